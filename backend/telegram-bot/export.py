@@ -0,0 +1,162 @@
+import csv
+import io
+import zlib
+from datetime import datetime
+
+from db_pool import transaction
+from pagination import encode_cursor
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8'
+}
+
+COLUMNS = ('id', 'email', 'country_code', 'country_name', 'country_flag', 'service_name',
+           'service_emoji', 'received_code', 'created_at', 'expires_at', 'is_archived')
+
+# Время форматируется в PostgreSQL: строка ISO 8601 приходит готовой, без разбора
+# в datetime и isoformat() на каждую строку
+ISO = 'YYYY-MM-DD"T"HH24:MI:SS.US'
+TEXT_COLUMNS = {'created_at': f"to_char(created_at, '{ISO}')", 'expires_at': f"to_char(expires_at, '{ISO}')"}
+
+
+def select_list(columns: tuple, fmt: str) -> str:
+    """Колонки запроса: id и created_at (для курсора продолжения), затем данные строки
+
+    Для NDJSON объект строки собирает json_build_object на стороне PostgreSQL:
+    это быстрее, чем dict и json.dumps на каждую строку в Python.
+    """
+    key = f"id, {TEXT_COLUMNS['created_at']}"
+    if fmt == 'ndjson':
+        pairs = ', '.join(f"'{column}', {column}" for column in columns)
+        return f"{key}, json_build_object({pairs})::text"
+    return f"{key}, " + ', '.join(TEXT_COLUMNS.get(column, column) for column in columns)
+
+
+class RowEncoder:
+    """Кодирование пачек строк (id, created_at, данные...) в NDJSON или CSV
+
+    Объект переиспользуется между пачками: буфер и writer CSV и поток сжатия
+    gzip (при compress) создаются один раз на выгрузку.
+    """
+
+    def __init__(self, columns: tuple, fmt: str = 'ndjson', compress: bool = False):
+        self.columns = columns
+        self.fmt = fmt
+        self._buffer = io.StringIO()
+        self._csv = csv.writer(self._buffer, lineterminator='\n')
+        self._zlib = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    @property
+    def compressed(self) -> bool:
+        return self._zlib is not None
+
+    def _bytes(self, text: str) -> bytes:
+        data = text.encode('utf-8')
+        return self._zlib.compress(data) if self._zlib else data
+
+    def header(self) -> bytes:
+        if self.fmt != 'csv':
+            return b''
+        self._csv.writerow(self.columns)
+        return self._take()
+
+    def encode(self, rows: list) -> bytes:
+        if self.fmt == 'csv':
+            self._csv.writerows([row[2:] for row in rows])
+            return self._take()
+        return self._bytes('\n'.join([row[2] for row in rows]) + '\n')
+
+    def _take(self) -> bytes:
+        text = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return self._bytes(text)
+
+    def finish(self) -> bytes:
+        return self._zlib.flush() if self._zlib else b''
+
+
+class HistoryExport:
+    """Выгрузка истории почт пользователя (по user_id или telegram_id; без них — всех) кусками
+
+    Строки читаются именованным (серверным) курсором по chunk_rows за раз, поэтому
+    в памяти одновременно не больше одной пачки строк. Итерация отдаёт байты
+    выгрузки; после неё next_cursor указывает на продолжение, если выгрузка
+    упёрлась в max_rows или max_bytes. Лимит байт проверяется после каждой пачки:
+    страница больше max_bytes не более чем на одну пачку.
+    """
+
+    def __init__(self, conn, user_id: int = None, fmt: str = 'ndjson', compress: bool = False,
+                 chunk_rows: int = 5000, max_rows: int = None, position: tuple = None,
+                 telegram_id: int = None, max_bytes: int = None):
+        self.conn = conn
+        self.user_id = user_id
+        self.telegram_id = telegram_id
+        scoped = user_id is not None or telegram_id is not None
+        self.columns = COLUMNS if scoped else ('user_id',) + COLUMNS
+        self.encoder = RowEncoder(self.columns, fmt, compress)
+        self.chunk_rows = chunk_rows
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.position = position
+        self.rows = 0
+        self.bytes = 0
+        self.next_cursor = None
+
+    def query(self) -> tuple:
+        conditions = []
+        params = []
+        if self.user_id is not None:
+            conditions.append("user_id = %s")
+            params.append(self.user_id)
+        elif self.telegram_id is not None:
+            # Пользователь находится в том же запросе, без отдельного SELECT перед выгрузкой
+            conditions.append("user_id = (SELECT id FROM users WHERE telegram_id = %s)")
+            params.append(self.telegram_id)
+        if self.position:
+            conditions.append("(created_at, id) < (%s, %s)")
+            params += list(self.position)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        # +1 строка, чтобы понять, есть ли продолжение
+        limit = "LIMIT %s" if self.max_rows else ''
+        if self.max_rows:
+            params.append(self.max_rows + 1)
+        return f"""
+            SELECT {select_list(self.columns, self.encoder.fmt)}
+            FROM temp_emails
+            {where}
+            ORDER BY created_at DESC, id DESC
+            {limit}
+        """, params
+
+    def __iter__(self):
+        query, params = self.query()
+        yield self.encoder.header()
+
+        with transaction(self.conn), self.conn.cursor(name='history_export') as cursor:
+            cursor.execute(query, params)
+            last = None
+            while True:
+                rows = cursor.fetchmany(self.chunk_rows)
+                if not rows:
+                    break
+                more = self.max_rows and self.rows + len(rows) > self.max_rows
+                if more:
+                    rows = rows[:self.max_rows - self.rows]
+                if rows:
+                    self.rows += len(rows)
+                    last = rows[-1]
+                    data = self.encoder.encode(rows)
+                    self.bytes += len(data)
+                    yield data
+                if not more and self.max_bytes and self.bytes >= self.max_bytes:
+                    # Продолжение нужно, только если за пачкой есть ещё строки
+                    more = cursor.fetchone() is not None
+                    if not more:
+                        break
+                if more:
+                    self.next_cursor = encode_cursor(datetime.fromisoformat(last[1]), last[0])
+                    break
+
+        yield self.encoder.finish()
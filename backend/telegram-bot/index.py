@@ -1,8 +1,30 @@
+import base64
+import hmac
 import json
 import os
-import psycopg2
 from datetime import datetime, timedelta
 
+from psycopg2.extras import execute_values
+
+from db_pool import PreparedStatement, get_pool, get_router, transaction
+from export import FORMATS, HistoryExport
+from instrumentation import metrics, render_prometheus, span
+from pagination import decode_cursor, encode_cursor
+
+MAX_HISTORY_PAGE_SIZE = 100
+MAX_BATCH_SIZE = 1000
+EXPORT_MAX_ROWS = int(os.environ.get('EXPORT_MAX_ROWS', '100000'))
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', '5000'))
+# Ответ функции собирается в памяти целиком (тело и base64 для gzip), поэтому
+# страница выгрузки ограничена и по байтам: около EXPORT_MAX_BYTES плюс одна пачка
+EXPORT_MAX_BYTES = int(os.environ.get('EXPORT_MAX_BYTES', str(2 * 1024 * 1024)))
+
+FUNCTION_NAME = 'telegram-bot'
+ACTIONS = {'create_user', 'update_subscription', 'create_email', 'update_code',
+           'get_history', 'get_stats', 'rebuild_stats', 'update_settings', 'batch', 'export_history'}
+# Только читают: идут на реплику DATABASE_READ_URL, если она задана и не отстала
+READ_ACTIONS = {'get_history', 'get_stats', 'export_history'}
+
 def handler(event: dict, context) -> dict:
     """API для управления Telegram ботом одноразовых почт"""
     
@@ -26,352 +48,786 @@ def handler(event: dict, context) -> dict:
         
         db_url = os.environ.get('DATABASE_URL')
         schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+        pool = get_pool(db_url, schema)
+        router = get_router(db_url, os.environ.get('DATABASE_READ_URL'), schema)
         
-        conn = psycopg2.connect(db_url, options=f'-c search_path={schema}')
-        conn.autocommit = True
-        cursor = conn.cursor()
-        
-        if action == 'create_user':
-            telegram_id = body.get('telegram_id')
-            username = body.get('username', '')
-            first_name = body.get('first_name', '')
-            
-            cursor.execute("""
-                INSERT INTO users (telegram_id, username, first_name, is_subscribed)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (telegram_id) 
-                DO UPDATE SET username = EXCLUDED.username, 
-                             first_name = EXCLUDED.first_name,
-                             updated_at = CURRENT_TIMESTAMP
-                RETURNING id, telegram_id, is_subscribed
-            """, (telegram_id, username, first_name, False))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'success': True,
-                    'user': {
-                        'id': result[0],
-                        'telegram_id': result[1],
-                        'is_subscribed': result[2]
-                    }
-                }),
-                'isBase64Encoded': False
-            }
+        if action == 'pool_stats':
+            return response(200, {'success': True, 'pool': pool.stats(), 'reads': router.stats()})
         
-        elif action == 'update_subscription':
-            telegram_id = body.get('telegram_id')
-            is_subscribed = body.get('is_subscribed', True)
-            
-            cursor.execute("""
-                UPDATE users 
-                SET is_subscribed = %s, updated_at = CURRENT_TIMESTAMP
-                WHERE telegram_id = %s
-                RETURNING id
-            """, (is_subscribed, telegram_id))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'success': True,
-                    'updated': result is not None
-                }),
-                'isBase64Encoded': False
+        if action == 'metrics':
+            with pool.connection() as conn, conn.cursor() as cursor:
+                return metrics_response(cursor)
+        
+        reads = action in READ_ACTIONS
+        with router.connection(int_id(body.get('telegram_id'))) if reads else pool.connection() as conn, \
+                conn.cursor() as cursor:
+            with span(f'action:{action}' if action in ACTIONS else 'action:unknown', FUNCTION_NAME):
+                result = handle_action(action, body, cursor)
+            if not reads:
+                metrics.flush(cursor)
+        
+        if reads and metrics.due():
+            # Метрики пишутся только на основной сервер
+            with pool.connection() as conn, conn.cursor() as cursor:
+                metrics.flush(cursor)
+        
+        if not reads and result['statusCode'] == 200:
+            # Ближайшие чтения этих пользователей должны видеть только что записанное
+            for telegram_id in written_users(action, body):
+                router.pin(telegram_id)
+        
+        return result
+    
+    except Exception as e:
+        return response(500, {'error': str(e)})
+
+
+# Действия по telegram_id находят пользователя в том же запросе, что и данные;
+# самые частые запросы готовятся на соединении через PREPARE
+# Локальная часть регистрируется в email_local_parts тем же запросом, что и почта:
+# так адрес от клиента API уникален, как и выданный create_temp_email, и его видит
+# фильтр адресов smtp_server.py. Занять можно только свободную часть из запаса
+API_CREATE_EMAIL = PreparedStatement('api_create_email', """
+    WITH owner AS (
+        SELECT id FROM users WHERE telegram_id = %s
+    ), part AS (
+        INSERT INTO email_local_parts (local_part, reserved_at, assigned_at, expires_at)
+        SELECT %s, %s::timestamp, %s::timestamp, %s::timestamp
+        FROM owner
+        ON CONFLICT (local_part) DO UPDATE
+        SET reserved_at = EXCLUDED.reserved_at, assigned_at = EXCLUDED.assigned_at,
+            expires_at = EXCLUDED.expires_at
+        WHERE email_local_parts.assigned_at IS NULL
+        RETURNING local_part
+    ), inserted AS (
+        INSERT INTO temp_emails
+        (user_id, email, country_code, country_name, country_flag,
+         service_name, service_emoji, expires_at)
+        SELECT owner.id, %s, %s, %s, %s, %s, %s, %s::timestamp
+        FROM owner, part
+        RETURNING id, email, created_at, expires_at
+    )
+    SELECT EXISTS (SELECT 1 FROM owner), i.id, i.email, i.created_at, i.expires_at
+    FROM (SELECT 1) one
+    LEFT JOIN inserted i ON true
+""")
+
+
+def is_admin(body: dict) -> bool:
+    """Передан ли токен администратора (EXPORT_ADMIN_TOKEN) для действий по всем пользователям"""
+    admin_token = os.environ.get('EXPORT_ADMIN_TOKEN')
+    return bool(admin_token) and hmac.compare_digest(str(body.get('admin_token', '')), admin_token)
+
+
+def local_part(email) -> str:
+    """Локальная часть адреса в нижнем регистре; None, если адрес некорректен"""
+    if not isinstance(email, str) or email.count('@') != 1 or len(email) > 255:
+        return None
+    part = email.split('@', 1)[0].lower()
+    return part if 0 < len(part) <= 64 else None
+
+
+API_UPDATE_CODE = PreparedStatement('api_update_code', """
+    UPDATE temp_emails
+    SET received_code = %s
+    WHERE id = %s
+    RETURNING id, email, received_code
+""")
+
+
+def history_statement(name: str, condition: str = '') -> PreparedStatement:
+    """Страница истории вместе с users.id: строка есть, если пользователь найден (t.id NULL — почт нет)"""
+    return PreparedStatement(name, f"""
+        SELECT u.id, t.id, t.email, t.country_code, t.country_name, t.country_flag,
+               t.service_name, t.service_emoji, t.received_code,
+               t.created_at, t.expires_at, t.is_archived
+        FROM users u
+        LEFT JOIN LATERAL (
+            SELECT id, email, country_code, country_name, country_flag,
+                   service_name, service_emoji, received_code,
+                   created_at, expires_at, is_archived
+            FROM temp_emails
+            WHERE user_id = u.id {condition}
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s
+        ) t ON true
+        WHERE u.telegram_id = %s
+    """)
+
+
+API_HISTORY_FIRST = history_statement('api_history_first')
+API_HISTORY_OLDER = history_statement('api_history_older', "AND (created_at, id) < (%s::timestamp, %s::integer)")
+
+API_STATS = PreparedStatement('api_stats', """
+    SELECT COALESCE(s.total_emails, 0),
+           COALESCE(s.countries_used, 0),
+           COALESCE(s.services_used, 0),
+           COALESCE((
+               SELECT json_agg(json_build_object(
+                   'name', p.service_name, 'emoji', p.service_emoji, 'count', p.emails_count
+               ) ORDER BY p.emails_count DESC)
+               FROM (
+                   SELECT service_name, service_emoji, emails_count
+                   FROM user_service_stats
+                   WHERE user_id = u.id
+                   ORDER BY emails_count DESC
+                   LIMIT 3
+               ) p
+           ), '[]')
+    FROM users u
+    LEFT JOIN user_stats s ON s.user_id = u.id
+    WHERE u.telegram_id = %s
+""")
+
+
+def written_users(action: str, body: dict) -> set:
+    """telegram_id пользователей, чьи данные изменило действие"""
+    if action == 'batch':
+        return {int_id(op.get('telegram_id')) for op in body.get('operations') or []
+                if isinstance(op, dict)} - {None}
+    telegram_id = int_id(body.get('telegram_id'))
+    return {telegram_id} if telegram_id is not None else set()
+
+
+def handle_action(action: str, body: dict, cursor) -> dict:
+    """Выполнение одного действия API на соединении из пула"""
+    if action == 'create_user':
+        telegram_id = body.get('telegram_id')
+        username = body.get('username', '')
+        first_name = body.get('first_name', '')
+        
+        cursor.execute("""
+            INSERT INTO users (telegram_id, username, first_name, is_subscribed)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (telegram_id) 
+            DO UPDATE SET username = EXCLUDED.username, 
+                         first_name = EXCLUDED.first_name,
+                         updated_at = CURRENT_TIMESTAMP
+            RETURNING id, telegram_id, is_subscribed
+        """, (telegram_id, username, first_name, False))
+        
+        result = cursor.fetchone()
+        
+        return response(200, {
+            'success': True,
+            'user': {
+                'id': result[0],
+                'telegram_id': result[1],
+                'is_subscribed': result[2]
             }
+        })
+    
+    elif action == 'update_subscription':
+        telegram_id = body.get('telegram_id')
+        is_subscribed = body.get('is_subscribed', True)
         
-        elif action == 'create_email':
-            telegram_id = body.get('telegram_id')
-            email = body.get('email')
-            country_code = body.get('country_code')
-            country_name = body.get('country_name')
-            country_flag = body.get('country_flag')
-            service_name = body.get('service_name')
-            service_emoji = body.get('service_emoji')
-            
-            cursor.execute("SELECT id FROM users WHERE telegram_id = %s", (telegram_id,))
-            user = cursor.fetchone()
-            
-            if not user:
-                cursor.close()
-                conn.close()
-                return {
-                    'statusCode': 404,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'error': 'User not found'}),
-                    'isBase64Encoded': False
-                }
-            
-            user_id = user[0]
-            expires_at = datetime.now() + timedelta(minutes=15)
-            
-            cursor.execute("""
-                INSERT INTO temp_emails 
-                (user_id, email, country_code, country_name, country_flag, 
-                 service_name, service_emoji, expires_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id, email, created_at, expires_at
-            """, (user_id, email, country_code, country_name, country_flag,
-                  service_name, service_emoji, expires_at))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'success': True,
-                    'email': {
-                        'id': result[0],
-                        'email': result[1],
-                        'created_at': result[2].isoformat(),
-                        'expires_at': result[3].isoformat()
-                    }
-                }),
-                'isBase64Encoded': False
+        cursor.execute("""
+            UPDATE users 
+            SET is_subscribed = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE telegram_id = %s
+            RETURNING id
+        """, (is_subscribed, telegram_id))
+        
+        result = cursor.fetchone()
+        
+        return response(200, {
+            'success': True,
+            'updated': result is not None
+        })
+    
+    elif action == 'create_email':
+        telegram_id = body.get('telegram_id')
+        email = body.get('email')
+        country_code = body.get('country_code')
+        country_name = body.get('country_name')
+        country_flag = body.get('country_flag')
+        service_name = body.get('service_name')
+        service_emoji = body.get('service_emoji')
+        
+        part = local_part(email)
+        if part is None:
+            return response(400, {'error': 'Invalid email'})
+        # SMTP-сервер ищет получателя в нижнем регистре
+        email = email.lower()
+        
+        now = datetime.now()
+        expires_at = now + timedelta(minutes=15)
+        
+        API_CREATE_EMAIL.execute(cursor, (telegram_id, part, now, now, expires_at,
+                                          email, country_code, country_name, country_flag,
+                                          service_name, service_emoji, expires_at))
+        
+        user_found, email_id, email, created_at, expires_at = cursor.fetchone()
+        
+        if not user_found:
+            return response(404, {'error': 'User not found'})
+        if email_id is None:
+            return response(409, {'error': 'Email already taken'})
+        
+        return response(200, {
+            'success': True,
+            'email': {
+                'id': email_id,
+                'email': email,
+                'created_at': created_at.isoformat(),
+                'expires_at': expires_at.isoformat()
             }
+        })
+    
+    elif action == 'update_code':
+        email_id = body.get('email_id')
+        code = body.get('code')
+        
+        API_UPDATE_CODE.execute(cursor, (code, email_id))
         
-        elif action == 'update_code':
-            email_id = body.get('email_id')
-            code = body.get('code')
-            
-            cursor.execute("""
-                UPDATE temp_emails 
-                SET received_code = %s
-                WHERE id = %s
-                RETURNING id, email, received_code
-            """, (code, email_id))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'success': True,
-                    'email': {
-                        'id': result[0],
-                        'email': result[1],
-                        'code': result[2]
-                    }
-                }),
-                'isBase64Encoded': False
+        result = cursor.fetchone()
+        
+        return response(200, {
+            'success': True,
+            'email': {
+                'id': result[0],
+                'email': result[1],
+                'code': result[2]
             }
+        })
+    
+    elif action == 'get_history':
+        telegram_id = body.get('telegram_id')
+        limit = max(1, min(int(body.get('limit', 10)), MAX_HISTORY_PAGE_SIZE))
         
-        elif action == 'get_history':
-            telegram_id = body.get('telegram_id')
-            limit = body.get('limit', 10)
-            
-            cursor.execute("SELECT id FROM users WHERE telegram_id = %s", (telegram_id,))
-            user = cursor.fetchone()
-            
-            if not user:
-                cursor.close()
-                conn.close()
-                return {
-                    'statusCode': 404,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'error': 'User not found'}),
-                    'isBase64Encoded': False
-                }
-            
-            user_id = user[0]
-            
-            cursor.execute("""
-                SELECT id, email, country_code, country_name, country_flag,
-                       service_name, service_emoji, received_code,
-                       created_at, expires_at, is_archived
-                FROM temp_emails
-                WHERE user_id = %s
-                ORDER BY created_at DESC
-                LIMIT %s
-            """, (user_id, limit))
-            
-            emails = []
-            for row in cursor.fetchall():
-                emails.append({
-                    'id': row[0],
-                    'email': row[1],
-                    'country_code': row[2],
-                    'country_name': row[3],
-                    'country_flag': row[4],
-                    'service_name': row[5],
-                    'service_emoji': row[6],
-                    'received_code': row[7],
-                    'created_at': row[8].isoformat() if row[8] else None,
-                    'expires_at': row[9].isoformat() if row[9] else None,
-                    'is_archived': row[10]
-                })
-            
-            cursor.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'success': True,
-                    'emails': emails
-                }),
-                'isBase64Encoded': False
+        position = None
+        if body.get('cursor'):
+            try:
+                position = decode_cursor(body['cursor'])
+            except ValueError:
+                return response(400, {'error': 'Invalid cursor'})
+        
+        # Keyset-пагинация по индексу (user_id, created_at DESC, id DESC): +1 строка,
+        # чтобы понять, есть ли следующая страница
+        if position:
+            API_HISTORY_OLDER.execute(cursor, (position[0], position[1], limit + 1, telegram_id))
+        else:
+            API_HISTORY_FIRST.execute(cursor, (limit + 1, telegram_id))
+        
+        rows = cursor.fetchall()
+        if not rows:
+            return response(404, {'error': 'User not found'})
+        
+        rows = [row[1:] for row in rows if row[1] is not None]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][8], rows[-1][0])
+        
+        emails = []
+        for row in rows:
+            emails.append({
+                'id': row[0],
+                'email': row[1],
+                'country_code': row[2],
+                'country_name': row[3],
+                'country_flag': row[4],
+                'service_name': row[5],
+                'service_emoji': row[6],
+                'received_code': row[7],
+                'created_at': row[8].isoformat() if row[8] else None,
+                'expires_at': row[9].isoformat() if row[9] else None,
+                'is_archived': row[10]
+            })
+        
+        return response(200, {
+            'success': True,
+            'emails': emails,
+            'next_cursor': next_cursor
+        })
+    
+    elif action == 'get_stats':
+        telegram_id = body.get('telegram_id')
+        
+        API_STATS.execute(cursor, (telegram_id,))
+        stats = cursor.fetchone()
+        
+        if not stats:
+            return response(404, {'error': 'User not found'})
+        
+        return response(200, {
+            'success': True,
+            'stats': {
+                'total_emails': stats[0],
+                'countries_used': stats[1],
+                'services_used': stats[2],
+                'popular_services': stats[3]
             }
+        })
+    
+    elif action == 'rebuild_stats':
+        telegram_id = body.get('telegram_id')
+        user_id = None
+        
+        if telegram_id is None and not is_admin(body):
+            # Полный пересчёт блокирует вставки в temp_emails — только с токеном администратора
+            return response(403, {'error': 'Admin token required'})
         
-        elif action == 'get_stats':
-            telegram_id = body.get('telegram_id')
-            
+        if telegram_id is not None:
             cursor.execute("SELECT id FROM users WHERE telegram_id = %s", (telegram_id,))
             user = cursor.fetchone()
-            
             if not user:
-                cursor.close()
-                conn.close()
-                return {
-                    'statusCode': 404,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({'error': 'User not found'}),
-                    'isBase64Encoded': False
-                }
-            
+                return response(404, {'error': 'User not found'})
             user_id = user[0]
-            
-            cursor.execute("""
-                SELECT COUNT(*) as total,
-                       COUNT(DISTINCT country_code) as countries,
-                       COUNT(DISTINCT service_name) as services
-                FROM temp_emails
-                WHERE user_id = %s
-            """, (user_id,))
-            
-            stats = cursor.fetchone()
-            
-            cursor.execute("""
-                SELECT service_name, service_emoji, COUNT(*) as count
-                FROM temp_emails
-                WHERE user_id = %s
-                GROUP BY service_name, service_emoji
-                ORDER BY count DESC
-                LIMIT 3
-            """, (user_id,))
-            
-            popular_services = []
-            for row in cursor.fetchall():
-                popular_services.append({
-                    'name': row[0],
-                    'emoji': row[1],
-                    'count': row[2]
-                })
-            
-            cursor.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'success': True,
-                    'stats': {
-                        'total_emails': stats[0],
-                        'countries_used': stats[1],
-                        'services_used': stats[2],
-                        'popular_services': popular_services
-                    }
-                }),
-                'isBase64Encoded': False
-            }
         
-        elif action == 'update_settings':
-            telegram_id = body.get('telegram_id')
-            favorite_service = body.get('favorite_service')
-            notifications_enabled = body.get('notifications_enabled', True)
-            reminder_enabled = body.get('reminder_enabled', True)
-            
-            cursor.execute("""
-                UPDATE users 
-                SET favorite_service = %s,
-                    notifications_enabled = %s,
-                    reminder_enabled = %s,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE telegram_id = %s
-                RETURNING id
-            """, (favorite_service, notifications_enabled, reminder_enabled, telegram_id))
-            
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'success': True,
-                    'updated': result is not None
-                }),
-                'isBase64Encoded': False
-            }
+        rebuilt = rebuild_user_stats(cursor.connection, user_id)
+        
+        return response(200, {
+            'success': True,
+            'users_rebuilt': rebuilt
+        })
+    
+    elif action == 'update_settings':
+        telegram_id = body.get('telegram_id')
+        favorite_service = body.get('favorite_service')
+        notifications_enabled = body.get('notifications_enabled', True)
+        reminder_enabled = body.get('reminder_enabled', True)
+        
+        cursor.execute("""
+            UPDATE users 
+            SET favorite_service = %s,
+                notifications_enabled = %s,
+                reminder_enabled = %s,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE telegram_id = %s
+            RETURNING id
+        """, (favorite_service, notifications_enabled, reminder_enabled, telegram_id))
+        
+        result = cursor.fetchone()
+        
+        return response(200, {
+            'success': True,
+            'updated': result is not None
+        })
+    
+    elif action == 'export_history':
+        fmt = body.get('format', 'ndjson')
+        if fmt not in FORMATS:
+            return response(400, {'error': 'format must be ndjson or csv'})
+        limit = max(1, min(int(body.get('limit', EXPORT_MAX_ROWS)), EXPORT_MAX_ROWS))
+        
+        position = None
+        if body.get('cursor'):
+            try:
+                position = decode_cursor(body['cursor'])
+            except ValueError:
+                return response(400, {'error': 'Invalid cursor'})
         
+        telegram_id = body.get('telegram_id')
+        if telegram_id is None:
+            # Выгрузка по всем пользователям — только с токеном администратора
+            if not is_admin(body):
+                return response(403, {'error': 'Admin token required'})
+        
+        export = HistoryExport(
+            cursor.connection,
+            fmt=fmt,
+            compress=bool(body.get('gzip')),
+            chunk_rows=EXPORT_CHUNK_ROWS,
+            max_rows=limit,
+            max_bytes=EXPORT_MAX_BYTES,
+            position=position,
+            telegram_id=telegram_id
+        )
+        result = export_response(export, fmt)
+        
+        # Пользователь ищется в запросе выгрузки; отдельная проверка — только для пустой
+        if export.rows == 0 and telegram_id is not None:
+            cursor.execute("SELECT 1 FROM users WHERE telegram_id = %s", (telegram_id,))
+            if cursor.fetchone() is None:
+                return response(404, {'error': 'User not found'})
+        
+        return result
+    
+    elif action == 'batch':
+        operations = body.get('operations')
+        
+        if not isinstance(operations, list) or not operations:
+            return response(400, {'error': 'operations must be a non-empty list'})
+        if len(operations) > MAX_BATCH_SIZE:
+            return response(400, {'error': f'Too many operations (max {MAX_BATCH_SIZE})'})
+        
+        with transaction(cursor.connection):
+            results = run_batch(cursor, operations)
+        
+        return response(200, {
+            'success': True,
+            'results': results
+        })
+    
+    else:
+        return response(400, {'error': 'Unknown action'})
+
+
+def run_batch(cursor, operations: list) -> list:
+    """Пакет операций: по одному многострочному запросу на тип, результаты в порядке операций
+    
+    Типы выполняются в порядке BATCH_HANDLERS (пользователи создаются раньше их почт),
+    внутри типа повтор того же ключа перекрывает предыдущий (последний побеждает).
+    """
+    results = [None] * len(operations)
+    groups = {}
+    for index, operation in enumerate(operations):
+        action = operation.get('action') if isinstance(operation, dict) else None
+        if action in BATCH_HANDLERS:
+            groups.setdefault(action, []).append((index, operation))
+        else:
+            results[index] = {'error': 'Unsupported action'}
+    
+    for action, batch_handler in BATCH_HANDLERS.items():
+        if action in groups:
+            batch_handler(cursor, groups[action], results)
+    
+    return results
+
+
+def int_id(value):
+    """Целый идентификатор из запроса (число или строка из цифр); None, если он не целый"""
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def operation_ids(items: list, key: str, results: list) -> dict:
+    """Номер операции -> целое значение key; операции без key или с нецелым key получают ошибку"""
+    ids = {}
+    for index, operation in items:
+        value = operation.get(key)
+        if value is None:
+            results[index] = {'error': f'{key} is required'}
+        elif int_id(value) is None:
+            results[index] = {'error': f'{key} must be an integer'}
         else:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'error': 'Unknown action'}),
-                'isBase64Encoded': False
+            ids[index] = int_id(value)
+    return ids
+
+
+def latest_by(items: list, key: str, results: list) -> tuple:
+    """Последняя операция для каждого значения key и номера операций -> значение key
+
+    Значения приводятся к int: "123" и 123 — один и тот же ключ.
+    """
+    ids = operation_ids(items, key, results)
+    latest = {ids[index]: operation for index, operation in items if index in ids}
+    return latest, ids
+
+
+def batch_create_users(cursor, items: list, results: list):
+    latest, ids = latest_by(items, 'telegram_id', results)
+    if not latest:
+        return
+    
+    rows = execute_values(cursor, """
+        INSERT INTO users (telegram_id, username, first_name, is_subscribed)
+        VALUES %s
+        ON CONFLICT (telegram_id) 
+        DO UPDATE SET username = EXCLUDED.username, 
+                     first_name = EXCLUDED.first_name,
+                     updated_at = CURRENT_TIMESTAMP
+        RETURNING id, telegram_id, is_subscribed
+    """, [
+        (telegram_id, op.get('username', ''), op.get('first_name', ''))
+        for telegram_id, op in latest.items()
+    ], template='(%s, %s, %s, false)', page_size=len(latest), fetch=True)
+    
+    users = {row[1]: {'id': row[0], 'telegram_id': row[1], 'is_subscribed': row[2]} for row in rows}
+    for index in ids:
+        results[index] = {'success': True, 'user': users[ids[index]]}
+
+
+def batch_update_users(cursor, items: list, results: list, columns: dict):
+    """UPDATE users по telegram_id из VALUES; columns — колонка: (тип, значение по умолчанию)"""
+    latest, ids = latest_by(items, 'telegram_id', results)
+    if not latest:
+        return
+    
+    names = list(columns)
+    assignments = ', '.join(f'{name} = v.{name}' for name in names)
+    template = '(%s::bigint, ' + ', '.join(f'%s::{columns[name][0]}' for name in names) + ')'
+    rows = execute_values(cursor, f"""
+        UPDATE users u
+        SET {assignments}, updated_at = CURRENT_TIMESTAMP
+        FROM (VALUES %s) AS v(telegram_id, {', '.join(names)})
+        WHERE u.telegram_id = v.telegram_id
+        RETURNING u.telegram_id
+    """, [
+        (telegram_id,) + tuple(op.get(name, columns[name][1]) for name in names)
+        for telegram_id, op in latest.items()
+    ], template=template, page_size=len(latest), fetch=True)
+    
+    updated = {row[0] for row in rows}
+    for index in ids:
+        results[index] = {'success': True, 'updated': ids[index] in updated}
+
+
+def batch_update_subscriptions(cursor, items: list, results: list):
+    batch_update_users(cursor, items, results, {'is_subscribed': ('boolean', True)})
+
+
+def batch_update_settings(cursor, items: list, results: list):
+    batch_update_users(cursor, items, results, {
+        'favorite_service': ('varchar', None),
+        'notifications_enabled': ('boolean', True),
+        'reminder_enabled': ('boolean', True)
+    })
+
+
+# Обязательные поля почты и длина их колонок varchar в temp_emails
+EMAIL_FIELDS = {
+    'country_code': 10,
+    'country_name': 100,
+    'country_flag': 10,
+    'service_name': 100,
+    'service_emoji': 10
+}
+CODE_MAX_LENGTH = 50
+
+
+def email_fields_error(operation: dict) -> str:
+    """Ошибка в полях почты (NOT NULL и длина колонки); None, если поля в порядке"""
+    for name, max_length in EMAIL_FIELDS.items():
+        value = operation.get(name)
+        if not isinstance(value, str) or not value:
+            return f'{name} is required'
+        if len(value) > max_length:
+            return f'{name} is too long'
+    return None
+
+
+def batch_create_emails(cursor, items: list, results: list):
+    """Почты пакета; неполная операция получает свою ошибку, а не срывает весь пакет"""
+    expires_at = datetime.now() + timedelta(minutes=15)
+    values = []
+    for index, operation in items:
+        if operation.get('telegram_id') is None or not operation.get('email'):
+            results[index] = {'error': 'telegram_id and email are required'}
+            continue
+        telegram_id = int_id(operation['telegram_id'])
+        if telegram_id is None:
+            results[index] = {'error': 'telegram_id must be an integer'}
+            continue
+        part = local_part(operation['email'])
+        if part is None:
+            results[index] = {'error': 'Invalid email'}
+            continue
+        error = email_fields_error(operation)
+        if error:
+            results[index] = {'error': error}
+            continue
+        values.append((
+            index, telegram_id, operation['email'].lower(), part,
+            operation.get('country_code'), operation.get('country_name'), operation.get('country_flag'),
+            operation.get('service_name'), operation.get('service_emoji'), expires_at
+        ))
+    if not values:
+        return
+    
+    # id берутся из последовательности заранее: так строки RETURNING сопоставляются
+    # с операциями по номеру, а не по порядку вставки. Локальная часть регистрируется
+    # в email_local_parts (как в create_email); из повторов одной части в пакете
+    # почту получает первая операция
+    rows = execute_values(cursor, """
+        WITH v (ord, telegram_id, email, local_part, country_code, country_name, country_flag,
+                service_name, service_emoji, expires_at) AS (VALUES %s),
+        numbered AS (
+            SELECT v.*, u.id AS user_id, nextval('temp_emails_id_seq') AS id
+            FROM v
+            JOIN users u ON u.telegram_id = v.telegram_id
+        ),
+        firsts AS (
+            SELECT DISTINCT ON (local_part) *
+            FROM numbered
+            ORDER BY local_part, ord
+        ),
+        parts AS (
+            INSERT INTO email_local_parts (local_part, reserved_at, assigned_at, expires_at)
+            SELECT local_part, LOCALTIMESTAMP, LOCALTIMESTAMP, expires_at
+            FROM firsts
+            ON CONFLICT (local_part) DO UPDATE
+            SET reserved_at = EXCLUDED.reserved_at, assigned_at = EXCLUDED.assigned_at,
+                expires_at = EXCLUDED.expires_at
+            WHERE email_local_parts.assigned_at IS NULL
+            RETURNING local_part
+        ),
+        inserted AS (
+            INSERT INTO temp_emails 
+            (id, user_id, email, country_code, country_name, country_flag, 
+             service_name, service_emoji, expires_at)
+            SELECT f.id, f.user_id, f.email, f.country_code, f.country_name, f.country_flag,
+                   f.service_name, f.service_emoji, f.expires_at
+            FROM firsts f
+            JOIN parts p ON p.local_part = f.local_part
+            RETURNING id, email, created_at, expires_at
+        )
+        SELECT n.ord, i.id, i.email, i.created_at, i.expires_at
+        FROM numbered n
+        LEFT JOIN inserted i ON i.id = n.id
+    """, values,
+        template='(%s::int, %s::bigint, %s::varchar, %s::varchar, %s::varchar, %s::varchar, '
+                 '%s::varchar, %s::varchar, %s::varchar, %s::timestamp)',
+        page_size=len(values), fetch=True)
+    
+    for index, email_id, email, created_at, email_expires_at in rows:
+        if email_id is None:
+            results[index] = {'error': 'Email already taken'}
+            continue
+        results[index] = {
+            'success': True,
+            'email': {
+                'id': email_id,
+                'email': email,
+                'created_at': created_at.isoformat(),
+                'expires_at': email_expires_at.isoformat()
             }
+        }
+    for index, _ in items:
+        if results[index] is None:
+            results[index] = {'error': 'User not found'}
+
+
+def batch_update_codes(cursor, items: list, results: list):
+    # Код длиннее колонки received_code не должен срывать весь пакет
+    valid = []
+    for index, operation in items:
+        code = operation.get('code')
+        if code is not None and len(str(code)) > CODE_MAX_LENGTH:
+            results[index] = {'error': 'code is too long'}
+        else:
+            valid.append((index, operation))
+    latest, ids = latest_by(valid, 'email_id', results)
+    if not latest:
+        return
     
-    except Exception as e:
+    rows = execute_values(cursor, """
+        UPDATE temp_emails t
+        SET received_code = v.code
+        FROM (VALUES %s) AS v(id, code)
+        WHERE t.id = v.id
+        RETURNING t.id, t.email, t.received_code
+    """, [(email_id, op.get('code')) for email_id, op in latest.items()],
+        template='(%s::int, %s::varchar)', page_size=len(latest), fetch=True)
+    
+    emails = {row[0]: {'id': row[0], 'email': row[1], 'code': row[2]} for row in rows}
+    for index in ids:
+        email = emails.get(ids[index])
+        results[index] = {'success': True, 'email': email} if email else {'error': 'Email not found'}
+
+
+# Порядок выполнения групп пакета: сначала пользователи, затем их почты и коды
+BATCH_HANDLERS = {
+    'create_user': batch_create_users,
+    'update_subscription': batch_update_subscriptions,
+    'update_settings': batch_update_settings,
+    'create_email': batch_create_emails,
+    'update_code': batch_update_codes
+}
+
+
+def rebuild_user_stats(conn, user_id: int = None) -> int:
+    """Пересчёт агрегатов user_stats по temp_emails (для всех или одного пользователя)"""
+    scope = "user_id IS NOT NULL" if user_id is None else "user_id = %(user_id)s"
+    params = {'user_id': user_id}
+    
+    with transaction(conn), conn.cursor() as cursor:
+        # Блокируем вставки на время пересчёта, чтобы триггер не разошёлся с пересчётом
+        cursor.execute("LOCK TABLE temp_emails IN SHARE MODE")
+        
+        for table in ('user_country_stats', 'user_service_stats', 'user_stats'):
+            cursor.execute(f"DELETE FROM {table} WHERE {scope}", params)
+        
+        cursor.execute(f"""
+            INSERT INTO user_country_stats (user_id, country_code, emails_count)
+            SELECT user_id, country_code, COUNT(*)
+            FROM temp_emails
+            WHERE {scope}
+            GROUP BY user_id, country_code
+        """, params)
+        
+        cursor.execute(f"""
+            INSERT INTO user_service_stats (user_id, service_name, service_emoji, emails_count)
+            SELECT user_id, service_name, MAX(service_emoji), COUNT(*)
+            FROM temp_emails
+            WHERE {scope}
+            GROUP BY user_id, service_name
+        """, params)
+        
+        cursor.execute(f"""
+            INSERT INTO user_stats (user_id, total_emails, countries_used, services_used)
+            SELECT user_id, COUNT(*), COUNT(DISTINCT country_code), COUNT(DISTINCT service_name)
+            FROM temp_emails
+            WHERE {scope}
+            GROUP BY user_id
+        """, params)
+        
+        return cursor.rowcount
+
+
+def metrics_response(cursor) -> dict:
+    """Счётчики всех функций в текстовом формате Prometheus"""
+    metrics.flush(cursor, force=True)
+    cursor.execute("SELECT function, span, metric, value FROM metrics_counters ORDER BY function, span, metric")
+    
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': render_prometheus(cursor.fetchall()),
+        'isBase64Encoded': False
+    }
+
+
+def export_response(export: HistoryExport, fmt: str) -> dict:
+    """Ответ с файлом выгрузки; продолжение — в заголовке X-Next-Cursor
+
+    Страница собирается в памяти: её размер ограничивают max_rows и max_bytes выгрузки.
+    """
+    data = b''.join(export)
+    headers = {
+        'Content-Type': FORMATS[fmt],
+        'Content-Disposition': f'attachment; filename="history.{fmt}"',
+        'X-Rows': str(export.rows),
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'X-Next-Cursor, X-Rows'
+    }
+    if export.next_cursor:
+        headers['X-Next-Cursor'] = export.next_cursor
+    
+    if export.encoder.compressed:
+        headers['Content-Type'] = 'application/gzip'
+        headers['Content-Disposition'] = f'attachment; filename="history.{fmt}.gz"'
         return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+            'statusCode': 200,
+            'headers': headers,
+            'body': base64.b64encode(data).decode('ascii'),
+            'isBase64Encoded': True
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': data.decode('utf-8'),
+        'isBase64Encoded': False
+    }
+
+
+def response(status: int, body: dict) -> dict:
+    """Формирование HTTP ответа"""
+    return {
+        'statusCode': status,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps(body),
+        'isBase64Encoded': False
+    }
\ No newline at end of file
@@ -0,0 +1,27 @@
+import base64
+import struct
+from datetime import datetime, timedelta
+
+_EPOCH = datetime(1970, 1, 1)
+_FORMAT = '>qq'
+
+
+def encode_cursor(created_at: datetime, email_id: int) -> str:
+    """Непрозрачный курсор keyset-пагинации по (created_at, id)"""
+    micros = (created_at - _EPOCH) // timedelta(microseconds=1)
+    raw = struct.pack(_FORMAT, micros, email_id)
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Разбор курсора в (created_at, id); ValueError для повреждённого курсора"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        micros, email_id = struct.unpack(_FORMAT, raw)
+        # Подделанный курсор может выйти за пределы datetime или столбца id (integer)
+        created_at = _EPOCH + timedelta(microseconds=micros)
+    except (TypeError, ValueError, OverflowError, struct.error):
+        raise ValueError('Invalid cursor')
+    if not 0 < email_id < 2 ** 31:
+        raise ValueError('Invalid cursor')
+    return created_at, email_id
@@ -0,0 +1,187 @@
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bloom import BloomFilter
+
+# Без похожих символов (0/o, 1/l): 10 знаков из 32 — 50 бит случайности
+ALPHABET = 'abcdefghijkmnpqrstuvwxyz23456789'
+LOCAL_PART_LENGTH = int(os.environ.get('EMAIL_LOCAL_PART_LENGTH', '10'))
+MAX_ATTEMPTS = 5
+
+
+class AddressExhausted(Exception):
+    """Не удалось подобрать свободную локальную часть за MAX_ATTEMPTS попыток"""
+
+
+def generate_local_part(length: int = LOCAL_PART_LENGTH) -> str:
+    return ''.join(secrets.choice(ALPHABET) for _ in range(length))
+
+
+# CTE part(local_part) для запроса, который создаёт почту: локальная часть берётся
+# из запаса, а если он пуст — вставляется сгенерированная. Пустой part означает
+# коллизию сгенерированной части: запрос повторяется с новой (allocation_params)
+ALLOCATE_LOCAL_PART = """
+    free AS (
+        SELECT local_part
+        FROM email_local_parts
+        WHERE assigned_at IS NULL
+        ORDER BY reserved_at
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ), claimed AS (
+        UPDATE email_local_parts p
+        SET assigned_at = %s::timestamp, expires_at = %s::timestamp
+        FROM free
+        WHERE p.local_part = free.local_part
+        RETURNING p.local_part
+    ), generated AS (
+        INSERT INTO email_local_parts (local_part, reserved_at, assigned_at, expires_at)
+        SELECT %s::varchar, %s::timestamp, %s::timestamp, %s::timestamp
+        WHERE NOT EXISTS (SELECT 1 FROM free)
+        ON CONFLICT (local_part) DO NOTHING
+        RETURNING local_part
+    ), part AS (
+        SELECT local_part FROM claimed
+        UNION ALL
+        SELECT local_part FROM generated
+    )
+"""
+
+
+def allocation_params(expires_at: datetime) -> tuple:
+    """Параметры ALLOCATE_LOCAL_PART в порядке их появления в тексте"""
+    now = datetime.now()
+    return (now, expires_at, generate_local_part(), now, now, expires_at)
+
+
+def refill_pool(cursor, target: int) -> int:
+    """Пополнение запаса свободных локальных частей до target; возвращает число новых"""
+    cursor.execute("SELECT COUNT(*) FROM email_local_parts WHERE assigned_at IS NULL")
+    missing = target - cursor.fetchone()[0]
+    if missing <= 0:
+        return 0
+
+    # Редкие коллизии просто пропускаются ON CONFLICT: запас догонится следующим проходом
+    cursor.execute("""
+        INSERT INTO email_local_parts (local_part)
+        SELECT unnest(%s::varchar[])
+        ON CONFLICT (local_part) DO NOTHING
+    """, ([generate_local_part() for _ in range(missing)],))
+    return cursor.rowcount
+
+
+def prune_local_parts(cursor, keep_hours: int = 24, batch_size: int = 1000) -> int:
+    """Удаление локальных частей, истёкших больше keep_hours назад; возвращает их число
+
+    Пока строка есть, часть не выдаётся повторно: письма на старый адрес не
+    попадут новому владельцу. Удаление пачками по idx_email_local_parts_expires_at.
+    """
+    deleted = 0
+    while True:
+        cursor.execute("""
+            DELETE FROM email_local_parts
+            WHERE local_part IN (
+                SELECT local_part
+                FROM email_local_parts
+                WHERE expires_at < %s AND assigned_at IS NOT NULL
+                ORDER BY expires_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+        """, (datetime.now() - timedelta(hours=keep_hours), batch_size))
+        deleted += cursor.rowcount
+        if cursor.rowcount < batch_size:
+            return deleted
+
+
+class AddressFilter:
+    """Фильтр Блума по выданным и запасённым локальным частям для отказа в RCPT без БД
+
+    Адреса выдаются из запаса, который попадает в фильтр ещё до выдачи. Редкие
+    адреса, созданные в обход запаса, подхватывает дозагрузка по reserved_at:
+    при промахе она выполняется не чаще раза в refresh_interval секунд.
+    Полная перестройка раз в rebuild_interval убирает истёкшие адреса.
+    """
+
+    def __init__(self, pool, error_rate: float = 0.001, rebuild_interval: float = 600,
+                 refresh_interval: float = 1.0):
+        self.pool = pool
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.refresh_interval = refresh_interval
+        self.rejected = 0
+
+        self._bloom = None
+        self._loaded_at = 0.0
+        self._refreshed_at = 0.0
+        self._last_reserved = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Полная перестройка фильтра"""
+        with self.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT local_part, reserved_at
+                FROM email_local_parts
+                WHERE expires_at IS NULL OR expires_at > %s
+            """, (datetime.now(),))
+            rows = cursor.fetchall()
+
+        # Запас по ёмкости, чтобы дозагрузки до следующей перестройки не портили точность
+        bloom = BloomFilter(max(10000, len(rows) * 2), self.error_rate)
+        last_reserved = None
+        for local_part, reserved_at in rows:
+            bloom.add(local_part)
+            if last_reserved is None or reserved_at > last_reserved:
+                last_reserved = reserved_at
+
+        with self._lock:
+            self._bloom = bloom
+            self._last_reserved = last_reserved
+            self._loaded_at = self._refreshed_at = time.monotonic()
+
+    def refresh(self) -> bool:
+        """Дозагрузка строк, зарезервированных после последней загрузки; False — рано"""
+        with self._lock:
+            if time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return False
+            self._refreshed_at = time.monotonic()
+            since = self._last_reserved or datetime.min
+
+        with self.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT local_part, reserved_at
+                FROM email_local_parts
+                WHERE reserved_at >= %s
+            """, (since,))
+            rows = cursor.fetchall()
+
+        with self._lock:
+            for local_part, reserved_at in rows:
+                self._bloom.add(local_part)
+                if self._last_reserved is None or reserved_at > self._last_reserved:
+                    self._last_reserved = reserved_at
+        return True
+
+    def _is_stale(self) -> bool:
+        return self._bloom is None or time.monotonic() - self._loaded_at > self.rebuild_interval
+
+    def contains(self, address: str) -> bool:
+        """Проверка только в памяти, без ввода-вывода; False — нужен might_exist"""
+        return not self._is_stale() and address.rsplit('@', 1)[0].lower() in self._bloom
+
+    def might_exist(self, address: str) -> bool:
+        """False — адреса точно нет; True — нужна проверка в БД (обращается к БД)"""
+        if self._is_stale():
+            self.load()
+
+        local_part = address.rsplit('@', 1)[0].lower()
+        if local_part in self._bloom:
+            return True
+        if self.refresh() and local_part in self._bloom:
+            return True
+        self.rejected += 1
+        return False
@@ -0,0 +1,55 @@
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Общий пул потоков уровня модуля, переживает тёплые вызовы"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=int(os.environ.get('BACKGROUND_WORKERS', '8')),
+                    thread_name_prefix='update-io'
+                )
+    return _executor
+
+
+class TaskGroup:
+    """Независимые вызовы одного апдейта, выполняемые параллельно основному коду
+
+    Обязательные задачи (записи в БД, сообщения пользователю) ожидаются полностью.
+    Необязательные (например, ответ на callback) ждём не дольше grace секунд:
+    к концу обработки они почти всегда уже выполнены.
+    """
+
+    def __init__(self, concurrent: bool = True, grace: float = 1.0):
+        self.concurrent = concurrent
+        self.grace = grace
+        self._required = []
+        self._optional = []
+
+    def submit(self, fn, *args, required: bool = True):
+        if not self.concurrent:
+            fn(*args)
+            return
+
+        # Контекст копируется, чтобы SQL и вызовы Telegram попадали в span апдейта
+        future = get_executor().submit(contextvars.copy_context().run, fn, *args)
+        (self._required if required else self._optional).append(future)
+
+    def wait(self):
+        """Ожидание задач; первая ошибка обязательной задачи пробрасывается"""
+        if self._required:
+            wait(self._required)
+        if self._optional:
+            wait(self._optional, timeout=self.grace)
+        for future in self._required:
+            future.result()
+        self._required = []
+        self._optional = []
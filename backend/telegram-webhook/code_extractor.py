@@ -0,0 +1,176 @@
+import html
+import re
+
+# Первый проход: одно регулярное выражение со всеми ключевыми словами на разных
+# языках. Дорогие шаблоны кодов запускаются только рядом с найденным словом.
+KEYWORDS = re.compile(
+    r'code|otp|passcode|one[- ]time|verif|confirm|pin\b|'
+    r'код|пароль|подтвер|'
+    r'código|codigo|codice|kod\b|doğrulama|bestätigung|vérification|'
+    r'验证码|驗證碼|確認コード|認証コード|인증|رمز',
+    re.I
+)
+
+CODE = re.compile(
+    r'(?<![\w/#.-])'
+    r'(\d{3}[- ]\d{3}|\d{4,8}|(?=[A-Za-z0-9]*\d)(?=[A-Za-z0-9]*[A-Za-z])[A-Za-z0-9]{5,8})'
+    r'(?!\w|[/:-]\w|[.,]\d)'
+)
+
+LINK_KEYWORDS = re.compile(
+    r'confirm|verif|activat|validat|magic|login|signin|'
+    r'подтвер|активир|bestätig|confirmar|verificar|vérifi',
+    re.I
+)
+HREF = re.compile(r'''href\s*=\s*["']([^"']+)["']''', re.I)
+URL = re.compile(r'https?://[^\s<>"\']+')
+
+STYLE_OR_SCRIPT = re.compile(r'<(style|script)\b.*?</\1\s*>', re.I | re.S)
+TAG = re.compile(r'<[^>]+>')
+SPACES = re.compile(r'\s+')
+
+WINDOW_BEFORE = 40
+WINDOW_AFTER = 100
+
+# Шаблоны писем самих почтовых сервисов из show_services; ключ — домен отправителя
+SERVICE_RULES = {
+    'google.com': [
+        re.compile(r'\bG-(\d{6})\b'),
+        re.compile(r'verification code(?: is)?:?\s*(\d{6})', re.I)
+    ],
+    'yandex.ru': [
+        re.compile(r'код(?: подтверждения)?:?\s*(\d{4,8})', re.I)
+    ],
+    'mail.ru': [
+        re.compile(r'код(?: подтверждения)?:?\s*(\d{4,8})', re.I),
+        re.compile(r'(\d{6})\s*[-—–]\s*код', re.I)
+    ],
+    'proton.me': [
+        re.compile(r'verification code(?: is)?:?\s*(\d{6})', re.I)
+    ],
+    'yahoo.com': [
+        re.compile(r'verification code(?: is)?:?\s*(\d{5,8})', re.I)
+    ],
+    'tuta.com': [
+        re.compile(r'verification code:?\s*([A-Z0-9]{6,8})', re.I)
+    ]
+}
+SERVICE_ALIASES = {
+    'gmail.com': 'google.com',
+    'accounts.google.com': 'google.com',
+    'yandex.com': 'yandex.ru',
+    'id.yandex.ru': 'yandex.ru',
+    'corp.mail.ru': 'mail.ru',
+    'protonmail.com': 'proton.me',
+    'proton.ch': 'proton.me',
+    'yahoo-inc.com': 'yahoo.com',
+    'tutanota.com': 'tuta.com',
+    'tutanota.de': 'tuta.com'
+}
+
+
+class Extraction:
+    """Результат разбора письма: код, ссылка подтверждения и сработавшее правило"""
+
+    __slots__ = ('code', 'link', 'rule')
+
+    def __init__(self, code: str = None, link: str = None, rule: str = None):
+        self.code = code
+        self.link = link
+        self.rule = rule
+
+
+def html_to_text(value: str) -> str:
+    """Грубое, но быстрое удаление разметки"""
+    value = STYLE_OR_SCRIPT.sub(' ', value)
+    value = TAG.sub(' ', value)
+    return SPACES.sub(' ', html.unescape(value))
+
+
+def service_for(sender: str) -> str:
+    """Почтовый сервис по адресу или домену отправителя"""
+    if not sender:
+        return None
+    domain = sender.rsplit('@', 1)[-1].strip('> ').lower()
+    domain = SERVICE_ALIASES.get(domain, domain)
+    if domain in SERVICE_RULES:
+        return domain
+    parent = domain.split('.', 1)[-1]
+    parent = SERVICE_ALIASES.get(parent, parent)
+    return parent if parent in SERVICE_RULES else None
+
+
+def is_copyright_year(text: str, match) -> bool:
+    """«© 2025» в подвале письма — не код"""
+    value = match.group(1)
+    return (len(value) == 4 and value[:2] in ('19', '20')
+            and '©' in text[max(0, match.start() - 12):match.start()])
+
+
+def search_code(text: str, start: int, end: int):
+    for match in CODE.finditer(text, start, end):
+        if not is_copyright_year(text, match):
+            return match
+    return None
+
+
+def find_code(text: str) -> str:
+    """Код рядом с ключевым словом: сначала после него, затем перед ним"""
+    for keyword in KEYWORDS.finditer(text):
+        start, end = keyword.span()
+        match = search_code(text, end, min(len(text), end + WINDOW_AFTER))
+        if match is None:
+            match = search_code(text, max(0, start - WINDOW_BEFORE), start)
+        if match is not None:
+            return match.group(1).replace(' ', '').replace('-', '')
+    return None
+
+
+def find_link(text_body: str, html_body: str) -> str:
+    """Первая ссылка, похожая на подтверждение регистрации"""
+    candidates = []
+    if html_body:
+        candidates.extend(html.unescape(href) for href in HREF.findall(html_body))
+    if text_body:
+        candidates.extend(URL.findall(text_body))
+    for url in candidates:
+        if url.startswith(('http://', 'https://')) and LINK_KEYWORDS.search(url):
+            return url
+    return None
+
+
+def extract(subject: str, text_body: str = None, html_body: str = None,
+            sender: str = None) -> Extraction:
+    """Извлечение кода и ссылки подтверждения из темы, текста и HTML письма"""
+    service = service_for(sender)
+    rules = SERVICE_RULES.get(service, ())
+    html_text = None
+
+    def fields():
+        nonlocal html_text
+        if subject:
+            yield 'subject', subject
+        if text_body:
+            yield 'text', text_body
+        if html_body:
+            # HTML очищаем только если код не нашёлся в теме и тексте
+            if html_text is None:
+                html_text = html_to_text(html_body)
+            yield 'html', html_text
+
+    code = None
+    rule = None
+    for field, value in fields():
+        for pattern in rules:
+            match = pattern.search(value)
+            if match:
+                code, rule = match.group(1), f'{service}:{field}'
+                break
+        if code is None:
+            code = find_code(value)
+            if code is not None:
+                rule = f'generic:{field}'
+        if code is not None:
+            break
+
+    return Extraction(code=code, link=find_link(text_body, html_body), rule=rule)
@@ -0,0 +1,471 @@
+import os
+import re
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from instrumentation import cursor_class
+
+# psycopg2 импортируется при создании первого пула: апдейтам, которым не нужна
+# БД, не приходится ждать его на холодном старте
+psycopg2 = None
+
+
+def load_driver():
+    global psycopg2
+    import psycopg2.errorcodes
+    import psycopg2.extensions
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведённое время"""
+
+
+class _Entry:
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class ConnectionPool:
+    """Пул соединений PostgreSQL, который живёт между тёплыми вызовами функции"""
+
+    def __init__(self, dsn: str, schema: str, max_size: int = 5, max_lifetime: float = 600,
+                 check_interval: float = 30, acquire_timeout: float = 5, read_only: bool = False):
+        load_driver()
+        self.cursor_factory = cursor_class()
+        self.dsn = dsn
+        self.schema = schema
+        self.read_only = read_only
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self.acquire_timeout = acquire_timeout
+
+        self._idle = []
+        self._in_use = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'connects': 0,
+            'recycled': 0,
+            'broken': 0,
+            'waits': 0,
+            'wait_time': 0.0
+        }
+
+    def _connect(self) -> _Entry:
+        options = f'-c search_path={self.schema}'
+        if self.read_only:
+            # Запись, по ошибке отправленная в пул чтения, падает и на основном сервере
+            options += ' -c default_transaction_read_only=on'
+        conn = psycopg2.connect(self.dsn, options=options, cursor_factory=self.cursor_factory)
+        conn.autocommit = True
+        with self._cond:
+            self._stats['connects'] += 1
+        return _Entry(conn)
+
+    def _is_healthy(self, entry: _Entry) -> bool:
+        """Проверка соединения перед выдачей: закрыто, устарело или не отвечает"""
+        if entry.conn.closed:
+            return False
+
+        now = time.monotonic()
+        if now - entry.created_at > self.max_lifetime:
+            with self._cond:
+                self._stats['recycled'] += 1
+            return False
+
+        if now - entry.last_used > self.check_interval:
+            try:
+                with entry.conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            except psycopg2.Error:
+                with self._cond:
+                    self._stats['broken'] += 1
+                return False
+
+        return True
+
+    def _discard(self, entry: _Entry):
+        try:
+            entry.conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def getconn(self):
+        """Получение соединения из пула (или открытие нового, если есть место)"""
+        deadline = None
+        waited_from = None
+
+        while True:
+            with self._cond:
+                entry = None
+                if self._idle:
+                    entry = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                else:
+                    if deadline is None:
+                        waited_from = time.monotonic()
+                        deadline = waited_from + self.acquire_timeout
+                        self._stats['waits'] += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['wait_time'] += time.monotonic() - waited_from
+                        raise PoolTimeout(f'No free connection in {self.acquire_timeout}s')
+                    self._cond.wait(remaining)
+                    continue
+
+                if waited_from is not None:
+                    self._stats['wait_time'] += time.monotonic() - waited_from
+                    waited_from = None
+
+            if entry is None:
+                try:
+                    entry = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats['misses'] += 1
+            elif self._is_healthy(entry):
+                with self._cond:
+                    self._stats['hits'] += 1
+            else:
+                self._discard(entry)
+                continue
+
+            with self._cond:
+                self._in_use[id(entry.conn)] = entry
+            return entry.conn
+
+    def putconn(self, conn, broken: bool = False):
+        """Возврат соединения в пул; сломанные соединения закрываются"""
+        with self._cond:
+            entry = self._in_use.pop(id(conn), None)
+        if entry is None:
+            return
+
+        if not broken and not conn.closed:
+            status = conn.info.transaction_status
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+
+        if broken or conn.closed:
+            with self._cond:
+                self._stats['broken'] += 1
+            self._discard(entry)
+            return
+
+        entry.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Контекстный менеджер: соединение возвращается в пул после использования"""
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, broken=broken)
+
+    def closeall(self):
+        """Закрытие всех свободных соединений"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for entry in idle:
+            self._discard(entry)
+
+    def stats(self) -> dict:
+        """Статистика пула: попадания, промахи, подключения, ожидание"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = len(self._in_use)
+        stats['wait_time'] = round(stats['wait_time'], 6)
+        return stats
+
+
+@contextmanager
+def transaction(conn):
+    """Явная транзакция на соединении из пула (по умолчанию они в autocommit)"""
+    conn.autocommit = False
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.autocommit = True
+
+
+# Горячие запросы готовятся на сервере через PREPARE; за PgBouncer в режиме
+# transaction соединение сервера меняется между запросами — там DB_PREPARE=0
+PREPARE_STATEMENTS = os.environ.get('DB_PREPARE', '1') == '1'
+
+# Какие запросы уже подготовлены на соединении; соединение, закрытое пулом,
+# пропадает отсюда само
+_prepared = weakref.WeakKeyDictionary()
+
+
+class PreparedStatement:
+    """Запрос с параметрами %s, который на каждом соединении готовится один раз
+
+    PREPARE уходит на сервер в одном обращении с первым EXECUTE, поэтому лишнего
+    round-trip нет, а дальше сервер не разбирает и не планирует запрос заново.
+    """
+
+    def __init__(self, name: str, query: str):
+        self.name = name
+        self.query = query
+        numbers = iter(range(1, query.count('%s') + 1))
+        self.prepare = f"PREPARE {name} AS " + re.sub(r'%s', lambda _: f'${next(numbers)}', query)
+
+    def execute(self, cursor, params: tuple):
+        if not PREPARE_STATEMENTS:
+            cursor.execute(self.query, params)
+            return
+
+        conn = cursor.connection
+        names = _prepared.setdefault(conn, set())
+        call = f"EXECUTE {self.name} ({', '.join(['%s'] * len(params))})"
+        if self.name in names:
+            cursor.execute(call, params)
+            return
+
+        load_driver()
+        try:
+            cursor.execute(f"{self.prepare}; {call}", params)
+        except psycopg2.Error as e:
+            # PREPARE не откатывается вместе с транзакцией, так что после ошибки в
+            # EXECUTE запрос на соединении уже есть; не выполнился PREPARE только
+            # в прерванной ранее транзакции
+            if e.pgcode not in (None, psycopg2.errorcodes.IN_FAILED_SQL_TRANSACTION):
+                names.add(self.name)
+            raise
+        names.add(self.name)
+
+
+# Отставание реплики в секундах: 0, если всё полученное уже применено (иначе
+# простаивающий основной сервер выглядел бы как растущее отставание); на
+# основном сервере (DATABASE_READ_URL указывает на него же) — тоже 0
+REPLICA_LAG = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class ReadRouter:
+    """Чтения — на реплику (DATABASE_READ_URL), записи и чтения сразу после них — на основной сервер
+
+    Пользователь, который только что писал, на pin_seconds закрепляется за основным
+    сервером: реплика могла ещё не получить его изменения. Отставание реплики
+    замеряется не чаще раза в lag_check_interval; при отставании больше max_lag
+    или недоступной реплике чтения тоже идут на основной сервер.
+    """
+    MAX_PINNED = 10000
+
+    def __init__(self, primary: ConnectionPool, replica: ConnectionPool = None, pin_seconds: float = 5,
+                 max_lag: float = 2, lag_check_interval: float = 1):
+        self.primary = primary
+        self.replica = replica
+        self.pin_seconds = pin_seconds
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+
+        self._pinned = {}
+        self._lag = None
+        self._lag_checked_at = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'replica_reads': 0,
+            'primary_reads': 0,
+            'pinned_reads': 0,
+            'lagging_reads': 0,
+            'replica_errors': 0
+        }
+
+    def pin(self, key):
+        """Чтения key (telegram_id) ближайшие pin_seconds — только с основного сервера"""
+        if self.replica is None or key is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._pinned[key] = now + self.pin_seconds
+            if len(self._pinned) > self.MAX_PINNED:
+                self._pinned = {k: until for k, until in self._pinned.items() if until > now}
+
+    def _is_pinned(self, key) -> bool:
+        if key is None:
+            return False
+        with self._lock:
+            until = self._pinned.get(key)
+            if until is None:
+                return False
+            if until > time.monotonic():
+                return True
+            del self._pinned[key]
+            return False
+
+    def replica_lag(self):
+        """Отставание реплики в секундах (замер не чаще раза в lag_check_interval); None — недоступна"""
+        now = time.monotonic()
+        with self._lock:
+            if self._lag_checked_at is not None and now - self._lag_checked_at < self.lag_check_interval:
+                return self._lag
+            # Замеряет один поток, остальные до его результата читают прошлое значение
+            self._lag_checked_at = now
+
+        try:
+            with self.replica.connection() as conn, conn.cursor() as cursor:
+                cursor.execute(REPLICA_LAG)
+                lag = float(cursor.fetchone()[0])
+        except (psycopg2.Error, PoolTimeout):
+            lag = None
+
+        with self._lock:
+            self._lag = lag
+            if lag is None:
+                self._stats['replica_errors'] += 1
+        return lag
+
+    def _replica_conn(self, key):
+        """Соединение с реплики или None, если читать нужно с основного сервера"""
+        if self.replica is None:
+            return None
+
+        if self._is_pinned(key):
+            reason = 'pinned_reads'
+        else:
+            lag = self.replica_lag()
+            reason = 'lagging_reads' if lag is None or lag > self.max_lag else None
+
+        conn = None
+        if reason is None:
+            try:
+                conn = self.replica.getconn()
+            except (psycopg2.OperationalError, PoolTimeout):
+                reason = 'replica_errors'
+                with self._lock:
+                    # До следующего замера реплика считается недоступной
+                    self._lag = None
+                    self._lag_checked_at = time.monotonic()
+
+        with self._lock:
+            self._stats[reason or 'replica_reads'] += 1
+            if reason:
+                self._stats['primary_reads'] += 1
+        return conn
+
+    @contextmanager
+    def _replica_connection(self, conn):
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.replica.putconn(conn, broken=broken)
+
+    @contextmanager
+    def connection(self, key=None):
+        """Соединение для чтения данных key: с реплики или из пула основного сервера"""
+        conn = self._replica_conn(key)
+        with self._replica_connection(conn) if conn is not None else self.primary.connection() as conn:
+            yield conn
+
+    @contextmanager
+    def cursor(self, primary_cursor, key=None):
+        """Курсор для чтения данных key: с реплики или переданный курсор основного сервера"""
+        conn = self._replica_conn(key)
+        if conn is None:
+            yield primary_cursor
+            return
+        with self._replica_connection(conn), conn.cursor() as cursor:
+            yield cursor
+
+    def stats(self) -> dict:
+        """Куда шли чтения и последнее замеренное отставание"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['lag'] = self._lag
+            stats['pinned'] = len(self._pinned)
+        stats['replica'] = self.replica is not None
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def pool_options() -> dict:
+    """Параметры пула из переменных окружения DB_POOL_*"""
+    return {
+        'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', '5')),
+        'max_lifetime': float(os.environ.get('DB_POOL_MAX_LIFETIME', '600')),
+        'check_interval': float(os.environ.get('DB_POOL_CHECK_INTERVAL', '30')),
+        'acquire_timeout': float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '5'))
+    }
+
+
+def get_pool(dsn: str, schema: str) -> ConnectionPool:
+    """Пул уровня модуля для пары (DATABASE_URL, MAIN_DB_SCHEMA)"""
+    key = (dsn, schema)
+    pool = _pools.get(key)
+    if pool is not None:
+        return pool
+
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(dsn, schema, **pool_options())
+            _pools[key] = pool
+        return pool
+
+
+def get_router(dsn: str, read_dsn: str, schema: str) -> ReadRouter:
+    """Маршрутизатор чтений уровня модуля; без read_dsn все чтения идут в пул get_pool(dsn)"""
+    key = (dsn, read_dsn, schema)
+    router = _routers.get(key)
+    if router is not None:
+        return router
+
+    primary = get_pool(dsn, schema)
+    with _routers_lock:
+        router = _routers.get(key)
+        if router is None:
+            replica = ConnectionPool(read_dsn, schema, read_only=True, **pool_options()) if read_dsn else None
+            router = ReadRouter(
+                primary, replica,
+                pin_seconds=float(os.environ.get('REPLICA_PIN_SECONDS', '5')),
+                max_lag=float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '2')),
+                lag_check_interval=float(os.environ.get('REPLICA_LAG_CHECK_SECONDS', '1'))
+            )
+            _routers[key] = router
+        return router
@@ -1,9 +1,34 @@
+import html
 import json
 import os
-import psycopg2
-import requests
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 
+from addresses import ALLOCATE_LOCAL_PART, MAX_ATTEMPTS, AddressExhausted, allocation_params
+from background import TaskGroup
+from cache import LRUCache
+from db_pool import PreparedStatement, get_pool, get_router, transaction
+from instrumentation import metrics, span
+from pagination import decode_cursor, encode_cursor
+from rate_scheduler import get_scheduler
+from subscriptions import subscription_cache
+from telegram_client import TelegramError, WebhookReply, get_client
+from updates import claim_update, recent_updates, release_update
+from users import UserStatement, resolve_user
+
+HISTORY_PAGE_SIZE = 10
+
+FUNCTION_NAME = 'telegram-webhook'
+SPAN_COMMANDS = {'/start', '/help', '/stats'}
+SPAN_CALLBACKS = {'create_email', 'check_subscription', 'history', 'stats', 'help', 'support'}
+SPAN_CALLBACK_PREFIXES = ('country_', 'service_', 'history_', 'refresh_')
+
+# Ответ на эти апдейты не зависит от БД: они обрабатываются без пула соединений,
+# и холодный старт не импортирует psycopg2
+STATIC_COMMANDS = {'/help'}
+STATIC_CALLBACKS = {'help', 'support'}
+STATIC_CALLBACK_PREFIXES = ('country_',)
+
 def handler(event: dict, context) -> dict:
     """Webhook handler для Telegram бота одноразовых почт"""
     
@@ -30,10 +55,29 @@ def handler(event: dict, context) -> dict:
         if not bot_token:
             return response(500, {'error': 'Bot token not configured'})
         
-        if 'message' in update:
-            return handle_message(update['message'], bot_token, db_url, schema)
-        elif 'callback_query' in update:
-            return handle_callback(update['callback_query'], bot_token, db_url, schema)
+        # Повторная доставка того же апдейта (Telegram не дождался ответа) не обрабатывается
+        update_id = update.get('update_id')
+        if update_id is not None and not recent_updates.add(update_id):
+            return response(200, {'ok': True})
+        
+        client = get_scheduler(bot_token) if os.environ.get('TELEGRAM_RATE_LIMIT', '1') == '1' else get_client(bot_token)
+        
+        try:
+            reply = run_update(
+                update,
+                client,
+                get_pool(db_url, schema) if needs_db(update) else None,
+                reply_mode=os.environ.get('TELEGRAM_WEBHOOK_REPLY', '1') == '1',
+                use_outbox=os.environ.get('TELEGRAM_OUTBOX', '0') == '1'
+            )
+        except Exception:
+            # Любая ошибка (пул, claim_update, сам апдейт) — ответ 500, и повторная
+            # доставка должна обработать апдейт заново, а не отсечься буфером
+            if update_id is not None:
+                recent_updates.discard(update_id)
+            raise
+        if reply:
+            return response(200, reply)
         
         return response(200, {'ok': True})
         
@@ -41,28 +85,113 @@ def handler(event: dict, context) -> dict:
         return response(500, {'error': str(e)})
 
 
-def handle_message(message: dict, bot_token: str, db_url: str, schema: str) -> dict:
+def run_update(update: dict, client, pool, reply_mode: bool = False, use_outbox: bool = False) -> dict:
+    """Обработка апдейта с защитой от повторов; возвращает тело ответа вебхука или None
+
+    Общая точка входа для вебхука и для long polling (polling.py).
+    """
+    if 'message' not in update and 'callback_query' not in update:
+        return None
+    
+    if not needs_db(update):
+        # Повтор такого апдейта лишь повторит тот же текст, поэтому processed_updates не нужен
+        with span(span_name(update), FUNCTION_NAME):
+            bot = WebhookReply(client) if reply_mode else client
+            process_update(update, bot, None)
+        return bot.reply() if reply_mode else None
+    
+    update_id = update.get('update_id')
+    with pool.connection() as conn, conn.cursor() as cursor:
+        with span(span_name(update), FUNCTION_NAME):
+            if update_id is not None and not claim_update(cursor, update_id):
+                return None
+            # С outbox сообщения и изменения апдейта фиксируются одной транзакцией,
+            # а отправляет их outbox.py — задержка Telegram не входит в ответ вебхука
+            sender = client
+            if use_outbox:
+                from outbox import OutboxSender
+                sender = OutboxSender(conn, client)
+            bot = WebhookReply(sender) if reply_mode else sender
+            try:
+                with transaction(conn) if use_outbox else nullcontext():
+                    process_update(update, bot, cursor)
+            except Exception:
+                if update_id is not None:
+                    release_update(cursor, update_id)
+                raise
+        metrics.flush(cursor)
+    
+    return bot.reply() if reply_mode else None
+
+
+def read_router():
+    """Маршрутизатор чтений для экранов, которые только читают (DATABASE_READ_URL)"""
+    return get_router(os.environ.get('DATABASE_URL'), os.environ.get('DATABASE_READ_URL'),
+                      os.environ.get('MAIN_DB_SCHEMA', 'public'))
+
+
+def needs_db(update: dict) -> bool:
+    """Дешёвый разбор апдейта до подключения к БД: нужен ли для ответа пул соединений"""
+    if 'message' in update:
+        return update['message'].get('text', '') not in STATIC_COMMANDS
+    if 'callback_query' not in update:
+        # my_chat_member, edited_message и прочие апдейты бот не обрабатывает
+        return False
+    data = update['callback_query'].get('data', '')
+    return not (data in STATIC_CALLBACKS or data.startswith(STATIC_CALLBACK_PREFIXES))
+
+
+def span_name(update: dict) -> str:
+    """Имя span для метрик: команда или тип кнопки, без идентификаторов (ограниченный набор)"""
+    if 'message' in update:
+        text = update['message'].get('text', '')
+        return f'message:{text}' if text in SPAN_COMMANDS else 'message:text'
+    data = update['callback_query'].get('data', '')
+    if data in SPAN_CALLBACKS:
+        return f'callback:{data}'
+    for prefix in SPAN_CALLBACK_PREFIXES:
+        if data.startswith(prefix):
+            return f'callback:{prefix[:-1]}'
+    return 'callback:other'
+
+
+def process_update(update: dict, bot, cursor):
+    """Обработка сообщения или нажатия кнопки"""
+    if 'message' in update:
+        handle_message(update['message'], bot, cursor)
+    else:
+        tasks = TaskGroup(concurrent=os.environ.get('TELEGRAM_EARLY_ACK', '1') == '1')
+        try:
+            handle_callback(update['callback_query'], bot, cursor, tasks)
+        finally:
+            tasks.wait()
+
+
+def handle_message(message: dict, bot, cursor):
     """Обработка текстовых сообщений"""
     chat_id = message['chat']['id']
     text = message.get('text', '')
     user = message['from']
     
-    conn = psycopg2.connect(db_url, options=f'-c search_path={schema}')
-    conn.autocommit = True
-    cursor = conn.cursor()
+    if text == '/help':
+        help_text = (
+            "📖 <b>Инструкция по использованию</b>\n\n"
+            "1️⃣ Нажмите 'Создать почту'\n"
+            "2️⃣ Выберите страну\n"
+            "3️⃣ Выберите почтовый сервис\n"
+            "4️⃣ Получите временный email\n"
+            "5️⃣ Коды придут автоматически\n\n"
+            "⚠️ Почта удалится через 15 минут"
+        )
+        send_message(bot, chat_id, help_text)
+        return
     
-    cursor.execute("""
-        INSERT INTO users (telegram_id, username, first_name, is_subscribed)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (telegram_id) 
-        DO UPDATE SET username = EXCLUDED.username, 
-                     first_name = EXCLUDED.first_name,
-                     updated_at = CURRENT_TIMESTAMP
-        RETURNING id, is_subscribed
-    """, (user['id'], user.get('username', ''), user.get('first_name', ''), False))
+    if text == '/stats':
+        # Пользователь регистрируется тем же запросом, который читает статистику
+        show_stats(bot, chat_id, user, cursor)
+        return
     
-    user_data = cursor.fetchone()
-    is_subscribed = user_data[1]
+    resolve_user(cursor, user)
     
     if text == '/start':
         keyboard = {
@@ -86,69 +215,27 @@ def handle_message(message: dict, bot_token: str, db_url: str, schema: str) -> d
             "Выберите действие:"
         )
         
-        send_message(bot_token, chat_id, welcome_text, keyboard)
-    
-    elif text == '/help':
-        help_text = (
-            "📖 <b>Инструкция по использованию</b>\n\n"
-            "1️⃣ Нажмите 'Создать почту'\n"
-            "2️⃣ Выберите страну\n"
-            "3️⃣ Выберите почтовый сервис\n"
-            "4️⃣ Получите временный email\n"
-            "5️⃣ Коды придут автоматически\n\n"
-            "⚠️ Почта удалится через 15 минут"
-        )
-        send_message(bot_token, chat_id, help_text)
-    
-    elif text == '/stats':
-        cursor.execute("SELECT id FROM users WHERE telegram_id = %s", (user['id'],))
-        user_row = cursor.fetchone()
-        
-        if user_row:
-            user_db_id = user_row[0]
-            cursor.execute("""
-                SELECT COUNT(*) as total,
-                       COUNT(DISTINCT country_code) as countries,
-                       COUNT(DISTINCT service_name) as services
-                FROM temp_emails
-                WHERE user_id = %s
-            """, (user_db_id,))
-            
-            stats = cursor.fetchone()
-            stats_text = (
-                f"📊 <b>Ваша статистика</b>\n\n"
-                f"📧 Создано почт: {stats[0]}\n"
-                f"🌍 Использовано стран: {stats[1]}\n"
-                f"📮 Использовано сервисов: {stats[2]}"
-            )
-            send_message(bot_token, chat_id, stats_text)
-    
-    cursor.close()
-    conn.close()
-    
-    return response(200, {'ok': True})
+        send_message(bot, chat_id, welcome_text, keyboard)
 
 
-def handle_callback(callback: dict, bot_token: str, db_url: str, schema: str) -> dict:
+def handle_callback(callback: dict, bot, cursor, tasks: TaskGroup):
     """Обработка нажатий на inline-кнопки"""
     callback_id = callback['id']
     chat_id = callback['message']['chat']['id']
     data = callback['data']
     user_id = callback['from']['id']
     
-    conn = psycopg2.connect(db_url, options=f'-c search_path={schema}')
-    conn.autocommit = True
-    cursor = conn.cursor()
+    # Кнопка перестаёт «крутиться» сразу, а не после всех запросов к БД и Telegram.
+    # check_subscription отвечает сам: текст ответа зависит от результата проверки.
+    early_ack = tasks.concurrent and data != 'check_subscription'
+    if early_ack:
+        tasks.submit(answer_callback, bot.direct(), callback_id, required=False)
     
     if data == 'create_email':
-        is_member = check_channel_subscription(bot_token, user_id, '@zidesing')
+        is_member = is_channel_member(bot, cursor, tasks, user_id, '@zidesing')
         
         if is_member:
-            cursor.execute("""
-                UPDATE users SET is_subscribed = true 
-                WHERE telegram_id = %s
-            """, (user_id,))
-            show_countries(bot_token, chat_id)
+            show_countries(bot, chat_id)
         else:
             keyboard = {
                 'inline_keyboard': [[
@@ -157,40 +244,42 @@ def handle_callback(callback: dict, bot_token: str, db_url: str, schema: str) ->
                     {'text': '🔄 Проверить подписку', 'callback_data': 'check_subscription'}
                 ]]
             }
-            send_message(bot_token, chat_id, 
+            send_message(bot, chat_id, 
                         "⚠️ Для использования бота подпишитесь на наш канал:",
                         keyboard)
     
     elif data == 'check_subscription':
-        is_member = check_channel_subscription(bot_token, user_id, '@zidesing')
+        is_member = is_channel_member(bot, cursor, tasks, user_id, '@zidesing', force=True)
         
         if is_member:
-            cursor.execute("""
-                UPDATE users SET is_subscribed = true 
-                WHERE telegram_id = %s
-            """, (user_id,))
-            answer_callback(bot_token, callback_id, "✅ Подписка подтверждена!")
-            show_countries(bot_token, chat_id)
+            answer_callback(bot, callback_id, "✅ Подписка подтверждена!")
+            show_countries(bot, chat_id)
         else:
-            answer_callback(bot_token, callback_id, "❌ Подписка не найдена")
+            answer_callback(bot, callback_id, "❌ Подписка не найдена")
     
     elif data.startswith('country_'):
         country_code = data.split('_')[1]
-        show_services(bot_token, chat_id, country_code)
+        show_services(bot, chat_id, country_code)
     
     elif data.startswith('service_'):
         parts = data.split('_')
         country_code = parts[1]
         service_name = '_'.join(parts[2:])
-        email_id = create_temp_email(bot_token, chat_id, user_id, country_code, service_name, cursor)
-        if email_id:
-            start_email_monitoring(bot_token, chat_id, email_id, cursor)
+        create_temp_email(bot, chat_id, callback['from'], country_code, service_name, cursor)
     
     elif data == 'history':
-        show_history(bot_token, chat_id, user_id, cursor)
+        show_history(bot, chat_id, callback['from'], cursor)
+    
+    elif data.startswith('history_'):
+        parts = data.split('_', 2)
+        if len(parts) < 3:
+            # Устаревшая или подделанная кнопка — первая страница, как при неверном курсоре
+            parts = ['history', 'n', None]
+        _, direction, page_cursor = parts
+        show_history(bot, chat_id, callback['from'], cursor, page_cursor, newer=direction == 'p')
     
     elif data == 'stats':
-        show_stats(bot_token, chat_id, user_id, cursor)
+        show_stats(bot, chat_id, callback['from'], cursor)
     
     elif data == 'help':
         help_text = (
@@ -200,7 +289,7 @@ def handle_callback(callback: dict, bot_token: str, db_url: str, schema: str) ->
             "3️⃣ Получите email и коды\n"
             "4️⃣ Почта удалится через 15 минут"
         )
-        send_message(bot_token, chat_id, help_text)
+        send_message(bot, chat_id, help_text)
     
     elif data == 'support':
         support_text = (
@@ -209,20 +298,23 @@ def handle_callback(callback: dict, bot_token: str, db_url: str, schema: str) ->
             "💬 Telegram: @ZIBot_admin\n"
             "⏰ Работаем 24/7"
         )
-        send_message(bot_token, chat_id, support_text)
+        send_message(bot, chat_id, support_text)
     
     elif data.startswith('refresh_'):
         email_id = int(data.split('_')[1])
-        refresh_email_inbox(bot_token, chat_id, email_id, cursor)
-    
-    answer_callback(bot_token, callback_id)
-    cursor.close()
-    conn.close()
+        refresh_email_inbox(bot, chat_id, email_id, cursor)
     
-    return response(200, {'ok': True})
+    if not early_ack and data != 'check_subscription':
+        answer_callback(bot, callback_id)
 
 
-def show_countries(bot_token: str, chat_id: int):
+def execute_write(conn, query: str, params: tuple):
+    """Запись в БД на отдельном курсоре, параллельно с вызовами Telegram"""
+    with conn.cursor() as cursor:
+        cursor.execute(query, params)
+
+
+def show_countries(bot, chat_id: int):
     """Отображение выбора страны"""
     countries = [
         ('🇷🇺', 'Россия', 'RU'),
@@ -244,10 +336,10 @@ def show_countries(bot_token: str, chat_id: int):
                 row.append({'text': f'{flag} {name}', 'callback_data': f'country_{code}'})
         keyboard['inline_keyboard'].append(row)
     
-    send_message(bot_token, chat_id, "🌍 <b>Выберите страну:</b>", keyboard)
+    send_message(bot, chat_id, "🌍 <b>Выберите страну:</b>", keyboard)
 
 
-def show_services(bot_token: str, chat_id: int, country_code: str):
+def show_services(bot, chat_id: int, country_code: str):
     """Отображение выбора почтового сервиса"""
     services = [
         ('🟡', 'Яндекс', 'yandex'),
@@ -267,41 +359,43 @@ def show_services(bot_token: str, chat_id: int, country_code: str):
     
     keyboard['inline_keyboard'].append([{'text': '🔙 Назад', 'callback_data': 'create_email'}])
     
-    send_message(bot_token, chat_id, "📮 <b>Выберите почтовый сервис:</b>", keyboard)
+    send_message(bot, chat_id, "📮 <b>Выберите почтовый сервис:</b>", keyboard)
+
+
+# Пользователь, локальная часть адреса и почта — одним запросом
+CREATE_EMAIL = UserStatement('create_email', """
+    INSERT INTO temp_emails
+    (user_id, email, country_code, country_name, country_flag,
+     service_name, service_emoji, expires_at)
+    SELECT me.id, part.local_part || '@' || %s, %s, %s, %s, %s, %s, %s::timestamp
+    FROM me, part
+    RETURNING user_id, id, email
+""", ctes=ALLOCATE_LOCAL_PART)
 
 
-def create_temp_email(bot_token: str, chat_id: int, user_id: int, country_code: str, 
+def create_temp_email(bot, chat_id: int, tg_user: dict, country_code: str, 
                      service_name: str, cursor):
     """Создание временной почты"""
-    cursor.execute("SELECT id FROM users WHERE telegram_id = %s", (user_id,))
-    user_row = cursor.fetchone()
-    
-    if not user_row:
-        send_message(bot_token, chat_id, "❌ Ошибка: пользователь не найден")
-        return None
-    
-    user_db_id = user_row[0]
-    
-    email = f"temp{user_id}_{int(datetime.now().timestamp())}@{service_name}.com"
     expires_at = datetime.now() + timedelta(minutes=15)
+    domain = (os.environ.get('MAIL_DOMAIN') or f"{service_name}.com").lower()
     
-    cursor.execute("""
-        INSERT INTO temp_emails 
-        (user_id, email, country_code, country_name, country_flag, 
-         service_name, service_emoji, expires_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        RETURNING id
-    """, (user_db_id, email, country_code, 'Country', '🌍', 
-          service_name, '📧', expires_at))
+    for _ in range(MAX_ATTEMPTS):
+        rows = CREATE_EMAIL.fetchall(cursor, tg_user, allocation_params(expires_at) + (
+            domain, country_code, 'Country', '🌍', service_name, '📧', expires_at))
+        if rows:
+            break
+    else:
+        raise AddressExhausted('No free local part')
     
-    email_id = cursor.fetchone()[0]
+    _, email_id, email = rows[0]
+    # Следующие экраны пользователя (история, статистика) должны видеть эту почту
+    read_router().pin(tg_user['id'])
     
     email_text = (
         f"✅ <b>Временная почта создана!</b>\n\n"
         f"📧 <code>{email}</code>\n\n"
         f"⏰ Действует 15 минут\n"
-        f"🔔 Коды и письма придут автоматически\n\n"
-        f"Проверяем входящие каждые 5 секунд..."
+        f"🔔 Коды и письма придут в этот чат сразу после получения"
     )
     
     keyboard = {
@@ -313,67 +407,96 @@ def create_temp_email(bot_token: str, chat_id: int, user_id: int, country_code:
         ]]
     }
     
-    send_message(bot_token, chat_id, email_text, keyboard)
+    send_message(bot, chat_id, email_text, keyboard)
     return email_id
 
 
-def show_history(bot_token: str, chat_id: int, user_id: int, cursor):
-    """Отображение истории почт"""
-    cursor.execute("SELECT id FROM users WHERE telegram_id = %s", (user_id,))
-    user_row = cursor.fetchone()
-    
-    if not user_row:
-        send_message(bot_token, chat_id, "❌ История пуста")
-        return
-    
-    user_db_id = user_row[0]
-    
-    cursor.execute("""
-        SELECT email, service_name, received_code, created_at, expires_at
-        FROM temp_emails
-        WHERE user_id = %s
-        ORDER BY created_at DESC
-        LIMIT 10
-    """, (user_db_id,))
+def history_statement(name: str, condition: str = '', order: str = 'DESC') -> UserStatement:
+    """Страница истории: строка me есть всегда, почты — через LATERAL (t.id NULL, если их нет)"""
+    return UserStatement(name, f"""
+        SELECT me.id, t.id, t.email, t.service_name, t.received_code, t.created_at, t.expires_at
+        FROM me
+        LEFT JOIN LATERAL (
+            SELECT id, email, service_name, received_code, created_at, expires_at
+            FROM temp_emails
+            WHERE user_id = me.id {condition}
+            ORDER BY created_at {order}, id {order}
+            LIMIT %s
+        ) t ON true
+    """)
+
+
+HISTORY_FIRST = history_statement('history_first')
+HISTORY_OLDER = history_statement('history_older', "AND (created_at, id) < (%s::timestamp, %s::integer)")
+HISTORY_NEWER = history_statement('history_newer', "AND (created_at, id) > (%s::timestamp, %s::integer)", 'ASC')
+
+
+def show_history(bot, chat_id: int, tg_user: dict, cursor, page_cursor: str = None,
+                 newer: bool = False):
+    """Отображение истории почт (страница до или после курсора)"""
+    position = None
+    if page_cursor:
+        try:
+            position = decode_cursor(page_cursor)
+        except ValueError:
+            newer = False
+    
+    reads = read_router()
+    if position and newer:
+        rows = HISTORY_NEWER.fetchall(cursor, tg_user, (position[0], position[1], HISTORY_PAGE_SIZE + 1), reads)
+    elif position:
+        rows = HISTORY_OLDER.fetchall(cursor, tg_user, (position[0], position[1], HISTORY_PAGE_SIZE + 1), reads)
+    else:
+        rows = HISTORY_FIRST.fetchall(cursor, tg_user, (HISTORY_PAGE_SIZE + 1,), reads)
+    emails = [row[1:] for row in rows if row[1] is not None]
     
-    emails = cursor.fetchall()
+    if position and newer:
+        has_newer = len(emails) > HISTORY_PAGE_SIZE
+        has_older = True
+        emails = emails[:HISTORY_PAGE_SIZE][::-1]
+    else:
+        has_newer = position is not None
+        has_older = len(emails) > HISTORY_PAGE_SIZE
+        emails = emails[:HISTORY_PAGE_SIZE]
     
     if not emails:
-        send_message(bot_token, chat_id, "📭 <b>История пуста</b>\n\nСоздайте свою первую почту!")
+        send_message(bot, chat_id, "📭 <b>История пуста</b>\n\nСоздайте свою первую почту!")
         return
     
     history_text = "📜 <b>История почт:</b>\n\n"
-    for email, service, code, created, expires in emails:
+    for email_id, email, service, code, created, expires in emails:
         status = "✅ Активна" if datetime.now() < expires else "⏰ Истекла"
         code_text = f"\n🔑 Код: <code>{code}</code>" if code else ""
         history_text += (
-            f"📧 <code>{email}</code>\n"
+            f"📧 <code>{html.escape(email)}</code>\n"
             f"📮 {service} | {status}{code_text}\n\n"
         )
     
-    send_message(bot_token, chat_id, history_text)
+    paging = []
+    if has_newer:
+        first = emails[0]
+        paging.append({'text': '◀️', 'callback_data': f'history_p_{encode_cursor(first[4], first[0])}'})
+    if has_older:
+        last = emails[-1]
+        paging.append({'text': '▶️', 'callback_data': f'history_n_{encode_cursor(last[4], last[0])}'})
+    
+    keyboard = {'inline_keyboard': [paging]} if paging else None
+    send_message(bot, chat_id, history_text, keyboard)
+
+
+STATS = UserStatement('stats', """
+    SELECT me.id,
+           COALESCE(s.total_emails, 0),
+           COALESCE(s.countries_used, 0),
+           COALESCE(s.services_used, 0)
+    FROM me
+    LEFT JOIN user_stats s ON s.user_id = me.id
+""")
 
 
-def show_stats(bot_token: str, chat_id: int, user_id: int, cursor):
+def show_stats(bot, chat_id: int, tg_user: dict, cursor):
     """Отображение статистики"""
-    cursor.execute("SELECT id FROM users WHERE telegram_id = %s", (user_id,))
-    user_row = cursor.fetchone()
-    
-    if not user_row:
-        send_message(bot_token, chat_id, "📊 Статистика недоступна")
-        return
-    
-    user_db_id = user_row[0]
-    
-    cursor.execute("""
-        SELECT COUNT(*) as total,
-               COUNT(DISTINCT country_code) as countries,
-               COUNT(DISTINCT service_name) as services
-        FROM temp_emails
-        WHERE user_id = %s
-    """, (user_db_id,))
-    
-    stats = cursor.fetchone()
+    stats = STATS.fetchall(cursor, tg_user, reads=read_router())[0][1:]
     
     stats_text = (
         f"📊 <b>Ваша статистика</b>\n\n"
@@ -382,28 +505,63 @@ def show_stats(bot_token: str, chat_id: int, user_id: int, cursor):
         f"📮 Использовано сервисов: {stats[2]}"
     )
     
-    send_message(bot_token, chat_id, stats_text)
+    send_message(bot, chat_id, stats_text)
+
+
+SUBSCRIPTION_STATE = PreparedStatement('subscription_state', """
+    SELECT is_subscribed, subscription_checked_at
+    FROM users WHERE telegram_id = %s
+""")
+
+
+def is_channel_member(bot, cursor, tasks: TaskGroup, user_id: int, channel: str,
+                      force: bool = False) -> bool:
+    """Подписка на канал с кэшем: память процесса, затем users, затем getChatMember"""
+    row = None
+    if not force:
+        cached = subscription_cache.get(user_id)
+        if cached is not None:
+            return cached
+        
+        SUBSCRIPTION_STATE.execute(cursor, (user_id,))
+        row = cursor.fetchone()
+        if row and subscription_cache.is_fresh(row[0], row[1]):
+            subscription_cache.put(user_id, row[0], row[1])
+            return row[0]
+    
+    is_member = check_channel_subscription(bot, user_id, channel)
+    if is_member is None:
+        # Telegram не ответил: не блокируем тех, кто уже был подписан
+        last_known = subscription_cache.last_known(user_id)
+        if last_known is None and row:
+            last_known = row[0]
+        return bool(last_known)
+    
+    checked_at = datetime.now()
+    subscription_cache.put(user_id, is_member, checked_at)
+    tasks.submit(execute_write, cursor.connection, """
+        UPDATE users 
+        SET is_subscribed = %s, subscription_checked_at = %s
+        WHERE telegram_id = %s
+    """, (is_member, checked_at, user_id))
+    return is_member
 
 
-def check_channel_subscription(bot_token: str, user_id: int, channel: str) -> bool:
-    """Проверка подписки на канал"""
+def check_channel_subscription(bot, user_id: int, channel: str):
+    """Проверка подписки на канал (None, если Telegram не ответил)"""
     try:
-        url = f"https://api.telegram.org/bot{bot_token}/getChatMember"
-        params = {'chat_id': channel, 'user_id': user_id}
-        resp = requests.get(url, params=params, timeout=5)
-        data = resp.json()
+        data = bot.call('getChatMember', {'chat_id': channel, 'user_id': user_id})
         
         if data.get('ok'):
             status = data['result']['status']
             return status in ['member', 'administrator', 'creator']
         return False
-    except:
-        return False
+    except TelegramError:
+        return None
 
 
-def send_message(bot_token: str, chat_id: int, text: str, keyboard=None):
+def send_message(bot, chat_id: int, text: str, keyboard=None):
     """Отправка сообщения в Telegram"""
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
     payload = {
         'chat_id': chat_id,
         'text': text,
@@ -413,85 +571,75 @@ def send_message(bot_token: str, chat_id: int, text: str, keyboard=None):
     if keyboard:
         payload['reply_markup'] = keyboard
     
-    requests.post(url, json=payload, timeout=5)
+    bot.send('sendMessage', payload)
 
 
-def answer_callback(bot_token: str, callback_id: str, text: str = None):
+def answer_callback(bot, callback_id: str, text: str = None):
     """Ответ на callback query"""
-    url = f"https://api.telegram.org/bot{bot_token}/answerCallbackQuery"
     payload = {'callback_query_id': callback_id}
     if text:
         payload['text'] = text
         payload['show_alert'] = False
-    requests.post(url, json=payload, timeout=5)
+    bot.send('answerCallbackQuery', payload)
 
 
-def start_email_monitoring(bot_token: str, chat_id: int, email_id: int, cursor):
-    """Запуск мониторинга входящих писем"""
-    import random
-    code = str(random.randint(100000, 999999))
-    
-    cursor.execute("""
-        UPDATE temp_emails 
-        SET received_code = %s
-        WHERE id = %s
-    """, (code, email_id))
-    
-    message_text = (
-        f"📬 <b>Получено новое письмо!</b>\n\n"
-        f"🔑 Код подтверждения: <code>{code}</code>\n\n"
-        f"✅ Скопируйте код для использования"
-    )
-    
-    keyboard = {
-        'inline_keyboard': [[
-            {'text': '🔄 Обновить входящие', 'callback_data': f'refresh_{email_id}'}
-        ]]
-    }
-    
-    send_message(bot_token, chat_id, message_text, keyboard)
+REFRESH_INBOX = PreparedStatement('refresh_inbox', """
+    SELECT t.email, t.received_code, t.expires_at, c.total, last.subject, last.link
+    FROM temp_emails t
+    LEFT JOIN LATERAL (
+        SELECT COUNT(*) AS total FROM inbound_messages m WHERE m.email_id = t.id
+    ) c ON true
+    LEFT JOIN LATERAL (
+        SELECT m.subject, m.link FROM inbound_messages m
+        WHERE m.email_id = t.id
+        ORDER BY m.received_at DESC
+        LIMIT 1
+    ) last ON true
+    WHERE t.id = %s
+""")
+
+# Почты, в которых код уже пришёл: их экран больше не меняется в ожидании письма,
+# и его можно читать с реплики; пока кода нет, «Обновить» читает основной сервер
+codes_received = LRUCache(int(os.environ.get('CODE_CACHE_SIZE', '10000')))
 
 
-def refresh_email_inbox(bot_token: str, chat_id: int, email_id: int, cursor):
+def refresh_email_inbox(bot, chat_id: int, email_id: int, cursor):
     """Обновление входящих писем"""
-    cursor.execute("""
-        SELECT email, received_code, expires_at
-        FROM temp_emails
-        WHERE id = %s
-    """, (email_id,))
+    with read_router().cursor(cursor) if codes_received.get(email_id) else nullcontext(cursor) as reader:
+        REFRESH_INBOX.execute(reader, (email_id,))
+        result = reader.fetchone()
     
-    result = cursor.fetchone()
     if not result:
-        send_message(bot_token, chat_id, "❌ Почта не найдена")
+        send_message(bot, chat_id, "❌ Почта не найдена")
         return
     
-    email, code, expires_at = result
+    email, code, expires_at, received, last_subject, last_link = result
+    if code:
+        codes_received.put(email_id, True)
     
     if datetime.now() > expires_at:
-        send_message(bot_token, chat_id, "⏰ Почта удалена (истек срок действия)")
+        send_message(bot, chat_id, "⏰ Почта удалена (истек срок действия)")
         return
     
     if code:
         message_text = (
-            f"📧 <b>Входящие для:</b> <code>{email}</code>\n\n"
-            f"📬 Получено писем: 1\n"
+            f"📧 <b>Входящие для:</b> <code>{html.escape(email)}</code>\n\n"
+            f"📬 Получено писем: {received}\n"
             f"🔑 Код: <code>{code}</code>\n\n"
             f"✅ Код можно скопировать нажатием"
         )
+    elif received:
+        message_text = (
+            f"📧 <b>Входящие для:</b> <code>{html.escape(email)}</code>\n\n"
+            f"📬 Получено писем: {received}\n"
+            f"✉️ Последнее: {html.escape(last_subject or '(без темы)')}"
+        )
+        if last_link:
+            message_text += f"\n🔗 <a href=\"{html.escape(last_link)}\">Ссылка подтверждения</a>"
     else:
-        import random
-        new_code = str(random.randint(100000, 999999))
-        cursor.execute("""
-            UPDATE temp_emails 
-            SET received_code = %s
-            WHERE id = %s
-        """, (new_code, email_id))
-        
         message_text = (
-            f"📧 <b>Входящие для:</b> <code>{email}</code>\n\n"
-            f"📬 Получено новое письмо!\n"
-            f"🔑 Код: <code>{new_code}</code>\n\n"
-            f"✅ Код готов к использованию"
+            f"📧 <b>Входящие для:</b> <code>{html.escape(email)}</code>\n\n"
+            f"📭 Писем пока нет"
         )
     
     keyboard = {
@@ -503,7 +651,7 @@ def refresh_email_inbox(bot_token: str, chat_id: int, email_id: int, cursor):
         ]]
     }
     
-    send_message(bot_token, chat_id, message_text, keyboard)
+    send_message(bot, chat_id, message_text, keyboard)
 
 
 def response(status: int, body: dict) -> dict:
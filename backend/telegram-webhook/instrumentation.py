@@ -0,0 +1,294 @@
+import json
+import os
+import re
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Границы корзин гистограммы длительности обработки (секунды)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_CHILDREN = 50
+
+# Первое слово запроса и первая таблица после FROM/INTO/UPDATE/JOIN
+SQL_LABEL = re.compile(r'^\s*(\w+)(?:.*?\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+))?', re.I | re.S)
+# Подготовленный запрос (db_pool.PreparedStatement) помечается своим именем
+SQL_EXECUTE = re.compile(r'(?:^|;)\s*EXECUTE\s+(\w+)', re.I)
+
+current_span = ContextVar('current_span', default=None)
+
+
+class Span:
+    """Одна обработка апдейта или действия API: итоги по SQL и вызовам Telegram"""
+
+    __slots__ = ('name', 'function', 'started', 'seconds', 'db_count', 'db_time',
+                 'tg_count', 'tg_time', 'children', 'error', '_lock')
+
+    def __init__(self, name: str, function: str):
+        self.name = name
+        self.function = function
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+        self.db_count = 0
+        self.db_time = 0.0
+        self.tg_count = 0
+        self.tg_time = 0.0
+        self.children = []
+        self.error = None
+        self._lock = threading.Lock()
+
+    def child(self, kind: str, label: str, seconds: float):
+        # Дочерние записи приходят и из фоновых потоков апдейта (TaskGroup)
+        with self._lock:
+            if kind == 'sql':
+                self.db_count += 1
+                self.db_time += seconds
+            else:
+                self.tg_count += 1
+                self.tg_time += seconds
+            if len(self.children) < MAX_CHILDREN:
+                self.children.append((kind, label, round(seconds * 1000, 2)))
+
+    def log_line(self) -> str:
+        line = {
+            'ts': round(time.time(), 3),
+            'fn': self.function,
+            'span': self.name,
+            'ms': round(self.seconds * 1000, 2),
+            'db': {'n': self.db_count, 'ms': round(self.db_time * 1000, 2)},
+            'tg': {'n': self.tg_count, 'ms': round(self.tg_time * 1000, 2)},
+            'children': self.children
+        }
+        if self.error:
+            line['error'] = self.error
+        return json.dumps(line, ensure_ascii=False)
+
+
+_labels = {}
+
+# Кэшируются только шаблоны запросов (str из кода). bytes — уже подставленные
+# параметры (execute_values отдаёт так каждую страницу), их кэш рос бы без предела
+LABEL_CACHE_MAX_QUERY = 8192
+LABEL_SCAN_CHARS = 2048
+
+
+def sql_label(query) -> str:
+    """Метка вида «SELECT temp_emails»; для шаблонов-литералов метка кэшируется"""
+    cacheable = isinstance(query, str) and len(query) <= LABEL_CACHE_MAX_QUERY
+    label = _labels.get(query) if cacheable else None
+    if label is None:
+        if isinstance(query, bytes):
+            text = query[:LABEL_SCAN_CHARS].decode('utf-8', 'replace')
+        else:
+            text = str(query)
+        prepared = SQL_EXECUTE.search(text)
+        match = SQL_LABEL.match(text)
+        if prepared:
+            label = f'EXECUTE {prepared.group(1)}'
+        else:
+            label = ' '.join(filter(None, (match.group(1).upper(), match.group(2)))) if match else 'SQL'
+        if cacheable and len(_labels) < 10000:
+            _labels[query] = label
+    return label
+
+
+_cursor_class = None
+
+
+def cursor_class():
+    """Класс курсора с замером запросов; создаётся при первом соединении вместе с импортом psycopg2"""
+    global _cursor_class
+    if _cursor_class is not None:
+        return _cursor_class
+
+    import psycopg2.extensions
+
+    class InstrumentedCursor(psycopg2.extensions.cursor):
+        """Курсор, записывающий время каждого запроса в текущий span"""
+
+        def execute(self, query, vars=None):
+            span = current_span.get()
+            if span is None:
+                return super().execute(query, vars)
+            started = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                span.child('sql', sql_label(query), time.perf_counter() - started)
+
+        def executemany(self, query, vars_list):
+            span = current_span.get()
+            if span is None:
+                return super().executemany(query, vars_list)
+            started = time.perf_counter()
+            try:
+                return super().executemany(query, vars_list)
+            finally:
+                span.child('sql', sql_label(query), time.perf_counter() - started)
+
+    _cursor_class = InstrumentedCursor
+    return _cursor_class
+
+
+def __getattr__(name: str):
+    # from instrumentation import InstrumentedCursor по-прежнему работает
+    if name == 'InstrumentedCursor':
+        return cursor_class()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def record_call(method: str, seconds: float):
+    """Вызов Bot API в текущем span (вызывается из TelegramClient)"""
+    span = current_span.get()
+    if span is not None:
+        span.child('telegram', method, seconds)
+
+
+class Metrics:
+    """Счётчики по (функция, span) с периодическим сбросом приращений в metrics_counters
+
+    Экземпляры облачной функции живут независимо, поэтому общая картина
+    собирается в БД: раз в flush_interval секунд одним INSERT ... ON CONFLICT
+    прибавляются накопленные приращения.
+    """
+
+    def __init__(self, flush_interval: float = 10):
+        self.flush_interval = flush_interval
+        self._deltas = {}
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _add(self, key: tuple, value: float):
+        self._deltas[key] = self._deltas.get(key, 0) + value
+
+    def observe(self, span: Span):
+        base = (span.function, span.name)
+        for bound in BUCKETS:
+            if span.seconds <= bound:
+                bucket = str(bound)
+                break
+        else:
+            bucket = '+Inf'
+
+        with self._lock:
+            self._add(base + ('updates_total',), 1)
+            if span.error:
+                self._add(base + ('errors_total',), 1)
+            self._add(base + ('duration_seconds_sum',), span.seconds)
+            self._add(base + (f'duration_seconds_bucket:{bucket}',), 1)
+            self._add(base + ('db_round_trips_total',), span.db_count)
+            self._add(base + ('db_seconds_total',), span.db_time)
+            self._add(base + ('telegram_calls_total',), span.tg_count)
+            self._add(base + ('telegram_seconds_total',), span.tg_time)
+
+    def due(self) -> bool:
+        """Пора ли сбрасывать: так вызывающий знает, нужно ли соединение с основным сервером"""
+        with self._lock:
+            return bool(self._deltas) and time.monotonic() - self._flushed_at >= self.flush_interval
+
+    def flush(self, cursor, force: bool = False) -> int:
+        """Сброс приращений в БД, если пришло время; возвращает число записанных ключей"""
+        import psycopg2
+
+        with self._lock:
+            if not self._deltas or (not force and time.monotonic() - self._flushed_at < self.flush_interval):
+                return 0
+            deltas, self._deltas = self._deltas, {}
+            self._flushed_at = time.monotonic()
+
+        # Единый порядок ключей: параллельные экземпляры не взаимоблокируются
+        keys = sorted(deltas)
+        try:
+            cursor.execute("""
+                INSERT INTO metrics_counters (function, span, metric, value)
+                SELECT * FROM unnest(%s::text[], %s::text[], %s::text[], %s::float8[])
+                ON CONFLICT (function, span, metric)
+                DO UPDATE SET value = metrics_counters.value + EXCLUDED.value,
+                              updated_at = CURRENT_TIMESTAMP
+            """, ([k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys],
+                  [deltas[k] for k in keys]))
+        except psycopg2.Error as e:
+            # Метрики не должны ронять обработку; приращения вернутся в следующий сброс
+            with self._lock:
+                for key, value in deltas.items():
+                    self._add(key, value)
+            print(json.dumps({'metrics_flush_error': str(e)}), flush=True)
+            return 0
+        return len(keys)
+
+
+metrics = Metrics(float(os.environ.get('METRICS_FLUSH_SECONDS', '10')))
+
+SPAN_LOG = os.environ.get('SPAN_LOG', 'all')
+
+
+@contextmanager
+def span(name: str, function: str):
+    """Span обработки: время, SQL и вызовы Telegram; по завершении — строка JSON-лога"""
+    current = Span(name, function)
+    token = current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        # Место ошибки — самый глубокий кадр вне обёрток этого модуля
+        frames = [f for f in traceback.extract_tb(e.__traceback__) if f.filename != __file__]
+        current.error = {'type': type(e).__name__, 'message': str(e)[:500]}
+        if frames:
+            current.error['where'] = f'{os.path.basename(frames[-1].filename)}:{frames[-1].lineno}'
+        raise
+    finally:
+        current_span.reset(token)
+        current.seconds = time.perf_counter() - current.started
+        metrics.observe(current)
+        if SPAN_LOG == 'all' or (SPAN_LOG == 'errors' and current.error):
+            print(current.log_line(), flush=True)
+
+
+METRIC_HELP = {
+    'updates_total': ('counter', 'Обработанные апдейты и действия API'),
+    'errors_total': ('counter', 'Обработки, завершившиеся исключением'),
+    'duration_seconds': ('histogram', 'Длительность обработки'),
+    'db_round_trips_total': ('counter', 'Запросы к БД'),
+    'db_seconds_total': ('counter', 'Время в запросах к БД'),
+    'telegram_calls_total': ('counter', 'Вызовы Bot API'),
+    'telegram_seconds_total': ('counter', 'Время в вызовах Bot API')
+}
+
+
+def number(value) -> str:
+    """Значение метрики без потери точности: формат :g оставил бы 6 значащих цифр"""
+    return repr(float(value))
+
+
+def render_prometheus(rows: list, prefix: str = 'bot_') -> str:
+    """Текстовый формат Prometheus из строк (function, span, metric, value)"""
+    by_metric = {}
+    for function, span_name, metric, value in rows:
+        labels = f'function="{function}",span="{span_name}"'
+        if metric.startswith('duration_seconds_bucket:'):
+            by_metric.setdefault('duration_seconds', {}).setdefault(labels, {})[metric.split(':', 1)[1]] = value
+        elif metric == 'duration_seconds_sum':
+            by_metric.setdefault('duration_seconds', {}).setdefault(labels, {})['sum'] = value
+        else:
+            by_metric.setdefault(metric, {})[labels] = value
+
+    lines = []
+    for metric, (kind, help_text) in METRIC_HELP.items():
+        series = by_metric.get(metric)
+        if not series:
+            continue
+        name = prefix + metric
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(series.items()):
+            if kind != 'histogram':
+                lines.append(f'{name}{{{labels}}} {number(value)}')
+                continue
+            cumulative = 0
+            for bound in [str(b) for b in BUCKETS] + ['+Inf']:
+                cumulative += value.get(bound, 0)
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {number(cumulative)}')
+            lines.append(f'{name}_sum{{{labels}}} {number(value.get("sum", 0))}')
+            lines.append(f'{name}_count{{{labels}}} {number(cumulative)}')
+    return '\n'.join(lines) + '\n'
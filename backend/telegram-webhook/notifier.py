@@ -0,0 +1,248 @@
+import argparse
+import html
+import json
+import os
+import select
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from rate_scheduler import BACKGROUND, get_scheduler
+from telegram_client import TelegramError
+
+CHANNEL = 'inbound_mail'
+
+
+class Notifier:
+    """Доставка новых кодов и писем в чаты по LISTEN/NOTIFY вместо опроса «Обновить входящие»
+
+    Уведомления, пришедшие за batch_window секунд, собираются в пачку: по ней
+    одна выборка из БД, отправка через планировщик с лимитами Telegram и одна
+    отметка notified_at. Письма, пропущенные пока воркер не работал, подбирает
+    догоняющий проход при каждом подключении; он же раз в catch_up_interval
+    секунд повторяет доставку, не прошедшую из-за ошибки Telegram.
+
+    Уведомление только о смене кода не связано со строкой inbound_messages:
+    неудачная отправка запоминается в failed_codes и повторяется тем же
+    проходом. Это состояние в памяти — после перезапуска воркера такие
+    уведомления не повторяются.
+    """
+
+    def __init__(self, dsn: str, schema: str, client, batch_window: float = 0.05,
+                 batch_size: int = 500, catch_up_minutes: int = 15, catch_up_interval: float = 30):
+        self.dsn = dsn
+        self.schema = schema
+        self.client = client
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.catch_up_minutes = catch_up_minutes
+        self.catch_up_interval = catch_up_interval
+        self.conn = None
+        self.next_catch_up = 0.0
+        self.failed_codes = set()
+
+    def connect(self):
+        """Отдельное соединение: LISTEN держит его всё время работы воркера"""
+        conn = psycopg2.connect(self.dsn, options=f'-c search_path={self.schema}')
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        self.conn = conn
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+            self.conn = None
+
+    def catch_up(self, min_age: float = 0) -> dict:
+        """Почты с письмами, о которых ещё не сообщили (простой воркера или ошибка отправки)
+
+        min_age отсекает только что пришедшие письма: их доставит уведомление.
+        К ним добавляются почты, уведомление о коде которых не удалось отправить.
+        """
+        now = datetime.now()
+        self.next_catch_up = time.monotonic() + self.catch_up_interval
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT DISTINCT email_id
+                FROM inbound_messages
+                WHERE notified_at IS NULL AND received_at > %s AND received_at <= %s
+            """, (now - timedelta(minutes=self.catch_up_minutes), now - timedelta(seconds=min_age)))
+            pending = {email_id: False for (email_id,) in cursor.fetchall()}
+        pending.update(dict.fromkeys(self.failed_codes, True))
+        self.failed_codes.clear()
+        return pending
+
+    def collect(self, timeout: float) -> dict:
+        """Ожидание первого уведомления и сбор пачки: email_id -> сменился ли код"""
+        pending = {}
+        deadline = None
+
+        while len(pending) < self.batch_size:
+            self.conn.poll()
+            while self.conn.notifies:
+                email_id, _, source = self.conn.notifies.pop(0).payload.partition(':')
+                email_id = int(email_id)
+                pending[email_id] = pending.get(email_id, False) or source == 'code'
+
+            if pending and deadline is None:
+                deadline = time.monotonic() + self.batch_window
+            wait = timeout if deadline is None else deadline - time.monotonic()
+            if wait <= 0 or not select.select([self.conn], [], [], wait)[0]:
+                break
+
+        return pending
+
+    def deliver(self, pending: dict) -> dict:
+        """Одна выборка на пачку, отправка через планировщик, одна отметка о доставке"""
+        started = time.monotonic()
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT t.id, u.telegram_id, t.email, t.received_code, t.expires_at,
+                       m.total, m.last_id, m.subject, m.link
+                FROM temp_emails t
+                JOIN users u ON u.id = t.user_id
+                LEFT JOIN LATERAL (
+                    SELECT COUNT(*) AS total, MAX(id) AS last_id,
+                           (array_agg(subject ORDER BY received_at DESC))[1] AS subject,
+                           (array_agg(link ORDER BY received_at DESC))[1] AS link
+                    FROM inbound_messages
+                    WHERE email_id = t.id AND notified_at IS NULL
+                ) m ON true
+                WHERE t.id = ANY(%s) AND u.notifications_enabled
+            """, (list(pending),))
+            rows = cursor.fetchall()
+
+        now = datetime.now()
+        futures = []
+        for email_id, chat_id, email, code, expires_at, total, last_id, subject, link in rows:
+            # Повтор уже доставленного: новых писем нет и код не менялся
+            if not total and not (pending[email_id] and code):
+                continue
+            payload = None
+            if expires_at > now:
+                payload = build_notification(email_id, chat_id, email, code, total, subject, link)
+            future = self.client.submit('sendMessage', payload, BACKGROUND) if payload else None
+            futures.append((email_id, last_id, future))
+
+        sent = 0
+        failed = 0
+        delivered = []
+        for email_id, last_id, future in futures:
+            if future is not None:
+                try:
+                    result = future.result()
+                except TelegramError:
+                    # Telegram недоступен: письма повторит периодический догоняющий проход,
+                    # а смену кода он найдёт только в failed_codes
+                    failed += 1
+                    if pending[email_id]:
+                        self.failed_codes.add(email_id)
+                    continue
+                if result.get('ok'):
+                    sent += 1
+                else:
+                    # Бот заблокирован или чат удалён — повтор не поможет
+                    failed += 1
+            if last_id is not None:
+                delivered.append((email_id, last_id))
+
+        if delivered:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE inbound_messages m
+                    SET notified_at = %s
+                    FROM unnest(%s::int[], %s::int[]) AS d(email_id, last_id)
+                    WHERE m.email_id = d.email_id AND m.id <= d.last_id AND m.notified_at IS NULL
+                """, (now, [email_id for email_id, _ in delivered], [last_id for _, last_id in delivered]))
+
+        return {
+            'emails': len(pending),
+            'sent': sent,
+            'failed': failed,
+            'ms': round((time.monotonic() - started) * 1000, 1)
+        }
+
+    def run(self, idle_timeout: float = 30):
+        """Основной цикл с переподключением; по пачке печатается строка JSON"""
+        while True:
+            try:
+                if self.conn is None or self.conn.closed:
+                    # Сначала LISTEN, затем догоняющий проход — так ничего не теряется
+                    self.connect()
+                    pending = self.catch_up()
+                elif time.monotonic() >= self.next_catch_up:
+                    pending = self.catch_up(min_age=self.catch_up_interval)
+                else:
+                    pending = self.collect(min(idle_timeout, self.next_catch_up - time.monotonic()))
+                if pending:
+                    print(json.dumps(self.deliver(pending)), flush=True)
+            except psycopg2.Error as e:
+                print(json.dumps({'error': str(e)}), flush=True)
+                self.close()
+                time.sleep(1)
+
+
+def build_notification(email_id: int, chat_id: int, email: str, code: str, total: int,
+                       subject: str, link: str) -> dict:
+    """Сообщение о новом коде или письме"""
+    if code:
+        text = (
+            f"🔑 <b>Новый код</b> для <code>{html.escape(email)}</code>\n\n"
+            f"<code>{html.escape(code)}</code>\n\n"
+            f"✅ Код можно скопировать нажатием"
+        )
+    else:
+        text = (
+            f"📬 <b>Новое письмо</b> для <code>{html.escape(email)}</code>\n\n"
+            f"✉️ {html.escape(subject or '(без темы)')}"
+        )
+        if total > 1:
+            text += f"\n📨 Новых писем: {total}"
+    if link:
+        text += f"\n🔗 <a href=\"{html.escape(link)}\">Ссылка подтверждения</a>"
+
+    return {
+        'chat_id': chat_id,
+        'text': text,
+        'parse_mode': 'HTML',
+        'reply_markup': {
+            'inline_keyboard': [[
+                {'text': '🔄 Обновить входящие', 'callback_data': f'refresh_{email_id}'}
+            ], [
+                {'text': '📜 История', 'callback_data': 'history'},
+                {'text': '➕ Создать новую', 'callback_data': 'create_email'}
+            ]]
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Мгновенная доставка кодов и писем в чаты')
+    parser.add_argument('--batch-window-ms', type=float, default=50,
+                        help='сколько ждать остальные уведомления пачки после первого')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--catch-up-minutes', type=int, default=15,
+                        help='за какой период подбирать пропущенные письма при подключении')
+    parser.add_argument('--catch-up-interval', type=float, default=30,
+                        help='как часто повторять доставку, не прошедшую из-за ошибки Telegram')
+    args = parser.parse_args()
+
+    notifier = Notifier(
+        os.environ.get('DATABASE_URL'),
+        os.environ.get('MAIN_DB_SCHEMA', 'public'),
+        get_scheduler(os.environ.get('TELEGRAM_BOT_TOKEN')),
+        batch_window=args.batch_window_ms / 1000,
+        batch_size=args.batch_size,
+        catch_up_minutes=args.catch_up_minutes,
+        catch_up_interval=args.catch_up_interval
+    )
+    notifier.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import select
+import time
+import psycopg2
+from psycopg2.extras import Json
+
+from rate_scheduler import INTERACTIVE, MESSAGE_METHODS, get_scheduler
+from telegram_client import TelegramError
+
+CHANNEL = 'outbox'
+
+
+class OutboxSender:
+    """Отправитель для вебхука: сообщения записываются в outbox вместо вызова Bot API
+
+    Запись идёт через то же соединение, что и остальные изменения апдейта, поэтому
+    в транзакции сообщение появляется в outbox только вместе с ними. Методы, которым
+    нужен немедленный ответ (answerCallbackQuery, getChatMember), идут в клиент.
+    """
+
+    def __init__(self, conn, client, priority: int = INTERACTIVE):
+        self.conn = conn
+        self.client = client
+        self.priority = priority
+
+    def call(self, method: str, payload: dict = None, deadline: float = None) -> dict:
+        return self.client.call(method, payload, deadline)
+
+    def send(self, method: str, payload: dict = None):
+        if method not in MESSAGE_METHODS:
+            self.client.send(method, payload)
+            return
+        enqueue(self.conn, method, payload or {}, self.priority)
+
+    def direct(self):
+        return self.client
+
+
+def enqueue(conn, method: str, payload: dict, priority: int = INTERACTIVE):
+    """Запись вызова в outbox; воркер будится уведомлением после COMMIT"""
+    chat_id = payload.get('chat_id')
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO outbox (method, payload, priority, chat_id) VALUES (%s, %s, %s, %s);
+            SELECT pg_notify(%s, '')
+        """, (method, Json(payload), priority, chat_id if isinstance(chat_id, int) else None, CHANNEL))
+
+
+def is_permanent(result: dict) -> bool:
+    """Ошибка, которую повтор не исправит: неверный запрос, бот заблокирован, чат удалён"""
+    code = result.get('error_code') or 0
+    return 400 <= code < 500 and code != 429
+
+
+class OutboxWorker:
+    """Отправка outbox пачками; несколько воркеров работают параллельно
+
+    Пачка захватывается одним UPDATE ... FOR UPDATE SKIP LOCKED: строки получают
+    аренду (available_at в будущем) и не держат блокировку во время HTTP-вызовов.
+    Если воркер упал, строки вернутся в очередь по истечении аренды. Из каждого
+    чата берётся только самая ранняя строка: следующая ждёт, пока предыдущая
+    арендована или ждёт повтора, — так порядок в чате сохраняется и при повторах,
+    и при нескольких воркерах. Аренда и задержки считаются по часам БД
+    (LOCALTIMESTAMP, как у DEFAULT столбцов), а не воркера. Отправка идёт
+    через RateScheduler, итог пачки записывается тремя запросами: удаление
+    отправленных, перенос повторов с экспоненциальной задержкой и перенос
+    окончательно неудачных в outbox_dead_letters.
+    """
+
+    def __init__(self, dsn: str, schema: str, sender, batch_size: int = 100, lease: float = 300,
+                 max_attempts: int = 5, poll_interval: float = 1.0):
+        self.dsn = dsn
+        self.schema = schema
+        self.sender = sender
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.conn = None
+
+    def connect(self):
+        conn = psycopg2.connect(self.dsn, options=f'-c search_path={self.schema}')
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        self.conn = conn
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+            self.conn = None
+
+    def claim(self) -> list:
+        """Захват под аренду готовых строк, перед которыми в их чате ничего не ждёт"""
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE outbox o
+                SET attempts = o.attempts + 1,
+                    available_at = LOCALTIMESTAMP + make_interval(secs => %s)
+                FROM (
+                    SELECT id
+                    FROM outbox q
+                    WHERE available_at <= LOCALTIMESTAMP
+                      AND NOT EXISTS (
+                          SELECT 1 FROM outbox e
+                          WHERE e.chat_id = q.chat_id AND e.id < q.id
+                      )
+                    ORDER BY priority, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ) claimed
+                WHERE o.id = claimed.id
+                RETURNING o.id, o.method, o.payload, o.priority, o.attempts
+            """, (self.lease, self.batch_size))
+            return sorted(cursor.fetchall(), key=lambda row: (row[3], row[0]))
+
+    def process_batch(self) -> dict:
+        rows = self.claim()
+        if not rows:
+            return None
+
+        futures = [(row, self.sender.submit(row[1], row[2], row[3])) for row in rows]
+        sent, retry, dead = [], [], []
+        for (outbox_id, method, payload, priority, attempts), future in futures:
+            try:
+                result = future.result()
+            except TelegramError as e:
+                error = str(e)
+            else:
+                if result.get('ok'):
+                    sent.append(outbox_id)
+                    continue
+                error = f"{result.get('error_code')}: {result.get('description')}"
+                if is_permanent(result):
+                    dead.append((outbox_id, error))
+                    continue
+
+            if attempts >= self.max_attempts:
+                dead.append((outbox_id, error))
+            else:
+                retry.append((outbox_id, min(300, 2 ** attempts), error))
+
+        with self.conn.cursor() as cursor:
+            if sent:
+                cursor.execute("DELETE FROM outbox WHERE id = ANY(%s)", (sent,))
+            if retry:
+                cursor.execute("""
+                    UPDATE outbox o
+                    SET available_at = LOCALTIMESTAMP + make_interval(secs => r.delay), last_error = r.error
+                    FROM unnest(%s::bigint[], %s::float8[], %s::text[]) AS r(id, delay, error)
+                    WHERE o.id = r.id
+                """, ([r[0] for r in retry], [r[1] for r in retry], [r[2] for r in retry]))
+            if dead:
+                cursor.execute("""
+                    WITH failed AS (
+                        DELETE FROM outbox o
+                        USING unnest(%s::bigint[], %s::text[]) AS d(id, error)
+                        WHERE o.id = d.id
+                        RETURNING o.id, o.method, o.payload, o.attempts, d.error, o.created_at
+                    )
+                    INSERT INTO outbox_dead_letters (id, method, payload, attempts, last_error, created_at)
+                    SELECT id, method, payload, attempts, error, created_at FROM failed
+                """, ([d[0] for d in dead], [d[1] for d in dead]))
+
+        return {'claimed': len(rows), 'sent': len(sent), 'retried': len(retry), 'dead': len(dead)}
+
+    def wait(self):
+        """Ожидание уведомления о новых строках; раз в poll_interval — проверка повторов"""
+        if not self.conn.notifies and select.select([self.conn], [], [], self.poll_interval)[0]:
+            self.conn.poll()
+        self.conn.notifies.clear()
+
+    def run(self):
+        """Основной цикл: пачки до опустошения очереди, затем ожидание; строка JSON на пачку"""
+        while True:
+            try:
+                if self.conn is None or self.conn.closed:
+                    self.connect()
+                started = time.monotonic()
+                report = self.process_batch()
+                if report is None:
+                    self.wait()
+                    continue
+                report['ms'] = round((time.monotonic() - started) * 1000, 1)
+                print(json.dumps(report), flush=True)
+            except psycopg2.Error as e:
+                print(json.dumps({'error': str(e)}), flush=True)
+                self.close()
+                time.sleep(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Отправка исходящих сообщений из outbox')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--lease', type=float, default=300,
+                        help='через сколько секунд строки упавшего воркера вернутся в очередь')
+    parser.add_argument('--max-attempts', type=int, default=5)
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    args = parser.parse_args()
+
+    worker = OutboxWorker(
+        os.environ.get('DATABASE_URL'),
+        os.environ.get('MAIN_DB_SCHEMA', 'public'),
+        get_scheduler(os.environ.get('TELEGRAM_BOT_TOKEN')),
+        batch_size=args.batch_size,
+        lease=args.lease,
+        max_attempts=args.max_attempts,
+        poll_interval=args.poll_interval
+    )
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from db_pool import get_pool
+from index import run_update
+from rate_scheduler import get_scheduler
+from telegram_client import TelegramError, get_client
+
+
+class ChatOrderedExecutor:
+    """Пул потоков: апдейты одного чата выполняются по очереди, разных чатов — параллельно"""
+
+    def __init__(self, workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update-worker')
+        self._queues = {}
+        self._pending = 0
+        self._cond = threading.Condition()
+
+    def submit(self, key, fn, *args):
+        with self._cond:
+            self._pending += 1
+            queue = self._queues.get(key)
+            # Ключ в словаре — у чата уже есть выполняющийся обработчик, он заберёт задачу
+            if queue is not None:
+                queue.append((fn, args))
+                return
+            self._queues[key] = deque([(fn, args)])
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self._cond:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                fn, args = queue.popleft()
+            try:
+                fn(*args)
+            finally:
+                with self._cond:
+                    self._pending -= 1
+                    self._cond.notify_all()
+
+    def pending(self) -> int:
+        return self._pending
+
+    def wait_below(self, limit: int):
+        """Обратное давление: не забирать новые апдейты, пока очередь не разгрузится"""
+        with self._cond:
+            while self._pending >= limit:
+                self._cond.wait()
+
+    def shutdown(self):
+        self.wait_below(1)
+        self._executor.shutdown()
+
+
+def chat_key(update: dict):
+    """Чат апдейта: по нему сохраняется порядок обработки"""
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update:
+        callback = update['callback_query']
+        return (callback.get('message') or {}).get('chat', {}).get('id', callback['from']['id'])
+    return None
+
+
+class PollingRunner:
+    """Получение апдейтов через getUpdates вместо вебхука
+
+    Один процесс держит один пул соединений и одну HTTP-сессию. Апдейты
+    обрабатываются той же run_update, что и в вебхуке, в пуле потоков
+    с сохранением порядка внутри чата.
+    """
+
+    def __init__(self, client, sender, pool, workers: int = 16, poll_timeout: int = 25,
+                 max_pending: int = 1000, use_outbox: bool = False):
+        self.client = client
+        self.sender = sender
+        self.pool = pool
+        self.poll_timeout = poll_timeout
+        self.max_pending = max_pending
+        self.use_outbox = use_outbox
+        self.executor = ChatOrderedExecutor(workers)
+        self.offset = None
+        self.stats = {'updates': 0, 'errors': 0, 'polls': 0}
+        self._lock = threading.Lock()
+
+    def fetch(self) -> list:
+        payload = {
+            'timeout': self.poll_timeout,
+            'allowed_updates': ['message', 'callback_query']
+        }
+        if self.offset is not None:
+            payload['offset'] = self.offset
+        data = self.client.call(
+            'getUpdates', payload,
+            deadline=self.poll_timeout + 15,
+            timeout=self.poll_timeout + 10
+        )
+        if not data.get('ok'):
+            raise TelegramError(f"getUpdates: {data.get('description')}")
+        return data['result']
+
+    def process(self, update: dict):
+        try:
+            run_update(update, self.sender, self.pool, use_outbox=self.use_outbox)
+        except Exception as e:
+            with self._lock:
+                self.stats['errors'] += 1
+            print(json.dumps({'update_id': update.get('update_id'), 'error': str(e)}), flush=True)
+        else:
+            with self._lock:
+                self.stats['updates'] += 1
+
+    def poll_once(self) -> int:
+        self.executor.wait_below(self.max_pending)
+        updates = self.fetch()
+        self.stats['polls'] += 1
+        for update in updates:
+            # Следующий getUpdates с этим offset подтвердит получение у Telegram
+            self.offset = update['update_id'] + 1
+            key = chat_key(update)
+            if key is None:
+                continue
+            self.executor.submit(key, self.process, update)
+        return len(updates)
+
+    def run(self, report_interval: float = 60):
+        reported_at = time.monotonic()
+        reported_updates = 0
+        try:
+            while True:
+                try:
+                    self.poll_once()
+                except TelegramError as e:
+                    print(json.dumps({'error': str(e)}), flush=True)
+                    time.sleep(1)
+
+                now = time.monotonic()
+                if now - reported_at >= report_interval:
+                    with self._lock:
+                        report = dict(self.stats, pending=self.executor.pending())
+                    report['updates_per_sec'] = round(
+                        (report['updates'] - reported_updates) / (now - reported_at), 1)
+                    print(json.dumps(report), flush=True)
+                    reported_at, reported_updates = now, report['updates']
+        except KeyboardInterrupt:
+            self.executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Работа бота через long polling (getUpdates)')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--poll-timeout', type=int, default=25)
+    parser.add_argument('--max-pending', type=int, default=1000,
+                        help='сколько необработанных апдейтов допускать перед следующим getUpdates')
+    parser.add_argument('--delete-webhook', action='store_true',
+                        help='снять вебхук: пока он установлен, getUpdates недоступен')
+    args = parser.parse_args()
+
+    # Пул соединений под число обработчиков, если размер не задан явно
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.workers))
+    token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    client = get_client(token)
+    sender = get_scheduler(token) if os.environ.get('TELEGRAM_RATE_LIMIT', '1') == '1' else client
+
+    if args.delete_webhook:
+        client.call('deleteWebhook', {'drop_pending_updates': False})
+
+    runner = PollingRunner(
+        client,
+        sender,
+        get_pool(os.environ.get('DATABASE_URL'), os.environ.get('MAIN_DB_SCHEMA', 'public')),
+        workers=args.workers,
+        poll_timeout=args.poll_timeout,
+        max_pending=args.max_pending,
+        use_outbox=os.environ.get('TELEGRAM_OUTBOX', '0') == '1'
+    )
+    runner.run()
+
+
+if __name__ == '__main__':
+    main()
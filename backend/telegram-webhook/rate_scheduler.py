@@ -0,0 +1,295 @@
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from telegram_client import LatencyHistogram, TelegramClient, TelegramError, get_client
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = ('interactive', 'background')
+
+# Лимиты Telegram касаются сообщений в чат; остальные методы идут без очереди
+MESSAGE_METHODS = frozenset((
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendMediaGroup',
+    'copyMessage', 'forwardMessage', 'editMessageText'
+))
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ('method', 'payload', 'priority', 'future', 'queued_at', 'expires', 'context')
+
+    def __init__(self, method: str, payload: dict, priority: int, deadline: float = None):
+        self.method = method
+        self.payload = payload
+        self.priority = priority
+        self.future = Future()
+        self.queued_at = time.monotonic()
+        # Срок вызова вместе с ожиданием в очереди; None — срок клиента от начала HTTP-вызова
+        self.expires = self.queued_at + deadline if deadline is not None else None
+        # Вызов выполнится в другом потоке, но будет учтён в span вызывающего
+        self.context = contextvars.copy_context()
+
+
+class _Chat:
+    __slots__ = ('bucket', 'queues')
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.queues = tuple(deque() for _ in PRIORITY_NAMES)
+
+    def priority(self) -> int:
+        """Приоритет первой ожидающей отправки или None"""
+        for priority, queue in enumerate(self.queues):
+            if queue:
+                return priority
+        return None
+
+    def pop(self) -> _Job:
+        for queue in self.queues:
+            if queue:
+                return queue.popleft()
+        return None
+
+
+def chat_key(chat_id):
+    """Ключ чата для лимитов: "123" и 123 — один чат, @username остаётся строкой"""
+    if isinstance(chat_id, str):
+        try:
+            return int(chat_id)
+        except ValueError:
+            return chat_id
+    return chat_id
+
+
+class RateScheduler:
+    """Очередь исходящих сообщений с общим лимитом бота и лимитом каждого чата
+
+    Сообщение не отбрасывается, а ждёт своего токена: общего (около 30 в секунду
+    на бота) и чата (1 в секунду, в группах 20 в минуту). Из готовых к отправке
+    чатов первым обслуживается тот, где ждёт ответ пользователю, а не фоновое
+    уведомление; внутри чата порядок сообщений сохраняется. Сами HTTP-вызовы
+    выполняет собственный пул потоков, поэтому отправки в разные чаты идут
+    параллельно. Интерфейс тот же, что у TelegramClient.
+    """
+
+    def __init__(self, client: TelegramClient, global_rate: float = 30, global_burst: float = 1,
+                 chat_rate: float = 1, chat_burst: float = 1, group_rate: float = 20 / 60,
+                 workers: int = 16, max_idle_chats: int = 10000):
+        self.client = client
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_idle_chats = max_idle_chats
+
+        # Небольшой запас ведра: иначе за первую секунду уйдёт capacity + rate сообщений
+        self._global = TokenBucket(global_rate, global_burst, time.monotonic())
+        self._chats = {}
+        self._ready = []
+        self._delayed = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='telegram-send')
+
+        self._depth = [0] * len(PRIORITY_NAMES)
+        self._wait = [LatencyHistogram() for _ in PRIORITY_NAMES]
+        self._sent = 0
+        self._throttled = 0
+
+        threading.Thread(target=self._run, name='telegram-rate', daemon=True).start()
+
+    def submit(self, method: str, payload: dict = None, priority: int = INTERACTIVE,
+               deadline: float = None) -> Future:
+        """Постановка вызова в очередь; Future завершится ответом Bot API"""
+        payload = payload or {}
+        chat_id = chat_key(payload.get('chat_id'))
+        if method not in MESSAGE_METHODS or chat_id is None:
+            return self._executor.submit(contextvars.copy_context().run, self.client.call, method, payload,
+                                         deadline)
+
+        job = _Job(method, payload, priority, deadline)
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                if len(self._chats) >= self.max_idle_chats:
+                    self._prune(job.queued_at)
+                chat = self._chats[chat_id] = _Chat(self._bucket_for(chat_id, job.queued_at))
+
+            current = chat.priority()
+            chat.queues[priority].append(job)
+            self._depth[priority] += 1
+            # Чат уже в очереди с тем же или более высоким приоритетом — запись не нужна
+            if current is None or priority < current:
+                heapq.heappush(self._ready, (priority, next(self._seq), chat_id))
+                self._cond.notify()
+        return job.future
+
+    def call(self, method: str, payload: dict = None, deadline: float = None,
+             priority: int = INTERACTIVE) -> dict:
+        if method not in MESSAGE_METHODS:
+            return self.client.call(method, payload, deadline)
+        if deadline is None:
+            deadline = self.client.deadline
+        future = self.submit(method, payload, priority, deadline)
+        try:
+            return future.result(timeout=deadline)
+        except FutureTimeout:
+            # Ещё в очереди — вызов снимается и не будет отправлен
+            future.cancel()
+            raise TelegramError(f'{method}: deadline exceeded in rate limit queue')
+
+    def send(self, method: str, payload: dict = None, priority: int = INTERACTIVE):
+        """Вызов, результат которого вызывающему коду не нужен"""
+        self.call(method, payload, priority=priority)
+
+    def direct(self) -> 'RateScheduler':
+        return self
+
+    def _bucket_for(self, chat_id, now: float) -> TokenBucket:
+        # Отрицательный chat_id или @username — группа или канал, у них лимит строже
+        if isinstance(chat_id, str) or chat_id < 0:
+            return TokenBucket(self.group_rate, 1, now)
+        return TokenBucket(self.chat_rate, self.chat_burst, now)
+
+    def _prune(self, now: float):
+        """Забываем чаты без очереди с полным ведром: их лимит уже ничего не ограничивает"""
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if chat.priority() is None and chat.bucket.is_full(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    def _next_job(self):
+        """Следующая отправка или (None, сколько ждать); вызывается под self._cond"""
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, chat_id = heapq.heappop(self._delayed)
+            chat = self._chats.get(chat_id)
+            if chat is not None and chat.priority() is not None:
+                heapq.heappush(self._ready, (chat.priority(), next(self._seq), chat_id))
+
+        if self._ready:
+            global_wait = self._global.delay(now)
+            if global_wait > 0:
+                return None, global_wait
+
+        while self._ready:
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats.get(chat_id)
+            if chat is None or chat.priority() is None:
+                continue
+            chat_wait = chat.bucket.delay(now)
+            if chat_wait > 0:
+                heapq.heappush(self._delayed, (now + chat_wait, next(self._seq), chat_id))
+                continue
+
+            job = chat.pop()
+            self._depth[job.priority] -= 1
+            if not job.future.set_running_or_notify_cancel():
+                # Вызов снят по сроку ожидания: токены не тратятся
+                if chat.priority() is not None:
+                    heapq.heappush(self._ready, (chat.priority(), next(self._seq), chat_id))
+                continue
+            chat.bucket.take(now)
+            self._global.take(now)
+            if chat.priority() is not None:
+                heapq.heappush(self._delayed, (now + chat.bucket.delay(now), next(self._seq), chat_id))
+            return job, None
+
+        return None, (self._delayed[0][0] - now if self._delayed else None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job, wait = self._next_job()
+                if job is None:
+                    self._cond.wait(wait)
+                    continue
+            self._executor.submit(self._execute, job)
+
+    def _execute(self, job: _Job):
+        waited = time.monotonic() - job.queued_at
+        with self._cond:
+            self._wait[job.priority].observe(waited)
+            self._sent += 1
+            if waited > 0.05:
+                self._throttled += 1
+        try:
+            remaining = None
+            if job.expires is not None:
+                remaining = job.expires - time.monotonic()
+                if remaining <= 0:
+                    raise TelegramError(f'{job.method}: deadline exceeded in rate limit queue')
+            job.future.set_result(job.context.run(self.client.call, job.method, job.payload, remaining))
+        except Exception as e:
+            job.future.set_exception(e)
+
+    def stats(self) -> dict:
+        """Глубина очереди и время ожидания по приоритетам, плюс статистика клиента"""
+        with self._cond:
+            return {
+                'queue': {name: self._depth[i] for i, name in enumerate(PRIORITY_NAMES)},
+                'wait': {name: self._wait[i].snapshot() for i, name in enumerate(PRIORITY_NAMES)},
+                'sent': self._sent,
+                'throttled': self._throttled,
+                'chats': len(self._chats),
+                'client': self.client.stats()
+            }
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(token: str) -> RateScheduler:
+    """Планировщик уровня модуля для токена бота, переживает тёплые вызовы"""
+    scheduler = _schedulers.get(token)
+    if scheduler is not None:
+        return scheduler
+
+    with _schedulers_lock:
+        scheduler = _schedulers.get(token)
+        if scheduler is None:
+            scheduler = RateScheduler(
+                get_client(token),
+                global_rate=float(os.environ.get('TELEGRAM_GLOBAL_RATE', '30')),
+                chat_rate=float(os.environ.get('TELEGRAM_CHAT_RATE', '1')),
+                chat_burst=float(os.environ.get('TELEGRAM_CHAT_BURST', '1')),
+                group_rate=float(os.environ.get('TELEGRAM_GROUP_RATE', str(20 / 60))),
+                workers=int(os.environ.get('TELEGRAM_SEND_WORKERS', '16'))
+            )
+            _schedulers[token] = scheduler
+        return scheduler
@@ -0,0 +1,274 @@
+import argparse
+import html
+import json
+import math
+import os
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from rate_scheduler import BACKGROUND, get_scheduler
+from telegram_client import TelegramError
+
+
+class TimerWheel:
+    """Таймеры в памяти: слот на каждые tick секунд, кольцо из slots слотов
+
+    Добавление и срабатывание — O(1) на таймер. Таймер дальше, чем на
+    slots * tick секунд, остаётся в своём слоте до нужного оборота.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.position = None
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _tick(self, moment: datetime) -> int:
+        return int(moment.timestamp() // self.tick)
+
+    def add(self, due: datetime, item):
+        tick = self._tick(due)
+        if self.position is not None and tick < self.position:
+            # Уже просрочен: сработает при ближайшем advance
+            tick = self.position
+        self.slots[tick % len(self.slots)].append((due, item))
+        self.size += 1
+
+    def advance(self, now: datetime) -> list:
+        """Таймеры со сроком не позже now, по порядку срабатывания"""
+        current = self._tick(now)
+        first = current - len(self.slots) + 1
+        if self.position is not None:
+            first = max(first, self.position)
+        fired = []
+        # За один вызов достаточно пройти кольцо один раз
+        for tick in range(first, current + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            waiting = [entry for entry in slot if entry[0] > now]
+            fired += [entry for entry in slot if entry[0] <= now]
+            slot[:] = waiting
+        self.position = current
+        self.size -= len(fired)
+        fired.sort(key=lambda entry: entry[0])
+        return [item for _, item in fired]
+
+
+class ReminderScheduler:
+    """Напоминания «почта удалится через 2 минуты» владельцам с reminder_enabled
+
+    Раз в window секунд почты, которым пора напомнить в ближайшее окно,
+    читаются пачками по частичному индексу idx_temp_emails_expires_at в порядке
+    expires_at и раскладываются по TimerWheel; между загрузками БД не
+    опрашивается. Перед отправкой строки захватываются одним UPDATE с условием
+    reminded_at IS NULL: сообщение уходит только по строкам, которые вернул
+    UPDATE, поэтому несколько экземпляров не отправят напоминание дважды.
+    """
+
+    def __init__(self, dsn: str, schema: str, client, lead: float = 120, window: float = 60,
+                 batch_size: int = 500, min_left: float = 30, tick: float = 1.0):
+        self.dsn = dsn
+        self.schema = schema
+        self.client = client
+        self.lead = timedelta(seconds=lead)
+        self.window = timedelta(seconds=window)
+        self.batch_size = batch_size
+        self.min_left = timedelta(seconds=min_left)
+        self.wheel = TimerWheel(tick, slots=max(2, math.ceil((lead + window) / tick) + 1))
+        self.loaded_until = None
+        self.next_load = None
+        self.conn = None
+        self.queries = 0
+
+    def connect(self):
+        conn = psycopg2.connect(self.dsn, options=f'-c search_path={self.schema}')
+        conn.autocommit = True
+        self.conn = conn
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+            self.conn = None
+
+    def load(self, now: datetime) -> int:
+        """Почты, истекающие до now + lead + window, — в таймеры; возвращает их число
+
+        Keyset по (expires_at, id): следующая пачка начинается после последней
+        строки предыдущей, без OFFSET. Загрузка продолжается с loaded_until,
+        поэтому каждая строка читается один раз (новые почты живут 15 минут и
+        попадают в одно из следующих окон).
+        """
+        start = now + self.min_left
+        if self.loaded_until is not None and self.loaded_until > start:
+            start = self.loaded_until
+        until = now + self.lead + self.window
+        loaded = 0
+        after = (start, 0)
+        while True:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT t.id, t.created_at, t.expires_at
+                    FROM temp_emails t
+                    JOIN users u ON u.id = t.user_id
+                    WHERE NOT t.is_archived
+                      AND t.expires_at >= %s AND t.expires_at < %s
+                      AND (t.expires_at, t.id) > (%s, %s)
+                      AND t.reminded_at IS NULL
+                      AND u.reminder_enabled AND u.notifications_enabled
+                    ORDER BY t.expires_at, t.id
+                    LIMIT %s
+                """, (after[0], until, after[0], after[1], self.batch_size))
+                rows = cursor.fetchall()
+            self.queries += 1
+            for email_id, created_at, expires_at in rows:
+                self.wheel.add(expires_at - self.lead, (email_id, created_at))
+            loaded += len(rows)
+            if len(rows) < self.batch_size:
+                break
+            after = (rows[-1][2], rows[-1][0])
+        self.loaded_until = until
+        return loaded
+
+    def claim(self, due: list, now: datetime) -> list:
+        """Отметка reminded_at; возвращаются только строки, захваченные этим экземпляром
+
+        Почту, которую успели архивировать, у которой владелец выключил
+        напоминания или до удаления которой осталось меньше min_left, не трогаем.
+        """
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE temp_emails t
+                SET reminded_at = %s
+                FROM unnest(%s::int[], %s::timestamp[]) AS d(id, created_at), users u
+                WHERE t.id = d.id AND t.created_at = d.created_at
+                  AND t.reminded_at IS NULL AND NOT t.is_archived AND t.expires_at >= %s
+                  AND u.id = t.user_id AND u.reminder_enabled AND u.notifications_enabled
+                RETURNING t.id, u.telegram_id, t.email, t.expires_at
+            """, (now, [email_id for email_id, _ in due], [created_at for _, created_at in due],
+                  now + self.min_left))
+            rows = cursor.fetchall()
+        self.queries += 1
+        return rows
+
+    def send(self, rows: list, now: datetime) -> dict:
+        futures = [self.client.submit('sendMessage', build_reminder(email_id, chat_id, email, expires_at - now),
+                                      BACKGROUND)
+                   for email_id, chat_id, email, expires_at in rows]
+        sent = 0
+        failed = 0
+        for future in futures:
+            try:
+                result = future.result()
+            except TelegramError:
+                # Строка уже отмечена: напоминание не повторяется (не больше одного раза)
+                failed += 1
+                continue
+            if result.get('ok'):
+                sent += 1
+            else:
+                failed += 1
+        return {'sent': sent, 'failed': failed}
+
+    def step(self, now: datetime = None):
+        """Один тик: загрузка окна, если пора, и напоминания, срок которых наступил
+
+        Возвращает отчёт или None, если ничего не происходило.
+        """
+        now = now or datetime.now()
+        report = {}
+        if self.next_load is None or now >= self.next_load:
+            report['loaded'] = self.load(now)
+            report['scheduled'] = len(self.wheel)
+            self.next_load = now + self.window
+
+        due = self.wheel.advance(now)
+        if due:
+            started = time.monotonic()
+            rows = self.claim(due, now)
+            report.update(due=len(due), claimed=len(rows), **self.send(rows, now))
+            report['ms'] = round((time.monotonic() - started) * 1000, 1)
+        return report or None
+
+    def run(self):
+        """Основной цикл с переподключением; по каждому событию печатается строка JSON"""
+        while True:
+            try:
+                if self.conn is None or self.conn.closed:
+                    self.connect()
+                    # Таймеры могли устареть: окно перечитывается заново
+                    self.loaded_until = None
+                    self.next_load = None
+                    self.wheel = TimerWheel(self.wheel.tick, len(self.wheel.slots))
+                report = self.step()
+                if report:
+                    print(json.dumps(report), flush=True)
+            except psycopg2.Error as e:
+                print(json.dumps({'error': str(e)}), flush=True)
+                self.close()
+                time.sleep(1)
+                continue
+            time.sleep(self.wheel.tick - time.time() % self.wheel.tick)
+
+
+def plural_minutes(minutes: int) -> str:
+    if minutes % 10 == 1 and minutes % 100 != 11:
+        return f"{minutes} минуту"
+    if 2 <= minutes % 10 <= 4 and not 12 <= minutes % 100 <= 14:
+        return f"{minutes} минуты"
+    return f"{minutes} минут"
+
+
+def build_reminder(email_id: int, chat_id: int, email: str, left: timedelta) -> dict:
+    """Напоминание о скором удалении почты"""
+    minutes = max(1, round(left.total_seconds() / 60))
+    return {
+        'chat_id': chat_id,
+        'text': (
+            f"⏰ Почта <code>{html.escape(email)}</code> удалится через {plural_minutes(minutes)}\n\n"
+            f"Если код ещё не пришёл — проверьте входящие"
+        ),
+        'parse_mode': 'HTML',
+        'reply_markup': {
+            'inline_keyboard': [[
+                {'text': '🔄 Обновить входящие', 'callback_data': f'refresh_{email_id}'}
+            ], [
+                {'text': '➕ Создать новую', 'callback_data': 'create_email'}
+            ]]
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Напоминания о скором удалении временных почт')
+    parser.add_argument('--lead-seconds', type=float, default=120,
+                        help='за сколько до удаления напоминать')
+    parser.add_argument('--window-seconds', type=float, default=60,
+                        help='как часто читать из БД следующее окно напоминаний')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--min-left-seconds', type=float, default=30,
+                        help='не напоминать, если до удаления осталось меньше')
+    args = parser.parse_args()
+
+    scheduler = ReminderScheduler(
+        os.environ.get('DATABASE_URL'),
+        os.environ.get('MAIN_DB_SCHEMA', 'public'),
+        get_scheduler(os.environ.get('TELEGRAM_BOT_TOKEN')),
+        lead=args.lead_seconds,
+        window=args.window_seconds,
+        batch_size=args.batch_size,
+        min_left=args.min_left_seconds
+    )
+    scheduler.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+import argparse
+import asyncio
+import os
+import re
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.header import decode_header, make_header
+from email.parser import BytesFeedParser
+
+import psycopg2
+
+from addresses import AddressFilter
+from code_extractor import extract
+from db_pool import ConnectionPool, PoolTimeout, pool_options, transaction
+
+ADDRESS = re.compile(rb'^(?:MAIL FROM|RCPT TO):\s*<([^>]*)>(.*)$', re.I)
+SIZE_PARAM = re.compile(rb'\bSIZE=(\d+)', re.I)
+
+MAX_BODY_CHARS = 100000
+
+
+class TemporaryFailure(Exception):
+    """Хранилище временно недоступно: клиенту отвечаем 451, и он повторит доставку"""
+
+
+class InboundMessage:
+    """Разобранное входящее письмо (только то, что нужно боту)"""
+
+    __slots__ = ('mail_from', 'subject', 'text_body', 'html_body', 'size', 'code', 'link')
+
+    def __init__(self, mail_from: str, subject: str, text_body: str, html_body: str, size: int,
+                 code: str = None, link: str = None):
+        self.mail_from = mail_from
+        self.subject = subject
+        self.text_body = text_body
+        self.html_body = html_body
+        self.size = size
+        self.code = code
+        self.link = link
+
+
+class PostgresMailStore:
+    """Получатели и письма в PostgreSQL; блокирующие вызовы уходят в пул потоков"""
+
+    def __init__(self, pool, addresses: AddressFilter = None):
+        self.pool = pool
+        self.addresses = addresses
+
+    def _lookup(self, address: str):
+        with self.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT id
+                FROM temp_emails
+                WHERE email = %s AND expires_at > %s AND NOT is_archived
+                ORDER BY created_at DESC
+                LIMIT 1
+            """, (address, datetime.now()))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def _store(self, email_ids: list, message: InboundMessage):
+        with self.pool.connection() as conn, transaction(conn), conn.cursor() as cursor:
+            cursor.executemany("""
+                INSERT INTO inbound_messages
+                (email_id, mail_from, subject, text_body, html_body, size_bytes, code, link)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, [(email_id, message.mail_from, message.subject, message.text_body,
+                   message.html_body, message.size, message.code, message.link)
+                  for email_id in email_ids])
+
+            if message.code:
+                cursor.execute("""
+                    UPDATE temp_emails
+                    SET received_code = %s
+                    WHERE id = ANY(%s)
+                """, (message.code, email_ids))
+
+    async def lookup(self, address: str):
+        loop = asyncio.get_running_loop()
+        try:
+            # Неизвестные адреса отсекаются фильтром Блума без запроса к БД
+            if self.addresses is not None and not self.addresses.contains(address):
+                if not await loop.run_in_executor(None, self.addresses.might_exist, address):
+                    return None
+            return await loop.run_in_executor(None, self._lookup, address)
+        except (psycopg2.Error, PoolTimeout) as e:
+            raise TemporaryFailure(str(e)) from e
+
+    async def store(self, email_ids: list, message: InboundMessage):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._store, email_ids, message)
+        except (psycopg2.Error, PoolTimeout) as e:
+            raise TemporaryFailure(str(e)) from e
+
+
+def decode_subject(value: str) -> str:
+    """Декодирование заголовка Subject (RFC 2047)"""
+    if not value:
+        return ''
+    try:
+        return str(make_header(decode_header(value)))
+    except (LookupError, ValueError):
+        return value
+
+
+def part_text(part) -> str:
+    payload = part.get_payload(decode=True) or b''
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, 'replace')[:MAX_BODY_CHARS]
+    except LookupError:
+        return payload.decode('utf-8', 'replace')[:MAX_BODY_CHARS]
+
+
+def parse_message(parser: BytesFeedParser, mail_from: str, size: int) -> InboundMessage:
+    """Извлечение темы и первых text/plain и text/html частей из разобранного потока"""
+    msg = parser.close()
+    text_body = None
+    html_body = None
+
+    for part in msg.walk():
+        if part.is_multipart() or part.get_content_disposition() == 'attachment':
+            continue
+        content_type = part.get_content_type()
+        if content_type == 'text/plain' and text_body is None:
+            text_body = part_text(part)
+        elif content_type == 'text/html' and html_body is None:
+            html_body = part_text(part)
+        if text_body is not None and html_body is not None:
+            break
+
+    subject = decode_subject(msg.get('subject', ''))[:1000]
+    sender = decode_subject(msg.get('from', '')) or mail_from
+    extraction = extract(subject, text_body, html_body, sender)
+
+    return InboundMessage(
+        mail_from=mail_from,
+        subject=subject,
+        text_body=text_body,
+        html_body=html_body,
+        size=size,
+        code=extraction.code,
+        link=extraction.link
+    )
+
+
+class SMTPSession:
+    """Одна SMTP-сессия: состояние конверта и разбор DATA по строкам"""
+
+    def __init__(self, server: 'InboundSMTPServer', reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.greeted = False
+        self.reset()
+
+    def reset(self):
+        self.mail_from = None
+        self.recipients = []
+
+    async def reply(self, *lines: str):
+        self.writer.write(b''.join(line.encode('ascii') + b'\r\n' for line in lines))
+        await self.writer.drain()
+
+    async def readline(self) -> bytes:
+        return await asyncio.wait_for(self.reader.readline(), self.server.timeout)
+
+    async def run(self):
+        await self.reply(f'220 {self.server.hostname} ESMTP ready')
+        while True:
+            line = await self.readline()
+            if not line:
+                return
+            command = line.rstrip(b'\r\n')
+            verb = command[:4].upper()
+
+            if verb in (b'EHLO', b'HELO'):
+                self.greeted = True
+                self.reset()
+                if verb == b'EHLO':
+                    await self.reply(
+                        f'250-{self.server.hostname}',
+                        f'250-SIZE {self.server.max_message_size}',
+                        '250-8BITMIME',
+                        '250 PIPELINING'
+                    )
+                else:
+                    await self.reply(f'250 {self.server.hostname}')
+            elif verb == b'MAIL':
+                await self.on_mail(command)
+            elif verb == b'RCPT':
+                await self.on_rcpt(command)
+            elif verb == b'DATA':
+                await self.on_data()
+            elif verb == b'RSET':
+                self.reset()
+                await self.reply('250 OK')
+            elif verb == b'NOOP':
+                await self.reply('250 OK')
+            elif verb == b'VRFY':
+                await self.reply('252 Cannot VRFY user')
+            elif verb == b'QUIT':
+                await self.reply('221 Bye')
+                return
+            else:
+                await self.reply('500 Command not recognized')
+
+    async def on_mail(self, command: bytes):
+        match = ADDRESS.match(command)
+        if not self.greeted:
+            await self.reply('503 Send EHLO first')
+        elif self.mail_from is not None:
+            await self.reply('503 Nested MAIL command')
+        elif not match:
+            await self.reply('501 Syntax: MAIL FROM:<address>')
+        else:
+            size = SIZE_PARAM.search(match.group(2))
+            if size and int(size.group(1)) > self.server.max_message_size:
+                await self.reply('552 Message size exceeds fixed limit')
+                return
+            self.mail_from = match.group(1).decode('utf-8', 'replace')
+            await self.reply('250 OK')
+
+    async def on_rcpt(self, command: bytes):
+        match = ADDRESS.match(command)
+        if self.mail_from is None:
+            await self.reply('503 Need MAIL before RCPT')
+        elif not match:
+            await self.reply('501 Syntax: RCPT TO:<address>')
+        elif len(self.recipients) >= self.server.max_recipients:
+            await self.reply('452 Too many recipients')
+        else:
+            address = match.group(1).decode('utf-8', 'replace').strip().lower()
+            try:
+                email_id = await self.server.store.lookup(address)
+            except TemporaryFailure:
+                await self.reply('451 4.3.0 Temporary failure')
+                return
+            if email_id is None:
+                await self.reply('550 5.1.1 Mailbox unavailable')
+                return
+            self.recipients.append(email_id)
+            await self.reply('250 OK')
+
+    async def on_data(self):
+        if not self.recipients:
+            await self.reply('503 Need RCPT before DATA')
+            return
+        await self.reply('354 End data with <CR><LF>.<CR><LF>')
+
+        # Письмо разбирается по мере чтения строк: сырое сообщение целиком не хранится
+        parser = BytesFeedParser()
+        size = 0
+        too_big = False
+        while True:
+            line = await self.readline()
+            if not line:
+                return
+            if line in (b'.\r\n', b'.\n'):
+                break
+            if line.startswith(b'.'):
+                line = line[1:]
+            size += len(line)
+            if size > self.server.max_message_size:
+                too_big = True
+            if not too_big:
+                parser.feed(line)
+
+        if too_big:
+            self.reset()
+            await self.reply('552 Message size exceeds fixed limit')
+            return
+
+        message = parse_message(parser, self.mail_from, size)
+        try:
+            await self.server.store.store(self.recipients, message)
+        except TemporaryFailure:
+            self.reset()
+            await self.reply('451 4.3.0 Temporary failure')
+            return
+        self.server.accepted += 1
+        self.reset()
+        await self.reply('250 OK: message accepted')
+
+
+class InboundSMTPServer:
+    """Асинхронный SMTP-сервер для адресов, выданных create_temp_email"""
+
+    def __init__(self, store, hostname: str = None, max_message_size: int = 10 * 1024 * 1024,
+                 max_recipients: int = 50, max_sessions: int = 5000, timeout: float = 300):
+        self.store = store
+        self.hostname = hostname or socket.getfqdn()
+        self.max_message_size = max_message_size
+        self.max_recipients = max_recipients
+        self.timeout = timeout
+        self.accepted = 0
+        self.sessions = 0
+        self._slots = asyncio.Semaphore(max_sessions)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self._slots.locked():
+            writer.write(b'421 Too many connections, try again later\r\n')
+            await writer.drain()
+            writer.close()
+            return
+
+        async with self._slots:
+            self.sessions += 1
+            try:
+                await SMTPSession(self, reader, writer).run()
+            except (asyncio.TimeoutError, ConnectionError, asyncio.LimitOverrunError, ValueError):
+                pass
+            finally:
+                self.sessions -= 1
+                writer.close()
+
+    async def start(self, host: str, port: int) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle_client, host, port, limit=64 * 1024)
+
+
+async def serve(host: str, port: int, hostname: str = None):
+    # Свой пул и пул потоков одного размера: каждый поток с запросом к БД получает
+    # соединение без ожидания, остальные сессии ждут в очереди пула потоков
+    db_threads = int(os.environ.get('SMTP_DB_THREADS', '20'))
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(db_threads, thread_name_prefix='smtp-db'))
+    pool = ConnectionPool(os.environ.get('DATABASE_URL'), os.environ.get('MAIN_DB_SCHEMA', 'public'),
+                          **dict(pool_options(), max_size=db_threads))
+    server = InboundSMTPServer(
+        PostgresMailStore(pool, AddressFilter(pool)),
+        hostname=hostname,
+        max_message_size=int(os.environ.get('SMTP_MAX_MESSAGE_SIZE', str(10 * 1024 * 1024))),
+        max_sessions=int(os.environ.get('SMTP_MAX_SESSIONS', '5000'))
+    )
+    listener = await server.start(host, port)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Приём входящей почты для временных адресов')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--hostname', default=None)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.hostname))
+
+
+if __name__ == '__main__':
+    main()
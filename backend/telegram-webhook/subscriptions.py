@@ -0,0 +1,44 @@
+import os
+from datetime import datetime, timedelta
+
+from cache import LRUCache
+
+
+class SubscriptionCache:
+    """Кэш результатов getChatMember: положительным доверяем дольше, отрицательные перепроверяем"""
+
+    def __init__(self, positive_ttl: timedelta, negative_ttl: timedelta, maxsize: int = 10000):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self._lru = LRUCache(maxsize)
+
+    def is_fresh(self, is_subscribed: bool, checked_at: datetime, now: datetime = None) -> bool:
+        if checked_at is None:
+            return False
+        ttl = self.positive_ttl if is_subscribed else self.negative_ttl
+        return (now or datetime.now()) - checked_at < ttl
+
+    def get(self, user_id: int):
+        """Свежий результат из памяти процесса или None"""
+        entry = self._lru.get(user_id)
+        if entry is None:
+            return None
+        is_subscribed, checked_at = entry
+        if not self.is_fresh(is_subscribed, checked_at):
+            return None
+        return is_subscribed
+
+    def last_known(self, user_id: int):
+        """Последний результат независимо от срока (для отказа Telegram)"""
+        entry = self._lru.get(user_id)
+        return entry[0] if entry else None
+
+    def put(self, user_id: int, is_subscribed: bool, checked_at: datetime):
+        self._lru.put(user_id, (is_subscribed, checked_at))
+
+
+subscription_cache = SubscriptionCache(
+    positive_ttl=timedelta(minutes=float(os.environ.get('SUBSCRIPTION_TTL_MINUTES', '30'))),
+    negative_ttl=timedelta(seconds=float(os.environ.get('SUBSCRIPTION_NEGATIVE_TTL_SECONDS', '30'))),
+    maxsize=int(os.environ.get('SUBSCRIPTION_CACHE_SIZE', '10000'))
+)
@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import re
+import time
+from datetime import date, datetime
+
+from psycopg2 import sql
+
+from addresses import prune_local_parts, refill_pool
+from db_pool import get_pool
+from updates import delete_old_updates
+
+PARTITION_NAME = re.compile(r'^temp_emails_(\d{4})_(\d{2})$')
+
+
+def archive_expired(cursor, batch_size: int, now: datetime = None) -> int:
+    """Архивирование одной пачки истёкших почт; возвращает число строк"""
+    # Частичный индекс idx_temp_emails_expires_at (WHERE NOT is_archived) отдаёт
+    # истёкшие строки по порядку, SKIP LOCKED позволяет запускать несколько сборщиков
+    cursor.execute("""
+        WITH expired AS (
+            SELECT id, created_at
+            FROM temp_emails
+            WHERE expires_at < %s AND NOT is_archived
+            ORDER BY expires_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE temp_emails t
+        SET is_archived = true
+        FROM expired
+        WHERE t.id = expired.id AND t.created_at = expired.created_at
+    """, (now or datetime.now(), batch_size))
+    return cursor.rowcount
+
+
+def ensure_partitions(cursor, months_ahead: int = 3) -> int:
+    """Создание месячных секций temp_emails на months_ahead месяцев вперёд"""
+    cursor.execute("""
+        SELECT create_temp_emails_partitions(
+            CURRENT_DATE, (CURRENT_DATE + make_interval(months => %s))::date
+        )
+    """, (months_ahead,))
+    return cursor.fetchone()[0]
+
+
+def drop_old_partitions(cursor, keep_months: int, today: date = None) -> list:
+    """Отключение и удаление месячных секций старше keep_months месяцев"""
+    today = today or date.today()
+    cutoff = today.year * 12 + today.month - 1 - keep_months
+
+    cursor.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'temp_emails'::regclass
+    """)
+
+    dropped = []
+    for (name,) in cursor.fetchall():
+        match = PARTITION_NAME.match(name)
+        if not match:
+            continue
+        year, month = int(match.group(1)), int(match.group(2))
+        if year * 12 + month - 1 >= cutoff:
+            continue
+        cursor.execute(sql.SQL("ALTER TABLE temp_emails DETACH PARTITION {}").format(sql.Identifier(name)))
+        cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+        dropped.append(name)
+    return dropped
+
+
+def sweep(cursor, batch_size: int = 1000, max_seconds: float = 50) -> dict:
+    """Архивирование истёкших почт пачками, пока они есть или не вышло время"""
+    started = time.monotonic()
+    now = datetime.now()
+    archived = 0
+    batches = 0
+
+    while time.monotonic() - started < max_seconds:
+        count = archive_expired(cursor, batch_size, now)
+        archived += count
+        batches += 1
+        if count < batch_size:
+            break
+
+    seconds = time.monotonic() - started
+    return {
+        'archived': archived,
+        'batches': batches,
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(archived / seconds, 1) if seconds > 0 else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Архивирование истёкших временных почт')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--max-seconds', type=float, default=50)
+    parser.add_argument('--interval', type=float, default=0,
+                        help='повторять каждые N секунд (0 — один проход)')
+    parser.add_argument('--months-ahead', type=int, default=3)
+    parser.add_argument('--keep-months', type=int, default=None,
+                        help='удалять секции старше N месяцев (по умолчанию не удаляются)')
+    parser.add_argument('--address-pool', type=int, default=1000,
+                        help='сколько свободных адресов держать в запасе')
+    parser.add_argument('--updates-ttl-hours', type=int, default=24,
+                        help='сколько хранить update_id обработанных апдейтов')
+    parser.add_argument('--local-parts-keep-hours', type=int, default=24,
+                        help='сколько держать занятыми локальные части истёкших адресов')
+    args = parser.parse_args()
+
+    pool = get_pool(os.environ.get('DATABASE_URL'), os.environ.get('MAIN_DB_SCHEMA', 'public'))
+
+    while True:
+        with pool.connection() as conn, conn.cursor() as cursor:
+            report = sweep(cursor, args.batch_size, args.max_seconds)
+            report['partitions_created'] = ensure_partitions(cursor, args.months_ahead)
+            report['addresses_reserved'] = refill_pool(cursor, args.address_pool)
+            report['local_parts_pruned'] = prune_local_parts(cursor, args.local_parts_keep_hours,
+                                                             args.batch_size)
+            report['updates_deleted'] = delete_old_updates(cursor, args.updates_ttl_hours)
+            if args.keep_months is not None:
+                report['partitions_dropped'] = drop_old_partitions(cursor, args.keep_months)
+        print(json.dumps(report), flush=True)
+
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
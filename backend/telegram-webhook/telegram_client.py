@@ -0,0 +1,329 @@
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from instrumentation import record_call
+
+API_URL = 'https://api.telegram.org'
+
+
+class TelegramError(Exception):
+    """Запрос к Bot API не удался: нет ответа до истечения дедлайна"""
+
+
+class TransportError(Exception):
+    """Ошибка соединения или таймаут HTTP-запроса (повторяется клиентом)"""
+
+
+class HttpResponse:
+    __slots__ = ('status_code', 'content')
+
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class HttpClientSession:
+    """Минимальный keep-alive клиент на http.client для POST с JSON
+
+    Импортируется за единицы миллисекунд против ~100 мс у requests, что заметно
+    на холодном старте функции. Соединения к одному хосту хранятся в стеке:
+    поток берёт свободное или открывает новое, после ответа возвращает.
+    """
+
+    def __init__(self, base_url: str, pool_size: int = 10):
+        import http.client
+
+        parts = urlsplit(base_url)
+        self._http = http.client
+        self._connection_class = (http.client.HTTPSConnection if parts.scheme == 'https'
+                                  else http.client.HTTPConnection)
+        self._host = parts.hostname
+        self._port = parts.port
+        self._pool_size = pool_size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self, timeout: float):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            return self._connection_class(self._host, self._port, timeout=timeout), False
+        conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self._pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def post(self, url: str, payload: dict, timeout: float) -> HttpResponse:
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        path = urlsplit(url).path
+        while True:
+            conn, reused = self._acquire(timeout)
+            try:
+                conn.request('POST', path, body, headers)
+                resp = conn.getresponse()
+                content = resp.read()
+            except (self._http.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                # Сервер закрыл простаивавшее соединение до запроса — сразу новое
+                if reused:
+                    continue
+                raise TransportError(str(e))
+            except (OSError, self._http.HTTPException) as e:
+                conn.close()
+                raise TransportError(str(e))
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return HttpResponse(resp.status, content)
+
+
+class RequestsSession:
+    """Тот же интерфейс поверх requests (TELEGRAM_HTTP=requests)"""
+
+    def __init__(self, base_url: str, pool_size: int = 10):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._errors = (requests.ConnectionError, requests.Timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def post(self, url: str, payload: dict, timeout: float):
+        try:
+            return self.session.post(url, json=payload, timeout=timeout)
+        except self._errors as e:
+            raise TransportError(str(e))
+
+
+TRANSPORTS = {'httpclient': HttpClientSession, 'requests': RequestsSession}
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными границами корзин (секунды)"""
+
+    BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(self.BUCKETS)
+        self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        buckets = {str(bound): n for bound, n in zip(self.BUCKETS, self.counts)}
+        buckets['+Inf'] = self.counts[-1]
+        return {'count': self.count, 'sum': round(self.total, 6), 'buckets': buckets}
+
+
+class TelegramClient:
+    """Клиент Bot API: одна keep-alive сессия, повторы при 429/5xx, дедлайн на вызов"""
+
+    def __init__(self, token: str, base_url: str = API_URL, timeout: float = 5,
+                 deadline: float = 10, max_retries: int = 3, pool_size: int = 10,
+                 transport: str = 'httpclient'):
+        self.base_url = f"{base_url}/bot{token}"
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.transport = transport
+        # HTTP-стек создаётся при первом вызове: ответ из тела вебхука его не требует
+        self._session = None
+
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._counters = {}
+
+    def call(self, method: str, payload: dict = None, deadline: float = None,
+             timeout: float = None) -> dict:
+        """Вызов метода Bot API; возвращает разобранный JSON-ответ Telegram
+
+        timeout переопределяет таймаут одного HTTP-запроса (нужно для long polling).
+        """
+        started = time.monotonic()
+        timeout = timeout if timeout is not None else self.timeout
+        expires = started + (deadline if deadline is not None else self.deadline)
+        url = f"{self.base_url}/{method}"
+        attempt = 0
+        last_error = None
+
+        try:
+            while True:
+                remaining = expires - time.monotonic()
+                if remaining <= 0:
+                    raise TelegramError(f'{method}: deadline exceeded ({last_error})')
+
+                data = None
+                delay = None
+                try:
+                    resp = self.session.post(url, payload or {}, min(timeout, remaining))
+                except TransportError as e:
+                    last_error = e
+                    delay = self._backoff(attempt)
+                else:
+                    try:
+                        data = resp.json()
+                    except ValueError:
+                        data = {'ok': False, 'error_code': resp.status_code, 'description': resp.text[:200]}
+
+                    if resp.status_code == 429:
+                        retry_after = (data.get('parameters') or {}).get('retry_after', 1)
+                        delay = float(retry_after)
+                        self._count(method, 'throttled')
+                    elif resp.status_code >= 500:
+                        delay = self._backoff(attempt)
+                    else:
+                        return data
+                    last_error = f"HTTP {resp.status_code}"
+
+                attempt += 1
+                if attempt > self.max_retries or time.monotonic() + delay >= expires:
+                    if data is not None:
+                        self._count(method, 'failed')
+                        return data
+                    raise TelegramError(f'{method}: {last_error}')
+
+                self._count(method, 'retries')
+                time.sleep(delay)
+        except TelegramError:
+            self._count(method, 'failed')
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self._observe(method, elapsed)
+            record_call(method, elapsed)
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = TRANSPORTS[self.transport](self.base_url, self.pool_size)
+        return self._session
+
+    def send(self, method: str, payload: dict = None):
+        """Вызов, результат которого вызывающему коду не нужен"""
+        self.call(method, payload)
+
+    def direct(self) -> 'TelegramClient':
+        """Отправитель без буферизации (для вызовов из фоновых потоков)"""
+        return self
+
+    def _backoff(self, attempt: int) -> float:
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(2.0, 0.1 * (2 ** attempt)))
+
+    def _observe(self, method: str, seconds: float):
+        with self._lock:
+            histogram = self._latency.get(method)
+            if histogram is None:
+                histogram = self._latency[method] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def _count(self, method: str, name: str):
+        with self._lock:
+            counters = self._counters.setdefault(method, {})
+            counters[name] = counters.get(name, 0) + 1
+
+    def stats(self) -> dict:
+        """Гистограммы задержек и счётчики повторов по методам"""
+        with self._lock:
+            return {
+                method: dict(histogram.snapshot(), **self._counters.get(method, {}))
+                for method, histogram in self._latency.items()
+            }
+
+
+class WebhookReply:
+    """Исходящие вызовы одного апдейта: последний возвращается в теле ответа вебхука
+
+    Telegram выполняет один метод Bot API, переданный в ответе на webhook-запрос.
+    Вызов через send() откладывается до следующего send(): предыдущий отправляется
+    клиентом, а последний забирается через reply(). Порядок вызовов сохраняется.
+    """
+
+    def __init__(self, client: TelegramClient):
+        self.client = client
+        self._pending = None
+
+    def call(self, method: str, payload: dict = None, deadline: float = None) -> dict:
+        """Синхронный вызов, когда нужен результат (например, getChatMember)"""
+        return self.client.call(method, payload, deadline)
+
+    def send(self, method: str, payload: dict = None):
+        if self._pending is not None:
+            self.client.send(*self._pending)
+        self._pending = (method, payload or {})
+
+    def direct(self) -> TelegramClient:
+        """Клиент, отправляющий сразу, минуя ответ вебхука"""
+        return self.client
+
+    def flush(self):
+        """Отправка отложенного вызова клиентом (когда ответ вебхука недоступен)"""
+        if self._pending is not None:
+            self.client.send(*self._pending)
+            self._pending = None
+
+    def reply(self) -> dict:
+        """Тело ответа вебхука с последним вызовом или None"""
+        if self._pending is None:
+            return None
+        method, payload = self._pending
+        self._pending = None
+        return dict(payload, method=method)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(token: str) -> TelegramClient:
+    """Клиент уровня модуля для токена бота, переживает тёплые вызовы"""
+    client = _clients.get(token)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        client = _clients.get(token)
+        if client is None:
+            client = TelegramClient(
+                token,
+                base_url=os.environ.get('TELEGRAM_API_URL', API_URL),
+                timeout=float(os.environ.get('TELEGRAM_TIMEOUT', '5')),
+                deadline=float(os.environ.get('TELEGRAM_DEADLINE', '10')),
+                max_retries=int(os.environ.get('TELEGRAM_MAX_RETRIES', '3')),
+                transport=os.environ.get('TELEGRAM_HTTP', 'httpclient')
+            )
+            _clients[token] = client
+        return client
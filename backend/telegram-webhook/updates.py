@@ -0,0 +1,62 @@
+import os
+import threading
+from collections import deque
+
+from db_pool import PreparedStatement
+
+
+class RecentUpdates:
+    """Кольцевой буфер последних update_id: повтор в тёплом экземпляре отсекается без БД"""
+
+    def __init__(self, maxsize: int = 4096):
+        self._order = deque(maxlen=maxsize)
+        self._ids = set()
+        self._lock = threading.Lock()
+
+    def add(self, update_id: int) -> bool:
+        """False, если update_id уже есть в буфере"""
+        with self._lock:
+            if update_id in self._ids:
+                return False
+            if len(self._order) == self._order.maxlen:
+                self._ids.discard(self._order[0])
+            self._order.append(update_id)
+            self._ids.add(update_id)
+            return True
+
+    def discard(self, update_id: int):
+        with self._lock:
+            if update_id in self._ids:
+                self._ids.discard(update_id)
+                self._order.remove(update_id)
+
+
+recent_updates = RecentUpdates(int(os.environ.get('UPDATE_RING_SIZE', '4096')))
+
+
+CLAIM_UPDATE = PreparedStatement('claim_update', """
+    INSERT INTO processed_updates (update_id)
+    VALUES (%s)
+    ON CONFLICT (update_id) DO NOTHING
+    RETURNING update_id
+""")
+
+
+def claim_update(cursor, update_id: int) -> bool:
+    """Отметка апдейта как обрабатываемого; False — его уже обработал другой вызов"""
+    CLAIM_UPDATE.execute(cursor, (update_id,))
+    return cursor.fetchone() is not None
+
+
+def release_update(cursor, update_id: int):
+    """Снятие отметки после ошибки, чтобы повторная доставка обработала апдейт"""
+    cursor.execute("DELETE FROM processed_updates WHERE update_id = %s", (update_id,))
+
+
+def delete_old_updates(cursor, ttl_hours: int = 24) -> int:
+    """Очистка отметок старше ttl_hours: Telegram так долго апдейты не повторяет"""
+    cursor.execute("""
+        DELETE FROM processed_updates
+        WHERE processed_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+    """, (ttl_hours,))
+    return cursor.rowcount
@@ -0,0 +1,103 @@
+import os
+from contextlib import nullcontext
+
+from cache import LRUCache
+from db_pool import PreparedStatement
+
+user_cache = LRUCache(int(os.environ.get('USER_CACHE_SIZE', '10000')))
+
+# CTE me(id) по Telegram-профилю (параметры: telegram_id, username, first_name).
+# INSERT/UPDATE выполняется, только если строки нет или профиль отличается;
+# иначе id берётся из существующей строки без записи в WAL
+USER_UPSERT = """
+    profile AS (
+        SELECT %s::bigint AS telegram_id, %s::varchar AS username, %s::varchar AS first_name
+    ), existing AS (
+        SELECT u.id, u.username, u.first_name
+        FROM users u, profile p
+        WHERE u.telegram_id = p.telegram_id
+    ), upsert AS (
+        INSERT INTO users (telegram_id, username, first_name, is_subscribed)
+        SELECT p.telegram_id, p.username, p.first_name, false
+        FROM profile p
+        WHERE NOT EXISTS (
+            SELECT 1 FROM existing e
+            WHERE e.username IS NOT DISTINCT FROM p.username
+              AND e.first_name IS NOT DISTINCT FROM p.first_name
+        )
+        ON CONFLICT (telegram_id)
+        DO UPDATE SET username = EXCLUDED.username,
+                      first_name = EXCLUDED.first_name,
+                      updated_at = CURRENT_TIMESTAMP
+        RETURNING id
+    ), me AS (
+        SELECT id FROM upsert
+        UNION ALL
+        SELECT id FROM existing
+        LIMIT 1
+    )
+"""
+
+
+def profile_fingerprint(username: str, first_name: str) -> int:
+    """Отпечаток профиля: меняется, только если изменились username или first_name"""
+    return hash((username, first_name))
+
+
+def profile(tg_user: dict) -> tuple:
+    """(telegram_id, username, first_name, отпечаток) из поля from апдейта"""
+    username = tg_user.get('username', '')
+    first_name = tg_user.get('first_name', '')
+    return tg_user['id'], username, first_name, profile_fingerprint(username, first_name)
+
+
+def cached_user_id(tg_user: dict):
+    """users.id из кэша, если профиль с тех пор не менялся"""
+    telegram_id, _, _, fingerprint = profile(tg_user)
+    cached = user_cache.get(telegram_id)
+    if cached and cached[1] == fingerprint:
+        return cached[0]
+    return None
+
+
+class UserStatement:
+    """Запрос от имени пользователя Telegram с CTE me(id) вместо отдельного resolve_user
+
+    Пользователь из кэша подставляется константой (этот вариант готовится через
+    PREPARE), иначе me — это upsert профиля в том же запросе. Первый столбец
+    результата должен быть me.id: по нему заполняется кэш.
+
+    Запрос, который только читает, может передать reads (db_pool.ReadRouter):
+    вариант с пользователем из кэша тогда выполняется на реплике. Upsert — запись,
+    он всегда идёт через переданный курсор основного сервера.
+    """
+
+    def __init__(self, name: str, body: str, ctes: str = ''):
+        extra = f", {ctes}" if ctes else ''
+        self.cached = PreparedStatement(name, f"WITH me AS (SELECT %s::integer AS id){extra} {body}")
+        self.upsert = f"WITH {USER_UPSERT}{extra} {body}"
+
+    def fetchall(self, cursor, tg_user: dict, params: tuple = (), reads=None) -> list:
+        user_db_id = cached_user_id(tg_user)
+        if user_db_id is not None:
+            with reads.cursor(cursor, tg_user['id']) if reads else nullcontext(cursor) as reader:
+                self.cached.execute(reader, (user_db_id,) + params)
+                return reader.fetchall()
+
+        telegram_id, username, first_name, fingerprint = profile(tg_user)
+        cursor.execute(self.upsert, (telegram_id, username, first_name) + params)
+        rows = cursor.fetchall()
+        if rows:
+            user_cache.put(telegram_id, (rows[0][0], fingerprint))
+        return rows
+
+
+RESOLVE_USER = UserStatement('resolve_user', "SELECT id FROM me")
+
+
+def resolve_user(cursor, tg_user: dict) -> int:
+    """users.id по Telegram-профилю; запись в users только при изменении профиля"""
+    user_db_id = cached_user_id(tg_user)
+    if user_db_id is not None:
+        return user_db_id
+    return RESOLVE_USER.fetchall(cursor, tg_user)[0][0]
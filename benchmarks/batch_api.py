@@ -0,0 +1,107 @@
+"""Пакетное действие batch против отдельных вызовов API telegram-bot.
+
+Запуск:
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/batch_api.py [--users 1000]
+
+Одни и те же операции (create_user, update_subscription, create_email,
+update_code на каждого пользователя) выполняются сначала отдельными вызовами
+handler, затем пакетами по --batch-size. Схема bench_<время> создаётся из
+db_migrations и удаляется после прогона, как в load_test.py.
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+import psycopg2
+
+from load_test import BOT_API_DIR, CountingCursor, create_schema, db_round_trips, drop_schema, load_module
+
+
+def operations(first_telegram_id: int, users: int) -> list:
+    ops = []
+    for telegram_id in range(first_telegram_id, first_telegram_id + users):
+        ops.append({'action': 'create_user', 'telegram_id': telegram_id, 'username': f'user{telegram_id}'})
+        ops.append({'action': 'update_subscription', 'telegram_id': telegram_id, 'is_subscribed': True})
+        ops.append({
+            'action': 'create_email',
+            'telegram_id': telegram_id,
+            'email': f'{telegram_id}@bench.local',
+            'country_code': 'RU',
+            'country_name': 'Россия',
+            'country_flag': '🇷🇺',
+            'service_name': 'gmail',
+            'service_emoji': '📧'
+        })
+    return ops
+
+
+def measure(fn) -> dict:
+    before = db_round_trips.value
+    started = time.perf_counter()
+    count = fn()
+    seconds = time.perf_counter() - started
+    return {
+        'operations': count,
+        'seconds': round(seconds, 3),
+        'operations_per_sec': round(count / seconds, 1),
+        'db_round_trips': db_round_trips.value - before
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    connect = psycopg2.connect
+    psycopg2.connect = lambda *a, **kw: connect(*a, **dict(kw, cursor_factory=CountingCursor))
+
+    schema = f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    create_schema(args.dsn, schema)
+    os.environ.update({'DATABASE_URL': args.dsn, 'MAIN_DB_SCHEMA': schema})
+    bot_api = load_module('bot_api_index', os.path.join(BOT_API_DIR, 'index.py'))
+
+    def call(body: dict) -> dict:
+        result = bot_api.handler({'httpMethod': 'POST', 'body': json.dumps(body)}, None)
+        if result['statusCode'] != 200:
+            raise RuntimeError(result['body'])
+        return json.loads(result['body'])
+
+    def codes(results: list) -> list:
+        return [
+            {'action': 'update_code', 'email_id': r['email']['id'], 'code': '123456'}
+            for r in results if 'email' in r
+        ]
+
+    def single() -> int:
+        ops = operations(1, args.users)
+        results = [call(op) for op in ops]
+        for op in codes(results):
+            call(op)
+        return len(ops) + args.users
+
+    def batched() -> int:
+        ops = operations(10 ** 9, args.users)
+        results = []
+        for start in range(0, len(ops), args.batch_size):
+            results += call({'action': 'batch', 'operations': ops[start:start + args.batch_size]})['results']
+        code_ops = codes(results)
+        for start in range(0, len(code_ops), args.batch_size):
+            call({'action': 'batch', 'operations': code_ops[start:start + args.batch_size]})
+        return len(ops) + len(code_ops)
+
+    try:
+        result = {'single': measure(single), 'batch': measure(batched)}
+    finally:
+        drop_schema(args.dsn, schema)
+
+    result['speedup'] = round(result['single']['seconds'] / result['batch']['seconds'], 1)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Задержка ответа на callback (answerCallbackQuery) до и после раннего подтверждения.
+
+Запуск: python benchmarks/callback_ack_latency.py [--iterations 50] [--telegram-ms 60] [--db-ms 8]
+
+Telegram и PostgreSQL заменены заглушками с фиксированной задержкой, поэтому
+сравниваются только порядок и параллельность вызовов в handle_callback.
+"""
+import argparse
+import itertools
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'telegram-webhook'))
+
+import index  # noqa: E402
+from background import TaskGroup  # noqa: E402
+
+
+class FakeClient:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.started = None
+        self.ack_at = None
+        self._lock = threading.Lock()
+
+    def call(self, method, payload=None, deadline=None):
+        time.sleep(self.latency)
+        if method == 'answerCallbackQuery':
+            with self._lock:
+                self.ack_at = time.perf_counter()
+        if method == 'getChatMember':
+            return {'ok': True, 'result': {'status': 'member'}}
+        return {'ok': True, 'result': {}}
+
+    def send(self, method, payload=None):
+        self.call(method, payload)
+
+    def direct(self):
+        return self
+
+
+class FakeConnection:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self._lock = threading.Lock()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeCursor:
+    def __init__(self, connection: FakeConnection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.query = query
+        with self.connection._lock:
+            time.sleep(self.connection.latency)
+
+    def fetchone(self):
+        if 'subscription_checked_at' in self.query:
+            return None
+        return (1,)
+
+    def fetchall(self):
+        # Создание почты — один запрос, возвращающий (me.id, id, email)
+        if 'INSERT INTO temp_emails' in self.query:
+            return [(1, 1, 'bench@bench.local')]
+        return []
+
+
+FLOWS = ['create_email', 'country_RU', 'service_RU_gmail']
+
+# Уникальные пользователи: кэш подписки не должен влиять на сравнение режимов
+_user_ids = itertools.count(1)
+
+
+def run(early_ack: bool, iterations: int, telegram_latency: float, db_latency: float) -> dict:
+    ack, total = {flow: [] for flow in FLOWS}, {flow: [] for flow in FLOWS}
+
+    for i in range(iterations):
+        for flow in FLOWS:
+            client = FakeClient(telegram_latency)
+            cursor = FakeConnection(db_latency).cursor()
+            callback = {
+                'id': str(i),
+                'data': flow,
+                'from': {'id': next(_user_ids)},
+                'message': {'chat': {'id': 1}}
+            }
+
+            tasks = TaskGroup(concurrent=early_ack)
+            started = time.perf_counter()
+            try:
+                index.handle_callback(callback, client, cursor, tasks)
+            finally:
+                tasks.wait()
+            finished = time.perf_counter()
+
+            ack[flow].append((client.ack_at - started) * 1000)
+            total[flow].append((finished - started) * 1000)
+
+    def summary(samples):
+        ordered = sorted(samples)
+        return {
+            'p50_ms': round(statistics.median(ordered), 2),
+            'p95_ms': round(ordered[int(len(ordered) * 0.95) - 1], 2)
+        }
+
+    return {
+        flow: {'ack': summary(ack[flow]), 'total': summary(total[flow])}
+        for flow in FLOWS
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--telegram-ms', type=float, default=60)
+    parser.add_argument('--db-ms', type=float, default=8)
+    args = parser.parse_args()
+
+    telegram_latency = args.telegram_ms / 1000
+    db_latency = args.db_ms / 1000
+
+    result = {
+        'before': run(False, args.iterations, telegram_latency, db_latency),
+        'after': run(True, args.iterations, telegram_latency, db_latency)
+    }
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Скорость и точность извлечения кодов подтверждения.
+
+Запуск: python benchmarks/code_extraction.py [--repeat 500] [--verbose]
+
+Корпус — benchmarks/data/verification_emails.json: письма почтовых сервисов
+из show_services и типичных сайтов на разных языках с ожидаемым кодом и ссылкой.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'telegram-webhook'))
+
+from code_extractor import extract  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'data', 'verification_emails.json')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=500)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    with open(CORPUS, encoding='utf-8') as f:
+        corpus = json.load(f)['messages']
+
+    code_hits = link_hits = 0
+    failures = []
+    for item in corpus:
+        result = extract(item['subject'], item['text'], item['html'], item['sender'])
+        code_ok = result.code == item['code']
+        link_ok = result.link == item['link']
+        code_hits += code_ok
+        link_hits += link_ok
+        if not (code_ok and link_ok):
+            failures.append({
+                'sender': item['sender'],
+                'expected': [item['code'], item['link']],
+                'got': [result.code, result.link],
+                'rule': result.rule
+            })
+
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        for item in corpus:
+            extract(item['subject'], item['text'], item['html'], item['sender'])
+    elapsed = time.perf_counter() - started
+    processed = args.repeat * len(corpus)
+
+    report = {
+        'messages': len(corpus),
+        'code_accuracy': round(code_hits / len(corpus), 4),
+        'link_accuracy': round(link_hits / len(corpus), 4),
+        'messages_per_sec': round(processed / elapsed, 1)
+    }
+    if args.verbose:
+        report['failures'] = failures
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Выгрузка истории: список словарей + json.dumps против потоковой HistoryExport.
+
+Запуск:
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/history_export.py [--rows 1000000]
+
+В схему bench_<время> (миграции из db_migrations) одному пользователю
+вставляется --rows почт, затем выгрузка выполняется старым способом
+(как get_history: fetchall, dict и isoformat() на строку, json.dumps)
+и через HistoryExport в NDJSON, CSV и NDJSON+gzip. Время меряется отдельным
+проходом без tracemalloc, пик памяти Python — вторым проходом с ним.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import psycopg2
+
+from load_test import BOT_API_DIR, create_schema, drop_schema
+
+sys.path.insert(0, BOT_API_DIR)
+
+from export import HistoryExport  # noqa: E402
+
+
+def seed(conn, rows: int) -> int:
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO users (telegram_id, username, first_name) VALUES (1, 'bench', 'Bench')
+            RETURNING id
+        """)
+        user_id = cursor.fetchone()[0]
+        # Построчный триггер статистики на миллионе строк одного пользователя
+        # занял бы минуты, а к выгрузке отношения не имеет
+        cursor.execute("ALTER TABLE temp_emails DISABLE TRIGGER trg_temp_emails_user_stats")
+        cursor.execute("""
+            INSERT INTO temp_emails
+            (user_id, email, country_code, country_name, country_flag, service_name,
+             service_emoji, received_code, created_at, expires_at)
+            SELECT %s, 'user' || i || '@bench.local', 'RU', 'Россия', '🇷🇺', 'gmail', '📧',
+                   CASE WHEN i %% 3 = 0 THEN lpad((i %% 1000000)::text, 6, '0') END,
+                   now() - i * INTERVAL '1 second', now() - i * INTERVAL '1 second' + INTERVAL '15 minutes'
+            FROM generate_series(1, %s) AS i
+        """, (user_id, rows))
+        cursor.execute("ANALYZE temp_emails")
+    return user_id
+
+
+def list_json(conn, user_id: int) -> int:
+    """Старый способ: вся история в памяти списком словарей"""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT id, email, country_code, country_name, country_flag,
+                   service_name, service_emoji, received_code,
+                   created_at, expires_at, is_archived
+            FROM temp_emails
+            WHERE user_id = %s
+            ORDER BY created_at DESC, id DESC
+        """, (user_id,))
+        emails = []
+        for row in cursor.fetchall():
+            emails.append({
+                'id': row[0],
+                'email': row[1],
+                'country_code': row[2],
+                'country_name': row[3],
+                'country_flag': row[4],
+                'service_name': row[5],
+                'service_emoji': row[6],
+                'received_code': row[7],
+                'created_at': row[8].isoformat() if row[8] else None,
+                'expires_at': row[9].isoformat() if row[9] else None,
+                'is_archived': row[10]
+            })
+    return len(json.dumps({'success': True, 'emails': emails}))
+
+
+def streamed(fmt: str, compress: bool):
+    def run(conn, user_id: int) -> int:
+        return sum(len(chunk) for chunk in HistoryExport(conn, user_id, fmt, compress))
+    return run
+
+
+VARIANTS = {
+    'list_json': list_json,
+    'ndjson': streamed('ndjson', False),
+    'csv': streamed('csv', False),
+    'ndjson_gzip': streamed('ndjson', True)
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--no-memory', action='store_true', help='без прохода с tracemalloc')
+    args = parser.parse_args()
+
+    schema = f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    create_schema(args.dsn, schema)
+    conn = psycopg2.connect(args.dsn, options=f'-c search_path={schema}')
+    conn.autocommit = True
+    result = {'rows': args.rows}
+    try:
+        started = time.perf_counter()
+        user_id = seed(conn, args.rows)
+        result['seed_seconds'] = round(time.perf_counter() - started, 1)
+
+        for name, run in VARIANTS.items():
+            started = time.perf_counter()
+            size = run(conn, user_id)
+            result[name] = {
+                'seconds': round(time.perf_counter() - started, 2),
+                'mb': round(size / 2 ** 20, 1)
+            }
+            if not args.no_memory:
+                tracemalloc.start()
+                run(conn, user_id)
+                result[name]['peak_python_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+                tracemalloc.stop()
+            print(json.dumps({name: result[name]}), flush=True)
+    finally:
+        conn.close()
+        drop_schema(args.dsn, schema)
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Бюджет холодного старта: время импорта index.py обеих функций.
+
+Запуск: python benchmarks/import_time.py [--runs 5] [--budget-ms 80]
+
+Каждый замер — новый процесс `python -X importtime -c "import index"` в
+каталоге функции; берётся медиана суммарного времени модуля index. Затем
+в новом процессе вебхук обрабатывает /help (ответ в теле вебхука) — так
+видно полный холодный путь без БД и сети. Для вебхука дополнительно
+проверяется, что psycopg2, requests и http.client не импортируются вместе
+с index. Код выхода 1, если бюджет превышен или тяжёлый модуль загружен.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FUNCTIONS = {
+    'telegram-webhook': os.path.join(ROOT, 'backend', 'telegram-webhook'),
+    'telegram-bot': os.path.join(ROOT, 'backend', 'telegram-bot')
+}
+LAZY_MODULES = ('psycopg2', 'requests', 'http.client')
+IMPORT_LINE = re.compile(r'import time:\s+\d+ \|\s+(\d+) \| index$')
+
+COLD_HELP = """
+import json, sys, time
+started = time.perf_counter()
+import index
+result = index.handler({'httpMethod': 'POST', 'body': json.dumps({
+    'update_id': 1,
+    'message': {'message_id': 1, 'text': '/help', 'chat': {'id': 1}, 'from': {'id': 1}}
+})}, None)
+elapsed = time.perf_counter() - started
+print(json.dumps({
+    'ms': round(elapsed * 1000, 1),
+    'status': result['statusCode'],
+    'reply_method': json.loads(result['body']).get('method'),
+    'loaded': [name for name in %r if name in sys.modules]
+}))
+""" % (LAZY_MODULES,)
+
+
+def import_ms(directory: str) -> float:
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import index'],
+        cwd=directory, env=env, capture_output=True, text=True, check=True
+    )
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line.strip())
+        if match:
+            return int(match.group(1)) / 1000
+    raise RuntimeError(result.stderr[-500:])
+
+
+def lazy_modules_loaded(directory: str) -> list:
+    result = subprocess.run(
+        [sys.executable, '-c',
+         f'import json, sys, index; print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))'],
+        cwd=directory, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout)
+
+
+def cold_help(directory: str) -> dict:
+    env = dict(os.environ, TELEGRAM_BOT_TOKEN='bench', SPAN_LOG='off')
+    result = subprocess.run([sys.executable, '-c', COLD_HELP], cwd=directory, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=80,
+                        help='допустимая медиана времени импорта index.py вебхука')
+    parser.add_argument('--bot-budget-ms', type=float, default=100,
+                        help='то же для telegram-bot (ему psycopg2 нужен всегда)')
+    args = parser.parse_args()
+
+    budgets = {'telegram-webhook': args.budget_ms, 'telegram-bot': args.bot_budget_ms}
+    report = {}
+    ok = True
+    for name, directory in FUNCTIONS.items():
+        samples = [import_ms(directory) for _ in range(args.runs)]
+        median = round(statistics.median(samples), 1)
+        report[name] = {'import_ms': median, 'budget_ms': budgets[name], 'samples': [round(s, 1) for s in samples]}
+        ok = ok and median <= budgets[name]
+
+    webhook = FUNCTIONS['telegram-webhook']
+    loaded = lazy_modules_loaded(webhook)
+    report['telegram-webhook']['heavy_modules_on_import'] = loaded
+    report['telegram-webhook']['cold_help'] = cold_help(webhook)
+    ok = ok and not loaded
+
+    report['ok'] = ok
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
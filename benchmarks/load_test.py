@@ -0,0 +1,413 @@
+"""Сквозной нагрузочный тест обоих handler с локальными Telegram и PostgreSQL.
+
+Запуск:
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/load_test.py \
+        [--users 200] [--concurrency 16] [--telegram-ms 30] [--output results.json] [--compare old.json]
+
+Миграции из db_migrations применяются к новой схеме bench_<время>, которая
+удаляется после прогона (--keep-schema оставляет её). Вместо api.telegram.org
+работает локальный HTTP-сервер с заданной задержкой, он же запоминает
+отправленные сообщения, чтобы сценарий мог нажать «Обновить входящие».
+
+Сначала каждый тип апдейта прогоняется отдельной фазой (так видно число
+запросов к БД и вызовов Telegram на апдейт), затем идёт смешанная нагрузка
+в --concurrency потоков. Результат печатается и сохраняется в JSON.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+WEBHOOK_DIR = os.path.join(ROOT, 'backend', 'telegram-webhook')
+BOT_API_DIR = os.path.join(ROOT, 'backend', 'telegram-bot')
+MIGRATIONS_DIR = os.path.join(ROOT, 'db_migrations')
+
+# Обе функции кладут db_pool.py, pagination.py и instrumentation.py рядом с index.py;
+# копии одинаковые, поэтому общий модуль из sys.modules подходит обеим. Каталог
+# telegram-bot идёт в конце: из него нужны только его собственные модули (export.py)
+sys.path.insert(0, WEBHOOK_DIR)
+sys.path.append(BOT_API_DIR)
+# Строка JSON-лога на каждый апдейт не нужна в выводе теста; SPAN_LOG=all включит её
+os.environ.setdefault('SPAN_LOG', 'errors')
+
+from instrumentation import InstrumentedCursor  # noqa: E402
+
+REFRESH = re.compile(r'refresh_(\d+)')
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def add(self, n: int = 1):
+        with self._lock:
+            self.value += n
+
+
+db_round_trips = Counter()
+
+
+class CountingCursor(InstrumentedCursor):
+    """Курсор, считающий обращения к БД (один execute — один round-trip)"""
+
+    def execute(self, query, vars=None):
+        db_round_trips.add()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        db_round_trips.add()
+        return super().executemany(query, vars_list)
+
+
+class FakeTelegram:
+    """Локальный Bot API: фиксированная задержка, подсчёт вызовов, последние сообщения чатов"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = Counter()
+        self.methods = {}
+        self.last_messages = {}
+        self._lock = threading.Lock()
+        self._message_ids = iter(range(1, 10 ** 9))
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело уходят разными write: без этого Nagle добавляет ~40 мс
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length') or 0)
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                body = json.dumps(fake.respond(method, payload)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def respond(self, method: str, payload: dict) -> dict:
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls.add()
+        with self._lock:
+            self.methods[method] = self.methods.get(method, 0) + 1
+        if method == 'getChatMember':
+            return {'ok': True, 'result': {'status': 'member', 'user': {'id': payload.get('user_id')}}}
+        if method == 'sendMessage':
+            self.remember(payload)
+            return {'ok': True, 'result': {'message_id': next(self._message_ids),
+                                           'chat': {'id': payload.get('chat_id')}}}
+        return {'ok': True, 'result': True}
+
+    def remember(self, payload: dict):
+        with self._lock:
+            self.last_messages[payload.get('chat_id')] = payload
+
+
+def load_module(name: str, path: str):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def create_schema(dsn: str, schema: str):
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f'CREATE SCHEMA {schema}')
+        cursor.execute(f'SET search_path TO {schema}')
+        for name in sorted(os.listdir(MIGRATIONS_DIR)):
+            if name.endswith('.sql'):
+                with open(os.path.join(MIGRATIONS_DIR, name), encoding='utf-8') as f:
+                    cursor.execute(f.read())
+    conn.close()
+
+
+def drop_schema(dsn: str, schema: str):
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP SCHEMA {schema} CASCADE')
+    conn.close()
+
+
+class Scenario:
+    """Апдейты одного пользователя: /start, создание почты, обновление, история, статистика"""
+
+    def __init__(self, telegram_id: int, update_ids):
+        self.telegram_id = telegram_id
+        self.update_ids = update_ids
+        self.email_id = None
+
+    def user(self) -> dict:
+        return {'id': self.telegram_id, 'first_name': 'Bench', 'username': f'bench{self.telegram_id}'}
+
+    def message(self, text: str) -> dict:
+        return {
+            'update_id': next(self.update_ids),
+            'message': {
+                'message_id': 1,
+                'from': self.user(),
+                'chat': {'id': self.telegram_id, 'type': 'private'},
+                'date': int(time.time()),
+                'text': text
+            }
+        }
+
+    def callback(self, data: str) -> dict:
+        return {
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.update_ids)),
+                'from': self.user(),
+                'message': {'message_id': 1, 'chat': {'id': self.telegram_id}},
+                'data': data
+            }
+        }
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.telegram = FakeTelegram(args.telegram_ms / 1000)
+        self.schema = f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.update_ids = iter(range(10 ** 6, 10 ** 12))
+        self.replies = Counter()
+
+        os.environ.update({
+            'TELEGRAM_BOT_TOKEN': 'bench',
+            'TELEGRAM_API_URL': self.telegram.url,
+            'MAIN_DB_SCHEMA': self.schema,
+            'DB_POOL_MAX_SIZE': str(args.concurrency + 4)
+        })
+
+        self.webhook = load_module('webhook_index', os.path.join(WEBHOOK_DIR, 'index.py'))
+        self.bot_api = load_module('bot_api_index', os.path.join(BOT_API_DIR, 'index.py'))
+
+    def webhook_update(self, update: dict) -> dict:
+        result = self.webhook.handler({'httpMethod': 'POST', 'body': json.dumps(update)}, None)
+        body = json.loads(result['body'])
+        if result['statusCode'] != 200:
+            raise RuntimeError(body)
+        # Вызов в теле ответа вебхука Telegram тоже выполняет — учитываем его
+        if body.get('method'):
+            self.replies.add()
+            if body['method'] == 'sendMessage':
+                self.telegram.remember(body)
+        return body
+
+    def api_action(self, body: dict) -> dict:
+        result = self.bot_api.handler({'httpMethod': 'POST', 'body': json.dumps(body)}, None)
+        if result['statusCode'] != 200:
+            raise RuntimeError(result['body'])
+        return json.loads(result['body'])
+
+    def remembered_email_id(self, scenario: Scenario):
+        payload = self.telegram.last_messages.get(scenario.telegram_id) or {}
+        match = REFRESH.search(json.dumps(payload.get('reply_markup') or {}))
+        if match:
+            scenario.email_id = int(match.group(1))
+
+    def steps(self, scenario: Scenario) -> dict:
+        """Все виды апдейтов: имя -> функция, выполняющая один апдейт"""
+        def create_email():
+            self.webhook_update(scenario.callback('create_email'))
+            self.webhook_update(scenario.callback('country_RU'))
+            self.webhook_update(scenario.callback('service_RU_gmail'))
+            self.remembered_email_id(scenario)
+
+        def refresh():
+            if scenario.email_id is None:
+                create_email()
+            self.webhook_update(scenario.callback(f'refresh_{scenario.email_id}'))
+
+        return {
+            'start': lambda: self.webhook_update(scenario.message('/start')),
+            'create_email': create_email,
+            'refresh': refresh,
+            'history': lambda: self.webhook_update(scenario.callback('history')),
+            'stats': lambda: self.webhook_update(scenario.callback('stats')),
+            'api_get_history': lambda: self.api_action(
+                {'action': 'get_history', 'telegram_id': scenario.telegram_id}),
+            'api_get_stats': lambda: self.api_action(
+                {'action': 'get_stats', 'telegram_id': scenario.telegram_id})
+        }
+
+    # create_email — три апдейта; веса ближе к реальному трафику бота
+    MIX = {
+        'start': 2,
+        'create_email': 3,
+        'refresh': 4,
+        'history': 2,
+        'stats': 1,
+        'api_get_history': 1,
+        'api_get_stats': 1
+    }
+    UPDATES_PER_STEP = {'create_email': 3}
+
+    def measure(self, jobs: list, concurrency: int) -> dict:
+        latencies = []
+        errors = Counter()
+        lock = threading.Lock()
+        updates = sum(self.UPDATES_PER_STEP.get(name, 1) for name, _ in jobs)
+        trips_before = db_round_trips.value
+        calls_before = self.telegram.calls.value + self.replies.value
+
+        def run(job):
+            name, fn = job
+            started = time.perf_counter()
+            try:
+                fn()
+            except Exception:
+                errors.add()
+                return
+            elapsed = (time.perf_counter() - started) * 1000 / self.UPDATES_PER_STEP.get(name, 1)
+            with lock:
+                latencies.append(elapsed)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(run, jobs))
+        seconds = time.perf_counter() - started
+
+        ordered = sorted(latencies) or [0.0]
+
+        def percentile(q):
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 2)
+
+        return {
+            'updates': updates,
+            'errors': errors.value,
+            'seconds': round(seconds, 3),
+            'updates_per_sec': round(updates / seconds, 1) if seconds else 0.0,
+            'p50_ms': round(statistics.median(ordered), 2),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'db_round_trips_per_update': round((db_round_trips.value - trips_before) / updates, 2),
+            'telegram_calls_per_update': round(
+                (self.telegram.calls.value + self.replies.value - calls_before) / updates, 2)
+        }
+
+    def run(self) -> dict:
+        args = self.args
+        random.seed(args.seed)
+        scenarios = [Scenario(7_000_000_000 + i, self.update_ids) for i in range(args.users)]
+
+        phases = {}
+        for name in self.MIX:
+            # Отдельная фаза в один поток: чистые счётчики на апдейт
+            jobs = [(name, self.steps(scenario)[name]) for scenario in scenarios]
+            phases[name] = self.measure(jobs, 1)
+
+        weighted = [name for name, weight in self.MIX.items() for _ in range(weight)]
+        mixed_jobs = []
+        for _ in range(args.users * args.rounds):
+            scenario = random.choice(scenarios)
+            name = random.choice(weighted)
+            mixed_jobs.append((name, self.steps(scenario)[name]))
+        mixed = self.measure(mixed_jobs, args.concurrency)
+
+        return {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'config': {
+                'users': args.users,
+                'rounds': args.rounds,
+                'concurrency': args.concurrency,
+                'telegram_ms': args.telegram_ms,
+                'env': {name: os.environ.get(name) for name in (
+                    'TELEGRAM_WEBHOOK_REPLY', 'TELEGRAM_EARLY_ACK', 'TELEGRAM_RATE_LIMIT',
+                    'TELEGRAM_OUTBOX', 'DB_POOL_MAX_SIZE', 'DATABASE_READ_URL')}
+            },
+            'phases': phases,
+            'mixed': mixed,
+            'telegram_methods': dict(self.telegram.methods)
+        }
+
+
+def compare(current: dict, previous: dict) -> dict:
+    """Изменение ключевых метрик относительно прошлого прогона, в процентах"""
+    keys = ('updates_per_sec', 'p50_ms', 'p95_ms', 'p99_ms',
+            'db_round_trips_per_update', 'telegram_calls_per_update')
+
+    def delta(new, old):
+        return {key: round((new[key] - old[key]) / old[key] * 100, 1) if old.get(key) else None
+                for key in keys}
+
+    result = {'mixed': delta(current['mixed'], previous['mixed'])}
+    for name, phase in current['phases'].items():
+        if name in previous.get('phases', {}):
+            result[name] = delta(phase, previous['phases'][name])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=5, help='апдейтов на пользователя в смешанной фазе')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--telegram-ms', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='куда сохранить JSON с результатом')
+    parser.add_argument('--compare', default=None, help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--keep-schema', action='store_true')
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error('нужен --dsn или DATABASE_URL локального PostgreSQL')
+
+    # Подсчёт round-trip: все соединения процесса получают считающий курсор
+    connect = psycopg2.connect
+    psycopg2.connect = lambda *a, **kw: connect(*a, **dict(kw, cursor_factory=CountingCursor))
+    os.environ['DATABASE_URL'] = args.dsn
+
+    test = LoadTest(args)
+    create_schema(args.dsn, test.schema)
+    try:
+        from addresses import refill_pool
+        with psycopg2.connect(args.dsn, options=f'-c search_path={test.schema}') as conn, \
+                conn.cursor() as cursor:
+            refill_pool(cursor, args.users * 2)
+        result = test.run()
+    finally:
+        if not args.keep_schema:
+            drop_schema(args.dsn, test.schema)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            result['compare_pct'] = compare(result, json.load(f))
+
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Соблюдение лимитов Telegram планировщиком исходящих сообщений.
+
+Запуск: python benchmarks/rate_scheduler.py [--notifications 300] [--chats 50] [--replies 30]
+
+Фоновые уведомления ставятся в очередь пачкой, затем во время их отправки
+приходят ответы пользователям. Фальшивый клиент записывает время каждого
+вызова: проверяется максимум сообщений за любое окно в 1 с (бот и чат)
+и время ответа пользователю на фоне очереди уведомлений.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'telegram-webhook'))
+
+from rate_scheduler import BACKGROUND, INTERACTIVE, RateScheduler  # noqa: E402
+
+
+class FakeClient:
+    deadline = 10
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def call(self, method, payload=None, deadline=None):
+        with self._lock:
+            self.sent.append((time.monotonic(), payload['chat_id']))
+        time.sleep(self.latency)
+        return {'ok': True}
+
+    def stats(self):
+        return {}
+
+
+def max_per_window(times: list, window: float = 1.0) -> int:
+    """Наибольшее число отправок в любом окне длиной window"""
+    times = sorted(times)
+    best = 0
+    start = 0
+    for end, moment in enumerate(times):
+        while moment - times[start] >= window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--notifications', type=int, default=300)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--replies', type=int, default=30)
+    parser.add_argument('--telegram-ms', type=float, default=60)
+    parser.add_argument('--global-rate', type=float, default=30)
+    args = parser.parse_args()
+
+    client = FakeClient(args.telegram_ms / 1000)
+    scheduler = RateScheduler(client, global_rate=args.global_rate)
+
+    started = time.monotonic()
+    futures = [
+        scheduler.submit('sendMessage', {'chat_id': i % args.chats + 1}, BACKGROUND)
+        for i in range(args.notifications)
+    ]
+
+    reply_waits = []
+    time.sleep(1.0)
+    for i in range(args.replies):
+        queued = time.monotonic()
+        scheduler.call('sendMessage', {'chat_id': 100000 + i}, priority=INTERACTIVE)
+        reply_waits.append((time.monotonic() - queued) * 1000)
+        time.sleep(0.05)
+
+    for future in futures:
+        future.result()
+    elapsed = time.monotonic() - started
+
+    by_chat = defaultdict(list)
+    for moment, chat_id in client.sent:
+        by_chat[chat_id].append(moment)
+
+    stats = scheduler.stats()
+    ordered = sorted(reply_waits)
+    print(json.dumps({
+        'messages': len(client.sent),
+        'seconds': round(elapsed, 2),
+        'messages_per_sec': round(len(client.sent) / elapsed, 1),
+        'max_global_per_sec': max_per_window([moment for moment, _ in client.sent]),
+        'max_chat_per_sec': max(max_per_window(times) for times in by_chat.values()),
+        'interactive_reply_ms': {
+            'p50': round(statistics.median(ordered), 1),
+            'max': round(ordered[-1], 1)
+        },
+        'background_wait_sum_sec': stats['wait']['background']['sum'],
+        'throttled': stats['throttled']
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Напоминания об удалении почты: ровно одно на почту при нескольких экземплярах.
+
+Запуск:
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/reminders.py [--emails 5000] [--instances 3]
+
+В схему bench_<время> (миграции из db_migrations) вставляются почты с
+expires_at в ближайшие --minutes минут; у части владельцев напоминания
+выключены, часть почт уже в архиве. Несколько ReminderScheduler с общим
+модельным временем делают step() одновременно, по секунде за шаг; Telegram
+заменён клиентом, который сразу отвечает ok. Проверяется, что каждая
+подходящая почта получила ровно одно напоминание, неподходящие — ни одного,
+и сколько запросов к БД понадобилось по сравнению с опросом раз в секунду.
+Код выхода 1, если есть пропуски или повторы.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from load_test import WEBHOOK_DIR, create_schema, drop_schema
+
+sys.path.insert(0, WEBHOOK_DIR)
+
+from reminders import ReminderScheduler  # noqa: E402
+
+
+class ImmediateClient:
+    """Вместо Telegram: запоминает напоминания и сразу отвечает ok"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def submit(self, method: str, payload: dict, priority: int) -> Future:
+        email_id = int(payload['reply_markup']['inline_keyboard'][0][0]['callback_data'].split('_')[1])
+        with self.lock:
+            self.sent.append((email_id, self.clock[0]))
+        future = Future()
+        future.set_result({'ok': True})
+        return future
+
+
+def seed(conn, emails: int, minutes: int, started: datetime) -> dict:
+    """Почты с expires_at в пределах minutes минут; id -> должно ли быть напоминание"""
+    with conn.cursor() as cursor:
+        # Каждый десятый пользователь выключил напоминания
+        cursor.execute("""
+            INSERT INTO users (telegram_id, username, first_name, reminder_enabled)
+            SELECT 9000000000 + i, 'bench' || i, 'Bench', i %% 10 <> 0
+            FROM generate_series(1, %s) AS i
+        """, (max(1, emails // 5),))
+        # Каждая двадцатая почта уже в архиве
+        cursor.execute("""
+            INSERT INTO temp_emails
+            (user_id, email, country_code, country_name, country_flag, service_name,
+             service_emoji, created_at, expires_at, is_archived)
+            SELECT u.id, 'r' || i || '@bench.local', 'RU', 'Россия', '🇷🇺', 'gmail', '📧',
+                   %s::timestamp, %s::timestamp + (i::bigint * %s / %s) * INTERVAL '1 millisecond', i %% 20 = 0
+            FROM generate_series(1, %s) AS i
+            JOIN users u ON u.telegram_id = 9000000000 + 1 + i %% %s
+        """, (started, started, minutes * 60_000, emails, emails, max(1, emails // 5)))
+        cursor.execute("ANALYZE temp_emails")
+        cursor.execute("""
+            SELECT t.id, t.expires_at, NOT t.is_archived AND u.reminder_enabled
+            FROM temp_emails t JOIN users u ON u.id = t.user_id
+        """)
+        return {email_id: (expires_at, eligible) for email_id, expires_at, eligible in cursor.fetchall()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--emails', type=int, default=5000)
+    parser.add_argument('--minutes', type=int, default=10, help='в какой промежуток истекают почты')
+    parser.add_argument('--instances', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error('нужен --dsn или DATABASE_URL локального PostgreSQL')
+
+    schema = f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    create_schema(args.dsn, schema)
+    try:
+        started = datetime.now().replace(microsecond=0)
+        with psycopg2.connect(args.dsn, options=f'-c search_path={schema}') as conn:
+            emails = seed(conn, args.emails, args.minutes, started)
+        conn.close()
+
+        clock = [started]
+        client = ImmediateClient(clock)
+        schedulers = [ReminderScheduler(args.dsn, schema, client, batch_size=args.batch_size)
+                      for _ in range(args.instances)]
+        for scheduler in schedulers:
+            scheduler.connect()
+
+        steps = args.minutes * 60 + 1
+        wall = time.perf_counter()
+        with ThreadPoolExecutor(args.instances) as executor:
+            for second in range(steps):
+                clock[0] = started + timedelta(seconds=second)
+                list(executor.map(lambda scheduler: scheduler.step(clock[0]), schedulers))
+        wall = time.perf_counter() - wall
+        queries = sum(scheduler.queries for scheduler in schedulers)
+        for scheduler in schedulers:
+            scheduler.close()
+    finally:
+        drop_schema(args.dsn, schema)
+
+    lead = schedulers[0].lead
+    min_left = schedulers[0].min_left
+    sent = Counter(email_id for email_id, _ in client.sent)
+    # Напоминать есть смысл, только если до удаления осталось не меньше min_left
+    expected = {email_id for email_id, (expires_at, eligible) in emails.items()
+                if eligible and expires_at >= started + min_left}
+    # Почты, срок напоминания которых наступил до запуска, напоминаются сразу — их не считаем
+    late = [(at - due).total_seconds() for email_id, at in client.sent
+            for due in [emails[email_id][0] - lead] if due >= started]
+
+    report = {
+        'emails': len(emails),
+        'instances': args.instances,
+        'simulated_seconds': steps,
+        'expected': len(expected),
+        'sent': len(client.sent),
+        'missed': len(expected - set(sent)),
+        'duplicates': sum(count - 1 for count in sent.values() if count > 1),
+        'unexpected': len(set(sent) - expected),
+        'max_late_seconds': max(late, default=0),
+        'db_queries': queries,
+        'db_queries_polling_every_second': steps * args.instances,
+        'wall_seconds': round(wall, 2)
+    }
+    report['ok'] = not (report['missed'] or report['duplicates'] or report['unexpected'])
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""Проверка числа обращений к БД на каждый сценарий вебхука и действие API.
+
+Запуск:
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/round_trips.py [--no-prepare]
+
+Схема bench_<время> создаётся из db_migrations, Telegram — локальный, как в
+load_test.py. Каждый сценарий выполняется дважды: первый раз без пользователя
+в кэше процесса (users.id находится upsert-CTE в запросе сценария) и с PREPARE
+на соединении, второй — тёплый, через EXECUTE. Для каждого раза число execute сравнивается с
+бюджетом; код выхода 1, если бюджет превышен хотя бы в одном сценарии.
+
+Бюджет апдейта вебхука — отметка processed_updates плюс не больше одного
+запроса самого сценария. Исключение — первая проверка подписки: чтение
+users до getChatMember и запись результата после него.
+"""
+import argparse
+import json
+import os
+import sys
+from argparse import Namespace
+
+# Сброс метрик раз в 10 секунд добавил бы случайный лишний запрос к апдейту
+os.environ.setdefault('METRICS_FLUSH_SECONDS', '86400')
+
+import psycopg2  # noqa: E402
+
+from load_test import CountingCursor, LoadTest, Scenario, create_schema, db_round_trips, drop_schema  # noqa: E402
+from users import user_cache  # noqa: E402
+
+# Сценарий: (бюджет холодного прогона, бюджет тёплого)
+WEBHOOK_BUDGETS = {
+    'start': (2, 1),
+    'stats_command': (2, 2),
+    'subscription_check': (3, 1),
+    'create_email': (2, 2),
+    'refresh': (2, 2),
+    'history': (2, 2),
+    'history_page': (2, 2),
+    'stats': (2, 2)
+}
+API_BUDGETS = {
+    'create_user': 1,
+    'update_subscription': 1,
+    'update_settings': 1,
+    'create_email': 1,
+    'update_code': 1,
+    'get_history': 1,
+    'get_history_page': 1,
+    'get_stats': 1,
+    'export_history': 1,
+    'batch': 2
+}
+
+
+def count(fn) -> int:
+    before = db_round_trips.value
+    fn()
+    return db_round_trips.value - before
+
+
+def webhook_cases(test: LoadTest, scenario: Scenario) -> dict:
+    def create_email():
+        test.webhook_update(scenario.callback('service_RU_gmail'))
+        test.remembered_email_id(scenario)
+
+    def history_page():
+        # Курсор далеко в будущем: вторая страница, запрос с условием по (created_at, id)
+        test.webhook_update(scenario.callback('history_n_' + test.webhook.encode_cursor(
+            test.webhook.datetime(2100, 1, 1), 1)))
+
+    return {
+        'start': lambda: test.webhook_update(scenario.message('/start')),
+        'stats_command': lambda: test.webhook_update(scenario.message('/stats')),
+        'subscription_check': lambda: test.webhook_update(scenario.callback('create_email')),
+        'create_email': create_email,
+        'refresh': lambda: test.webhook_update(scenario.callback(f'refresh_{scenario.email_id}')),
+        'history': lambda: test.webhook_update(scenario.callback('history')),
+        'history_page': history_page,
+        'stats': lambda: test.webhook_update(scenario.callback('stats'))
+    }
+
+
+def api_cases(test: LoadTest, telegram_id: int) -> dict:
+    state = {}
+
+    def call(body: dict):
+        return lambda: state.update(test.api_action(body))
+
+    def create_email():
+        state.update(test.api_action({
+            'action': 'create_email',
+            'telegram_id': telegram_id,
+            'email': f'{telegram_id}-{db_round_trips.value}@check.local',
+            'country_code': 'RU',
+            'country_name': 'Россия',
+            'country_flag': '🇷🇺',
+            'service_name': 'gmail',
+            'service_emoji': '📧'
+        }))
+
+    def update_code():
+        test.api_action({'action': 'update_code', 'email_id': state['email']['id'], 'code': '123456'})
+
+    def export_history():
+        result = test.bot_api.handler({'httpMethod': 'POST', 'body': json.dumps(
+            {'action': 'export_history', 'telegram_id': telegram_id})}, None)
+        if result['statusCode'] != 200 or result['headers']['X-Rows'] == '0':
+            raise RuntimeError(result)
+
+    return {
+        'create_user': call({'action': 'create_user', 'telegram_id': telegram_id, 'username': 'check'}),
+        'update_subscription': call({'action': 'update_subscription', 'telegram_id': telegram_id}),
+        'update_settings': call({'action': 'update_settings', 'telegram_id': telegram_id,
+                                 'favorite_service': 'gmail'}),
+        'create_email': create_email,
+        'update_code': update_code,
+        'get_history': call({'action': 'get_history', 'telegram_id': telegram_id, 'limit': 1}),
+        'get_history_page': lambda: call({'action': 'get_history', 'telegram_id': telegram_id,
+                                          'limit': 1, 'cursor': state['next_cursor']})(),
+        'get_stats': call({'action': 'get_stats', 'telegram_id': telegram_id}),
+        'export_history': export_history,
+        'batch': call({'action': 'batch', 'operations': [
+            {'action': 'update_subscription', 'telegram_id': telegram_id, 'is_subscribed': True},
+            {'action': 'update_settings', 'telegram_id': telegram_id, 'reminder_enabled': False}
+        ]})
+    }
+
+
+def check(cases: dict, budgets: dict, telegram_id: int) -> dict:
+    report = {}
+    for name, fn in cases.items():
+        budget = budgets[name]
+        cold, warm = budget if isinstance(budget, tuple) else (budget, budget)
+        user_cache.pop(telegram_id)
+        trips = [count(fn), count(fn)]
+        report[name] = {
+            'round_trips': trips,
+            'budget': [cold, warm],
+            'ok': trips[0] <= cold and trips[1] <= warm
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--no-prepare', action='store_true', help='DB_PREPARE=0: запросы без PREPARE')
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error('нужен --dsn или DATABASE_URL локального PostgreSQL')
+    if args.no_prepare:
+        os.environ['DB_PREPARE'] = '0'
+
+    connect = psycopg2.connect
+    psycopg2.connect = lambda *a, **kw: connect(*a, **dict(kw, cursor_factory=CountingCursor))
+    os.environ['DATABASE_URL'] = args.dsn
+
+    test = LoadTest(Namespace(telegram_ms=0, concurrency=1))
+    create_schema(args.dsn, test.schema)
+    try:
+        scenario = Scenario(8_000_000_001, test.update_ids)
+        report = {
+            'prepare': not args.no_prepare,
+            'webhook': check(webhook_cases(test, scenario), WEBHOOK_BUDGETS, scenario.telegram_id),
+            'api': check(api_cases(test, 8_000_000_002), API_BUDGETS, 8_000_000_002)
+        }
+    finally:
+        drop_schema(args.dsn, test.schema)
+
+    report['ok'] = all(case['ok'] for part in ('webhook', 'api') for case in report[part].values())
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()
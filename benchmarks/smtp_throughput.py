@@ -0,0 +1,128 @@
+"""Пропускная способность SMTP-приёма на синтетических письмах.
+
+Запуск: python benchmarks/smtp_throughput.py [--messages 2000] [--clients 50] [--db-ms 0]
+
+Сервер из smtp_server.py работает в отдельном потоке со своим event loop,
+клиенты — обычный smtplib в пуле потоков. Хранилище — в памяти, с
+необязательной искусственной задержкой, чтобы измерялся именно SMTP-конвейер.
+"""
+import argparse
+import asyncio
+import json
+import os
+import smtplib
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend', 'telegram-webhook'))
+
+from smtp_server import InboundSMTPServer  # noqa: E402
+
+
+class MemoryMailStore:
+    def __init__(self, addresses: dict, latency: float):
+        self.addresses = addresses
+        self.latency = latency
+        self.stored = 0
+
+    async def lookup(self, address):
+        return self.addresses.get(address)
+
+    async def store(self, email_ids, message):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.stored += len(email_ids)
+
+
+def build_message(i: int, recipient: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg['From'] = 'noreply@example.com'
+    msg['To'] = recipient
+    msg['Subject'] = f'Код подтверждения {i}'
+    msg.set_content(f'Ваш код: {100000 + i % 900000}\n' + 'Lorem ipsum dolor sit amet. ' * 40)
+    msg.add_alternative(f'<p>Ваш код: <b>{100000 + i % 900000}</b></p>' + '<p>Lorem ipsum</p>' * 40,
+                        subtype='html')
+    return msg
+
+
+def start_server(store) -> tuple:
+    ready = threading.Event()
+    state = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = InboundSMTPServer(store, hostname='bench.local')
+        listener = loop.run_until_complete(server.start('127.0.0.1', 0))
+        state['port'] = listener.sockets[0].getsockname()[1]
+        state['loop'] = loop
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return state['port'], state['loop']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--per-connection', type=int, default=10,
+                        help='писем в одной SMTP-сессии')
+    parser.add_argument('--db-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    addresses = {f'bench{i}@mail.local': i for i in range(1000)}
+    store = MemoryMailStore(addresses, args.db_ms / 1000)
+    port, _ = start_server(store)
+
+    recipients = list(addresses)
+    messages = []
+    for i in range(args.messages):
+        recipient = recipients[i % len(recipients)]
+        messages.append((recipient, build_message(i, recipient).as_bytes()))
+    batches = [messages[i:i + args.per_connection] for i in range(0, len(messages), args.per_connection)]
+    latencies = []
+    lock = threading.Lock()
+
+    def deliver(batch):
+        with smtplib.SMTP('127.0.0.1', port) as client:
+            for recipient, raw in batch:
+                started = time.perf_counter()
+                client.sendmail('noreply@example.com', [recipient], raw)
+                with lock:
+                    latencies.append((time.perf_counter() - started) * 1000)
+
+    with smtplib.SMTP('127.0.0.1', port) as client:
+        try:
+            client.sendmail('noreply@example.com', ['unknown@mail.local'], 'x')
+            unknown_rejected = False
+        except smtplib.SMTPRecipientsRefused:
+            unknown_rejected = True
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as executor:
+        list(executor.map(deliver, batches))
+    elapsed = time.perf_counter() - started
+
+    ordered = sorted(latencies)
+    print(json.dumps({
+        'messages': args.messages,
+        'stored': store.stored,
+        'unknown_rejected': unknown_rejected,
+        'clients': args.clients,
+        'seconds': round(elapsed, 3),
+        'messages_per_sec': round(args.messages / elapsed, 1),
+        'p50_ms': round(statistics.median(ordered), 2),
+        'p95_ms': round(ordered[int(len(ordered) * 0.95) - 1], 2),
+        'p99_ms': round(ordered[int(len(ordered) * 0.99) - 1], 2)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+ALTER TABLE users ADD COLUMN subscription_checked_at TIMESTAMP;
@@ -0,0 +1,82 @@
+CREATE TABLE user_stats (
+    user_id INTEGER PRIMARY KEY,
+    total_emails INTEGER NOT NULL DEFAULT 0,
+    countries_used INTEGER NOT NULL DEFAULT 0,
+    services_used INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE user_country_stats (
+    user_id INTEGER NOT NULL,
+    country_code VARCHAR(10) NOT NULL,
+    emails_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, country_code)
+);
+
+CREATE TABLE user_service_stats (
+    user_id INTEGER NOT NULL,
+    service_name VARCHAR(100) NOT NULL,
+    service_emoji VARCHAR(10) NOT NULL,
+    emails_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, service_name)
+);
+
+-- Счётчики обновляются в той же транзакции, что и INSERT в temp_emails.
+-- xmax = 0 у строки из RETURNING означает, что она только что вставлена,
+-- то есть страна или сервис встретились у пользователя впервые.
+CREATE FUNCTION user_stats_on_email_insert() RETURNS trigger AS $$
+DECLARE
+    new_country BOOLEAN;
+    new_service BOOLEAN;
+BEGIN
+    IF NEW.user_id IS NULL THEN
+        RETURN NEW;
+    END IF;
+
+    INSERT INTO user_country_stats (user_id, country_code, emails_count)
+    VALUES (NEW.user_id, NEW.country_code, 1)
+    ON CONFLICT (user_id, country_code)
+    DO UPDATE SET emails_count = user_country_stats.emails_count + 1
+    RETURNING (xmax = 0) INTO new_country;
+
+    INSERT INTO user_service_stats (user_id, service_name, service_emoji, emails_count)
+    VALUES (NEW.user_id, NEW.service_name, NEW.service_emoji, 1)
+    ON CONFLICT (user_id, service_name)
+    DO UPDATE SET emails_count = user_service_stats.emails_count + 1,
+                  service_emoji = EXCLUDED.service_emoji
+    RETURNING (xmax = 0) INTO new_service;
+
+    INSERT INTO user_stats (user_id, total_emails, countries_used, services_used)
+    VALUES (NEW.user_id, 1, new_country::int, new_service::int)
+    ON CONFLICT (user_id)
+    DO UPDATE SET total_emails = user_stats.total_emails + 1,
+                  countries_used = user_stats.countries_used + EXCLUDED.countries_used,
+                  services_used = user_stats.services_used + EXCLUDED.services_used,
+                  updated_at = CURRENT_TIMESTAMP;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_temp_emails_user_stats
+AFTER INSERT ON temp_emails
+FOR EACH ROW EXECUTE FUNCTION user_stats_on_email_insert();
+
+-- Первичное заполнение по уже существующим почтам
+INSERT INTO user_country_stats (user_id, country_code, emails_count)
+SELECT user_id, country_code, COUNT(*)
+FROM temp_emails
+WHERE user_id IS NOT NULL
+GROUP BY user_id, country_code;
+
+INSERT INTO user_service_stats (user_id, service_name, service_emoji, emails_count)
+SELECT user_id, service_name, MAX(service_emoji), COUNT(*)
+FROM temp_emails
+WHERE user_id IS NOT NULL
+GROUP BY user_id, service_name;
+
+INSERT INTO user_stats (user_id, total_emails, countries_used, services_used)
+SELECT user_id, COUNT(*), COUNT(DISTINCT country_code), COUNT(DISTINCT service_name)
+FROM temp_emails
+WHERE user_id IS NOT NULL
+GROUP BY user_id;
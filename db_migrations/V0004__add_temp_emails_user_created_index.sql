@@ -0,0 +1,4 @@
+CREATE INDEX idx_temp_emails_user_created ON temp_emails(user_id, created_at DESC, id DESC);
+
+-- Префикс нового индекса полностью заменяет индекс по одному user_id
+DROP INDEX idx_temp_emails_user_id;
@@ -0,0 +1,76 @@
+-- temp_emails секционируется по месяцам created_at: старые месяцы отключаются
+-- (DETACH) или удаляются (DROP) целиком, без построчного DELETE.
+-- Ключ секционирования обязан входить в первичный ключ, поэтому PK = (id, created_at).
+
+CREATE TABLE temp_emails_partitioned (
+    id INTEGER NOT NULL DEFAULT nextval('temp_emails_id_seq'),
+    user_id INTEGER,
+    email VARCHAR(255) NOT NULL,
+    country_code VARCHAR(10) NOT NULL,
+    country_name VARCHAR(100) NOT NULL,
+    country_flag VARCHAR(10) NOT NULL,
+    service_name VARCHAR(100) NOT NULL,
+    service_emoji VARCHAR(10) NOT NULL,
+    received_code VARCHAR(50),
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    is_archived BOOLEAN DEFAULT false,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE temp_emails_default PARTITION OF temp_emails_partitioned DEFAULT;
+
+-- Создание месячных секций от month_from до month_to включительно
+CREATE FUNCTION create_temp_emails_partitions(month_from DATE, month_to DATE) RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE := date_trunc('month', month_from);
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    WHILE month_start <= month_to LOOP
+        partition_name := 'temp_emails_' || to_char(month_start, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF temp_emails FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, (month_start + INTERVAL '1 month')::date
+            );
+            created := created + 1;
+        END IF;
+        month_start := (month_start + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO temp_emails_partitioned
+    (id, user_id, email, country_code, country_name, country_flag, service_name,
+     service_emoji, received_code, created_at, expires_at, is_archived)
+SELECT id, user_id, email, country_code, country_name, country_flag, service_name,
+       service_emoji, received_code, COALESCE(created_at, expires_at - INTERVAL '15 minutes'),
+       expires_at, is_archived
+FROM temp_emails;
+
+ALTER SEQUENCE temp_emails_id_seq OWNED BY NONE;
+DROP TABLE temp_emails;
+ALTER TABLE temp_emails_partitioned RENAME TO temp_emails;
+ALTER SEQUENCE temp_emails_id_seq OWNED BY temp_emails.id;
+
+-- Секции для уже существующих данных и на три месяца вперёд; строки,
+-- попавшие в DEFAULT при копировании, переносятся в свои секции
+CREATE TEMP TABLE temp_emails_moved AS SELECT * FROM temp_emails_default;
+DELETE FROM temp_emails_default;
+SELECT create_temp_emails_partitions(
+    COALESCE((SELECT MIN(created_at) FROM temp_emails_moved)::date, CURRENT_DATE),
+    (CURRENT_DATE + INTERVAL '3 months')::date
+);
+INSERT INTO temp_emails SELECT * FROM temp_emails_moved;
+DROP TABLE temp_emails_moved;
+
+CREATE INDEX idx_temp_emails_user_created ON temp_emails(user_id, created_at DESC, id DESC);
+
+-- Частичный индекс: архивные строки не мешают сборщику истёкших почт
+CREATE INDEX idx_temp_emails_expires_at ON temp_emails(expires_at) WHERE NOT is_archived;
+
+CREATE TRIGGER trg_temp_emails_user_stats
+AFTER INSERT ON temp_emails
+FOR EACH ROW EXECUTE FUNCTION user_stats_on_email_insert();
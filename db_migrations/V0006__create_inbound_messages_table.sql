@@ -0,0 +1,15 @@
+CREATE TABLE inbound_messages (
+    id SERIAL PRIMARY KEY,
+    email_id INTEGER NOT NULL,
+    mail_from VARCHAR(255),
+    subject TEXT,
+    text_body TEXT,
+    html_body TEXT,
+    size_bytes INTEGER,
+    received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_inbound_messages_email_id ON inbound_messages(email_id, received_at DESC);
+
+-- Поиск получателя на этапе RCPT TO
+CREATE INDEX idx_temp_emails_email ON temp_emails(email);
@@ -0,0 +1,2 @@
+ALTER TABLE inbound_messages ADD COLUMN code VARCHAR(50);
+ALTER TABLE inbound_messages ADD COLUMN link TEXT;
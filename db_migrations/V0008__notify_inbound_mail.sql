@@ -0,0 +1,31 @@
+ALTER TABLE inbound_messages ADD COLUMN notified_at TIMESTAMP;
+
+-- Письма, о которых ещё не сообщили в чат: догоняющий проход notifier.py после перезапуска
+CREATE INDEX idx_inbound_messages_unnotified ON inbound_messages(received_at) WHERE notified_at IS NULL;
+
+-- В канал уходит только id почты, код и письмо notifier читает сам одной выборкой.
+-- Одинаковые уведомления внутри транзакции PostgreSQL доставляет один раз.
+CREATE FUNCTION notify_inbound_message() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('inbound_mail', NEW.email_id::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_inbound_messages_notify
+AFTER INSERT ON inbound_messages
+FOR EACH ROW EXECUTE FUNCTION notify_inbound_message();
+
+-- Код может прийти и без письма (действие update_code), поэтому помечаем источник
+CREATE FUNCTION notify_received_code() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('inbound_mail', NEW.id::text || ':code');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_temp_emails_notify_code
+AFTER UPDATE OF received_code ON temp_emails
+FOR EACH ROW
+WHEN (NEW.received_code IS NOT NULL AND NEW.received_code IS DISTINCT FROM OLD.received_code)
+EXECUTE FUNCTION notify_received_code();
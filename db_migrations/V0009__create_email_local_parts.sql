@@ -0,0 +1,23 @@
+-- Реестр локальных частей адресов. Уникальный индекс по email на секционированной
+-- temp_emails невозможен (ключ секционирования обязан входить в каждый уникальный
+-- индекс), поэтому уникальность обеспечивает первичный ключ этой таблицы.
+-- Строки с assigned_at IS NULL — заранее сгенерированный запас для create_temp_email.
+CREATE TABLE email_local_parts (
+    local_part VARCHAR(64) PRIMARY KEY,
+    reserved_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    assigned_at TIMESTAMP,
+    expires_at TIMESTAMP
+);
+
+-- Выдача из запаса в порядке резервирования
+CREATE INDEX idx_email_local_parts_free ON email_local_parts(reserved_at) WHERE assigned_at IS NULL;
+
+-- Дозагрузка фильтра Блума в smtp_server.py: новые строки после последней загрузки
+CREATE INDEX idx_email_local_parts_reserved_at ON email_local_parts(reserved_at);
+
+-- Уже выданные адреса тоже занимают свои локальные части
+INSERT INTO email_local_parts (local_part, reserved_at, assigned_at, expires_at)
+SELECT lower(split_part(email, '@', 1)), MIN(created_at), MIN(created_at), MAX(expires_at)
+FROM temp_emails
+GROUP BY lower(split_part(email, '@', 1))
+ON CONFLICT (local_part) DO NOTHING;
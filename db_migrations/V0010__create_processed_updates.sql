@@ -0,0 +1,9 @@
+-- update_id уже обработанных апдейтов: повторная доставка Telegram не создаёт
+-- второй почты и вторых сообщений. Строки старше суток удаляет sweeper.py.
+CREATE TABLE processed_updates (
+    update_id BIGINT PRIMARY KEY,
+    processed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Строки добавляются по времени, поэтому для очистки хватает компактного BRIN
+CREATE INDEX idx_processed_updates_processed_at ON processed_updates USING brin(processed_at);
@@ -0,0 +1,27 @@
+-- Исходящие вызовы Bot API: вебхук записывает их в той же транзакции, что и свои
+-- изменения, а отправляет outbox.py. Отправленные строки удаляются, поэтому
+-- таблица остаётся маленькой.
+CREATE TABLE outbox (
+    id BIGSERIAL PRIMARY KEY,
+    method VARCHAR(64) NOT NULL,
+    payload JSONB NOT NULL,
+    priority SMALLINT NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Выборка готовых к отправке; захваченная строка получает available_at в будущем (аренда)
+CREATE INDEX idx_outbox_available_at ON outbox(available_at);
+
+-- Вызовы, которые не удалось выполнить: постоянная ошибка или исчерпаны попытки
+CREATE TABLE outbox_dead_letters (
+    id BIGINT PRIMARY KEY,
+    method VARCHAR(64) NOT NULL,
+    payload JSONB NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL,
+    failed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,11 @@
+-- Накопительные счётчики обработки апдейтов и действий API. Каждый экземпляр
+-- функции раз в METRICS_FLUSH_SECONDS прибавляет свои приращения, действие
+-- metrics в telegram-bot отдаёт итог в текстовом формате Prometheus.
+CREATE TABLE metrics_counters (
+    function VARCHAR(64) NOT NULL,
+    span VARCHAR(64) NOT NULL,
+    metric VARCHAR(64) NOT NULL,
+    value DOUBLE PRECISION NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (function, span, metric)
+);
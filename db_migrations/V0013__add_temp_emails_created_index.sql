@@ -0,0 +1,3 @@
+-- Общая выгрузка истории (export_history без telegram_id) читает все почты
+-- от новых к старым: индекс позволяет отдавать строки без сортировки таблицы
+CREATE INDEX idx_temp_emails_created ON temp_emails(created_at DESC, id DESC);
@@ -0,0 +1,4 @@
+-- Отметка напоминания «почта удалится через 2 минуты» (reminders.py). Её ставит
+-- тот же UPDATE, который захватывает строку перед отправкой, поэтому несколько
+-- экземпляров планировщика не отправляют напоминание дважды.
+ALTER TABLE temp_emails ADD COLUMN reminded_at TIMESTAMP;
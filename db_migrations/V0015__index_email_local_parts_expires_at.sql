@@ -0,0 +1,3 @@
+-- Перестройка фильтра адресов (AddressFilter.load) и очистка истёкших локальных
+-- частей в sweeper.py (prune_local_parts) выбирают строки по expires_at
+CREATE INDEX idx_email_local_parts_expires_at ON email_local_parts(expires_at);
@@ -0,0 +1,9 @@
+-- Порядок сообщений в чате: outbox.py берёт только самую раннюю строку каждого
+-- чата, пока она не отправлена или не ушла в outbox_dead_letters
+ALTER TABLE outbox ADD COLUMN chat_id BIGINT;
+
+UPDATE outbox
+SET chat_id = (payload->>'chat_id')::bigint
+WHERE payload->>'chat_id' ~ '^-?[0-9]+$';
+
+CREATE INDEX idx_outbox_chat_id ON outbox(chat_id, id);